@@ -0,0 +1,167 @@
+"""
+Admission control and load shedding for write endpoints.
+
+SQLite only has one writer at a time, so during a check-in storm extra write requests just queue up
+behind its lock until clients time out and retry. Instead, write routes take one of a small number
+of writer slots before they run. Requests that can't get a slot wait in a priority queue, and are
+turned away with a 503 and a Retry-After header when the queue is already too long for their route
+or they have waited too long. Each route has a policy:
+
+    priority   lower values get free slots first (check-ins before scans before hardware)
+    max_queue  reject the request if this many requests are already waiting, on any route,
+               so lower value routes with shorter limits are shed first as the queue grows
+    max_wait   seconds a request may wait for a slot
+
+Admission is an async dependency, so it runs on the event loop before a threadpool thread or a
+database connection is taken:
+
+    @app.put("/users/{user_id}/checkin", dependencies=[Depends(admit("checkin"))])
+
+Configured with environment variables:
+
+    SQL_APP_ADMISSION          set to off to admit every request immediately (on by default)
+    SQL_APP_WRITE_CONCURRENCY  number of writer slots (4)
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+from collections import Counter
+from dataclasses import dataclass
+
+from fastapi import HTTPException
+
+from . import metrics
+
+ADMISSION_ENABLED = os.environ.get("SQL_APP_ADMISSION", "on") not in ("off", "0", "false")
+WRITE_CONCURRENCY = int(os.environ.get("SQL_APP_WRITE_CONCURRENCY", "4"))
+
+
+@dataclass(frozen=True)
+class AdmissionPolicy:
+    name: str
+    priority: int
+    max_queue: int
+    max_wait: float
+
+
+POLICIES = {
+    policy.name: policy for policy in [
+        AdmissionPolicy("checkin", priority=0, max_queue=256, max_wait=2.0),
+        AdmissionPolicy("scan", priority=1, max_queue=128, max_wait=1.0),
+        AdmissionPolicy("update_user", priority=2, max_queue=32, max_wait=1.0),
+        AdmissionPolicy("hardware", priority=3, max_queue=16, max_wait=0.5),
+    ]
+}
+
+rejections = metrics.CounterFamily(
+    "admission_rejections_total", "Write requests turned away with a 503.", ("route", "reason")
+)
+wait_time = metrics.HistogramFamily(
+    "admission_wait_seconds", "Time admitted write requests waited for a writer slot.", metrics.LATENCY_BUCKETS, ("route",)
+)
+
+
+class AdmissionController:
+    """
+    Writer slots and the queue of requests waiting for one. Only used from the event loop thread,
+    so it needs no locks.
+    """
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self.waiters = []  # Heap of (priority, sequence, policy name, future)
+        self.waiting = 0
+        self.queue_depth = Counter()  # policy name -> requests waiting
+        self.sequence = itertools.count()
+
+    async def acquire(self, policy):
+        if self.active < self.max_concurrency and not self.waiting:
+            self.active += 1
+            wait_time.labels(policy.name).observe(0.0)
+            return
+        if self.waiting >= policy.max_queue:
+            reject(policy, "queue_full", self.retry_after(policy))
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (policy.priority, next(self.sequence), policy.name, future))
+        self.waiting += 1
+        self.queue_depth[policy.name] += 1
+        start = time.perf_counter()
+        try:
+            # wait_for cancels the future on timeout, and release() skips cancelled futures
+            await asyncio.wait_for(future, policy.max_wait)
+        except asyncio.TimeoutError:
+            self.dequeued(policy.name)
+            reject(policy, "timeout", self.retry_after(policy))
+        except asyncio.CancelledError:
+            # The client went away. If a slot was handed over at the same moment, pass it on
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                self.dequeued(policy.name)
+            raise
+        wait_time.labels(policy.name).observe(time.perf_counter() - start)
+
+    def release(self):
+        while self.waiters:
+            _, _, name, future = heapq.heappop(self.waiters)
+            if future.cancelled():
+                continue
+            # Hand the slot straight to the next request, so active doesn't change
+            self.dequeued(name)
+            future.set_result(None)
+            return
+        self.active -= 1
+
+    def dequeued(self, name):
+        self.waiting -= 1
+        self.queue_depth[name] -= 1
+
+    def retry_after(self, policy):
+        return max(1, math.ceil(policy.max_wait))
+
+    def collect_metrics(self):
+        yield "# HELP admission_queue_depth Write requests waiting for a writer slot."
+        yield "# TYPE admission_queue_depth gauge"
+        for name in POLICIES:
+            yield f'admission_queue_depth{{route="{name}"}} {self.queue_depth[name]}'
+        yield "# HELP admission_active_writes Write requests holding a writer slot."
+        yield "# TYPE admission_active_writes gauge"
+        yield f"admission_active_writes {self.active}"
+
+
+def reject(policy, reason, retry_after):
+    rejections.inc(policy.name, reason)
+    raise HTTPException(
+        status_code=503,
+        detail="The server is busy handling other writes, please retry shortly",
+        headers={"Retry-After": str(retry_after)}
+    )
+
+
+controller = AdmissionController(WRITE_CONCURRENCY)
+metrics.register_collector(controller.collect_metrics)
+metrics.register_collector(rejections.render)
+metrics.register_collector(wait_time.render)
+
+
+def admit(policy_name):
+    """
+    Dependency that holds a writer slot for the rest of the request.
+    """
+    policy = POLICIES[policy_name]
+
+    async def admission():
+        if not ADMISSION_ENABLED:
+            yield
+            return
+        await controller.acquire(policy)
+        try:
+            yield
+        finally:
+            controller.release()
+
+    return admission
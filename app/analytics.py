@@ -0,0 +1,177 @@
+"""
+In-memory rollups behind the /analytics endpoints: per-company headcounts, check-ins and skill
+counts, and a rating histogram per skill.
+
+The rollup is built on first use with a few GROUP BY queries. After that it is an incremental view
+(see user_changes.py): committed changes to users replace those users' contribution to the counts
+instead of rebuilding them. With several workers, set SQL_APP_ANALYTICS_MAX_AGE to rebuild rollups
+older than that many seconds, since changes made by other processes aren't seen.
+"""
+import heapq
+import os
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+
+from sqlalchemy import Integer, func, select
+
+from . import models, user_changes
+
+ANALYTICS_MAX_AGE = float(os.environ.get("SQL_APP_ANALYTICS_MAX_AGE", "0"))
+
+
+class CompanyStats:
+    __slots__ = ("headcount", "checked_in", "skills")
+
+    def __init__(self):
+        self.headcount = 0
+        self.checked_in = 0
+        self.skills = Counter()  # skill_id -> users at the company with the skill
+
+
+class Rollup:
+    def __init__(self):
+        self.companies = defaultdict(CompanyStats)
+        self.ratings = defaultdict(Counter)  # skill_id -> rating -> users
+        self.skill_names = {}
+        self.ranking = None  # Companies by headcount, kept until a headcount changes
+
+    @classmethod
+    def build(cls, connection):
+        """
+        Aggregate the whole database with set-based queries.
+        """
+        rollup = cls()
+        users = select(
+            models.User.company,
+            func.count(),
+            # Without type_, the sum would be read back as a Boolean like the column
+            func.coalesce(func.sum(models.User.checked_in, type_=Integer), 0)
+        ).group_by(models.User.company)
+        for company, headcount, checked_in in connection.execute(users):
+            stats = rollup.companies[company]
+            stats.headcount = headcount
+            stats.checked_in = checked_in
+
+        # One pass over UserSkills gives both the skills of each company and the rating histograms
+        skills = (
+            select(models.User.company, models.UserSkill.skill_id, models.UserSkill.rating, func.count())
+            .join(models.User, models.User.user_id == models.UserSkill.user_id)
+            .group_by(models.User.company, models.UserSkill.skill_id, models.UserSkill.rating)
+        )
+        for company, skill_id, rating, users in connection.execute(skills):
+            rollup.companies[company].skills[skill_id] += users
+            rollup.ratings[skill_id][rating] += users
+
+        rollup.skill_names.update(connection.execute(select(models.Skill.skill_id, models.Skill.skill_name)).all())
+        return rollup
+
+    def apply(self, before, after):
+        """
+        Replace the contribution of some users, given their images before and after a change.
+        """
+        companies = {image[0] for image in before.values()} | {image[0] for image in after.values()}
+        headcounts = {company: self.headcount(company) for company in companies}
+        self.add(before, -1)
+        self.add(after, 1)
+        # Check-ins and skill changes don't move companies up or down the ranking
+        for company, headcount in headcounts.items():
+            if self.headcount(company) != headcount:
+                self.rank(company, headcount)
+
+    def add(self, images, sign):
+        for company, checked_in, skills in images.values():
+            stats = self.companies[company]
+            stats.headcount += sign
+            stats.checked_in += sign * checked_in
+            for skill_id, (skill_name, rating) in skills.items():
+                stats.skills[skill_id] += sign
+                if stats.skills[skill_id] <= 0:
+                    del stats.skills[skill_id]
+                self.ratings[skill_id][rating] += sign
+                self.skill_names[skill_id] = skill_name
+            if stats.headcount <= 0:
+                del self.companies[company]
+
+    def headcount(self, company):
+        stats = self.companies.get(company)
+        return stats.headcount if stats is not None else 0
+
+    def rank(self, company, old_headcount):
+        """
+        Move a company whose headcount changed to its new place in the ranking.
+        """
+        if self.ranking is None:
+            return
+        if old_headcount > 0:
+            index = bisect_left(self.ranking, ranking_key(company, old_headcount))
+            del self.ranking[index]
+        headcount = self.headcount(company)
+        if headcount > 0:
+            insort(self.ranking, ranking_key(company, headcount))
+
+    def companies_by_headcount(self):
+        """
+        Ranking keys of the companies, largest first (see ranking_key).
+        """
+        if self.ranking is None:
+            self.ranking = sorted(ranking_key(company, stats.headcount) for company, stats in self.companies.items())
+        return self.ranking
+
+
+def ranking_key(company, headcount):
+    # Largest companies first, then by name. Users without a company sort last among their size
+    return (-headcount, company is None, company or "")
+
+
+rollup = user_changes.register(user_changes.IncrementalView("analytics", Rollup.build, max_age=ANALYTICS_MAX_AGE))
+
+
+def company_summaries(current, limit, top_skills, min_headcount=1):
+    """
+    The largest companies first, with their check-in ratio and most common skills.
+    """
+    summaries = []
+    for negative_headcount, no_company, company in current.companies_by_headcount():
+        if limit is not None and len(summaries) >= limit or -negative_headcount < min_headcount:
+            break
+        company = None if no_company else company
+        stats = current.companies[company]
+        summaries.append({
+            "company": company,
+            "headcount": stats.headcount,
+            "checked_in": stats.checked_in,
+            "checked_in_ratio": stats.checked_in / stats.headcount,
+            "top_skills": [
+                {"skill": skill_name, "users": users}
+                for users, skill_name in top_skills_of(current, stats, top_skills)
+            ],
+        })
+    return summaries
+
+
+def top_skills_of(current, stats, count):
+    """
+    The company's most common skills as (users, skill_name), ties broken by name so the order
+    doesn't depend on the order changes were applied in.
+    """
+    skills = ((users, current.skill_names.get(skill_id) or "") for skill_id, users in stats.skills.items())
+    return heapq.nsmallest(count, skills, key=lambda skill: (-skill[0], skill[1]))
+
+
+def skill_rating_histograms(current):
+    """
+    How many users rated themselves 1 to 5 in each skill, most common skills first.
+    """
+    histograms = []
+    for skill_id, ratings in current.ratings.items():
+        users = sum(ratings.values())
+        if users <= 0:
+            continue
+        histograms.append({
+            "skill": current.skill_names.get(skill_id),
+            "users": users,
+            "average_rating": sum(rating * count for rating, count in ratings.items()) / users,
+            "ratings": {rating: count for rating, count in sorted(ratings.items()) if count > 0},
+        })
+    histograms.sort(key=lambda histogram: (-histogram["users"], histogram["skill"] or ""))
+    return histograms
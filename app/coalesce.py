@@ -0,0 +1,112 @@
+"""
+Single-flight request coalescing for expensive aggregate reads.
+
+When many clients ask for the same aggregate at the same moment (every organizer dashboard
+loading /skills/ at once), only the first request runs the query. Identical requests that arrive
+while it is running wait for it and share its result, or its exception. Requests are identical when
+they are for the same route with the same query parameters, after FastAPI has parsed them.
+
+A route can also keep its result for a short freshness window (ttl, in seconds), so requests that
+arrive just after the computation finished reuse it too:
+
+    @app.get("/skills/")
+    @budget(max_queries=1)
+    @coalesce(ttl=0.5)
+    def read_skill_frequencies(...):
+
+Results are shared between requests, so they must not be modified after they are returned.
+"""
+import functools
+import threading
+import time
+
+from sqlalchemy.orm import Session
+
+from . import metrics
+
+coalesced_calls = metrics.CounterFamily(
+    "coalesced_calls_total",
+    "Calls to coalesced routes, by whether they ran the computation, waited for one in flight or reused a fresh result.",
+    ("route", "result"),
+)
+metrics.register_collector(coalesced_calls.render)
+
+
+class Call:
+    __slots__ = ("done", "result", "error", "finished_at")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.finished_at = None
+
+
+class SingleFlight:
+    def __init__(self, name, ttl=0.0):
+        self.name = name
+        self.ttl = ttl
+        self.calls = {}  # key -> the Call in flight, or the last one while it is fresh
+        self.lock = threading.Lock()
+
+    def do(self, key, function):
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None and call.done.is_set() and time.monotonic() - call.finished_at >= self.ttl:
+                call = None
+            if call is None:
+                call = self.calls[key] = Call()
+                leader = True
+            else:
+                leader = False
+            result = "leader" if leader else ("cached" if call.done.is_set() else "coalesced")
+            coalesced_calls.inc(self.name, result)
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                call.finished_at = time.monotonic()
+                call.done.set()
+                # Failed calls are never reused, and without a ttl neither are results
+                if call.error is not None or self.ttl <= 0:
+                    self.calls.pop(key, None)
+        return call.result
+
+
+def request_key(kwargs):
+    """
+    The endpoint's arguments without the database session, in a fixed order.
+    """
+    return tuple(sorted(
+        (name, tuple(value) if isinstance(value, list) else value)
+        for name, value in kwargs.items()
+        if not isinstance(value, Session)
+    ))
+
+
+def coalesce(ttl=0.0):
+    """
+    Decorator for sync endpoints whose concurrent identical calls should share one computation.
+    Endpoints must be called with keyword arguments, as FastAPI does.
+    """
+    def decorator(endpoint):
+        flight = SingleFlight(endpoint.__name__, ttl)
+
+        @functools.wraps(endpoint)
+        def wrapper(**kwargs):
+            return flight.do(request_key(kwargs), lambda: endpoint(**kwargs))
+
+        wrapper.__single_flight__ = flight
+        return wrapper
+
+    return decorator
@@ -0,0 +1,63 @@
+import os
+import tempfile
+
+import pytest
+
+from app import snapshot
+
+# The seeded database is built once and shared by every test run (and every pytest-xdist worker)
+SEED_SNAPSHOT_PATH = os.path.join(tempfile.gettempdir(), "htn-2024-seed-snapshot.db")
+
+# Each test process gets its own database file, so workers never share state. This has to be set
+# before app.database is imported by the test modules.
+TEST_DATABASE_PATH = os.path.join(
+    tempfile.mkdtemp(prefix="htn-2024-tests-"),
+    f"test_{os.environ.get('PYTEST_XDIST_WORKER', 'main')}.db"
+)
+os.environ["SQL_APP_DB_PATH"] = TEST_DATABASE_PATH
+os.environ.pop("SQL_APP_SNAPSHOT", None)
+
+# Fail any request that goes over its query budget, and report query counts in X-Query-Count
+os.environ["SQL_APP_QUERY_BUDGET"] = "raise"
+os.environ["SQL_APP_DEBUG"] = "1"
+
+# Enables the admin endpoints
+ADMIN_TOKEN = "test-admin-token"
+os.environ["SQL_APP_ADMIN_TOKEN"] = ADMIN_TOKEN
+
+
+@pytest.fixture(scope="session")
+def seed_snapshot():
+    """
+    Seed the database once per session (or reuse an up to date snapshot from a previous run).
+    """
+    return snapshot.seed_snapshot(SEED_SNAPSHOT_PATH)
+
+
+@pytest.fixture(autouse=True)
+def fresh_db(seed_snapshot):
+    """
+    Restore the seeded database before every test so tests can't affect each other.
+    """
+    from app import pipeline, user_changes
+    from app.user_cache import user_cache
+    # Not while the outbox worker is writing to the file. The previous test's events go with it.
+    with pipeline.worker.lock:
+        snapshot.restore_snapshot(seed_snapshot, TEST_DATABASE_PATH)
+    user_cache.clear()
+    user_changes.reset()
+    yield TEST_DATABASE_PATH
+
+
+@pytest.fixture
+def query_recorder():
+    """
+    Returns a context manager that records the SQL statements run inside it:
+
+        with query_recorder() as queries:
+            client.get("/users/1")
+        queries.assert_budget(max_queries=2)
+    """
+    from app.database import get_engine
+    from app.query_budget import record_queries
+    return lambda: record_queries(get_engine())
@@ -1,16 +1,137 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from fastapi import FastAPI, Depends
-from . import models
+"""
+The database engine and sessions.
 
-DATABASE_URL = "sqlite:///./sql_app.db"
-engine = create_engine(DATABASE_URL)
+Nothing touches the database when this module is imported. init_engine() creates a missing
+database from the snapshot (if SQL_APP_SNAPSHOT is set), creates the engine and any missing tables, and attaches the
+instrumentation. The app runs it from its lifespan startup, together with the warm-up below.
+Without a lifespan (a TestClient used without a with block, scripts), the first session or
+get_engine() call runs it instead.
+"""
+import os
+import threading
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session, sessionmaker
 
-models.Base.metadata.create_all(bind=engine)
+from . import analytics, idempotency, matching, metrics, models, pipeline, query_budget, scan_rollups, snapshot, user_cache, user_changes
+
+# SQL_APP_DB_PATH points the app at a different database file (e.g. one per test worker)
+DATABASE_FILE_PATH = os.environ.get("SQL_APP_DB_PATH", "./sql_app.db")
+DATABASE_URL = f"sqlite:///{DATABASE_FILE_PATH}"
+
+# SQL_APP_SNAPSHOT creates the database from a prebuilt snapshot if it doesn't exist yet. It is never
+# restored over an existing database, since other workers may be writing to it (python -m
+# app.snapshot restore does that explicitly)
+SNAPSHOT_PATH = os.environ.get("SQL_APP_SNAPSHOT")
+
+# SQL_APP_WARMUP=off skips filling the connection pool and preparing the hot statements on startup
+WARMUP_ENABLED = os.environ.get("SQL_APP_WARMUP", "on") not in ("off", "0", "false")
+# SQL_APP_PRELOAD is a comma separated list of in-memory views to build before serving requests
+PRELOAD = [name.strip() for name in os.environ.get("SQL_APP_PRELOAD", "").split(",") if name.strip()]
+PRELOADABLE_VIEWS = {"analytics": analytics.rollup, "matching": matching.matrix}
+
+engine = None
+_init_lock = threading.Lock()
+
+
+def init_engine():
+    """
+    Create the engine and the schema on first call, and return the engine.
+    """
+    global engine
+    if engine is not None:
+        return engine
+    with _init_lock:
+        if engine is not None:
+            return engine
+        if SNAPSHOT_PATH:
+            snapshot.create_from_snapshot(SNAPSHOT_PATH, DATABASE_FILE_PATH)
+
+        new_engine = create_engine(DATABASE_URL, poolclass=metrics.TimedQueuePool)
+        # Before the instrumentation is attached, so the schema check isn't counted against the
+        # query budget of the request that happens to create the engine
+        models.Base.metadata.create_all(bind=new_engine)
+        SessionLocal.configure(bind=new_engine)
+
+        metrics.instrument(new_engine, SessionLocal)
+        query_budget.instrument(new_engine)
+        user_cache.instrument(new_engine, SessionLocal)
+        scan_rollups.instrument(SessionLocal)
+        pipeline.instrument(new_engine, SessionLocal)
+        idempotency.instrument(SessionLocal)
+        # The analytics and matching views register themselves with user_changes when imported
+        user_changes.instrument(new_engine, SessionLocal)
+        # Only set once everything is attached, so other threads never use a half set up engine
+        engine = new_engine
+    return engine
+
+
+get_engine = init_engine
+
+
+class LazySessionmaker(sessionmaker):
+    """
+    A sessionmaker that creates the engine the first time a session is made.
+    """
+    def __call__(self, **kwargs):
+        if engine is None:
+            init_engine()
+        return super().__call__(**kwargs)
+
+
+SessionLocal = LazySessionmaker(autocommit=False, autoflush=False)
+
+
+def warm_up():
+    """
+    Fill the connection pool, and run the statements of the hottest read paths once on every
+    pooled connection. That compiles them into SQLAlchemy's statement cache and prepares them in
+    the sqlite3 statement cache of each connection, so a new worker's first requests don't pay for it.
+    """
+    from . import queries
+
+    if not WARMUP_ENABLED:
+        return
+    init_engine()
+    # Hold every connection at once, or the pool would hand out the same one each time
+    connections = [engine.connect() for _ in range(engine.pool.size())]
+    try:
+        for connection in connections:
+            connection.execute(text("SELECT 1"))
+            with Session(bind=connection) as db:
+                # Missing ids and a one row page, so the statements run without doing much work
+                queries.load_user(db, 0)
+                queries.load_users(db, limit=1)
+                queries.load_users_by_id(db, [0])
+                queries.load_signed_out_hardware(db, 0)
+                queries.load_scanned_events(db, 0)
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+def preload():
+    """
+    Build the views listed in SQL_APP_PRELOAD now, rather than on the first request that needs them.
+    """
+    unknown = set(PRELOAD) - PRELOADABLE_VIEWS.keys()
+    if unknown:
+        raise ValueError(f"Unknown views in SQL_APP_PRELOAD: {', '.join(sorted(unknown))}")
+    init_engine()
+    for name in PRELOAD:
+        PRELOADABLE_VIEWS[name].get()
+
+
+def startup():
+    """
+    Everything a worker does before it serves requests.
+    """
+    init_engine()
+    warm_up()
+    preload()
+    # Also picks up the events a previous run left in the outbox
+    pipeline.worker.start()
 
-app = FastAPI()
 
 # Dependency
 def get_db():
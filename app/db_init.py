@@ -1,30 +1,36 @@
+from collections import defaultdict
 from datetime import datetime
+import argparse
 import json
 import logging
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, select, update
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.orm import sessionmaker
-from models import Base, Event, Hardware, User, Skill, UserSkill
+from models import Base, Event, Hardware, User, Skill, UserChange, UserSkill
 
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-DATABASE_FILE_PATH = "./sql_app.db"  # Define the path to the database file
+# Define the path to the database file. SQL_APP_DB_PATH lets tests and tools seed a different file.
+DATABASE_FILE_PATH = os.environ.get("SQL_APP_DB_PATH", "./sql_app.db")
+DATABASE_URL = f"sqlite:///{DATABASE_FILE_PATH}"
 
-# Check if the database file exists and delete it if it does
-if os.path.exists(DATABASE_FILE_PATH):
-    os.remove(DATABASE_FILE_PATH)
-    logging.info(f"Deleted existing database file: {DATABASE_FILE_PATH}")
-else:
-    logging.info(f"Database file not found, no need to delete: {DATABASE_FILE_PATH}")
+# Number of rows sent to the database per statement when syncing
+SYNC_BATCH_SIZE = 500
 
-
-DATABASE_URL = "sqlite:///./sql_app.db"
 engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-Base.metadata.create_all(bind=engine)
+
+def reset_db_file():
+    # Check if the database file exists and delete it if it does
+    if os.path.exists(DATABASE_FILE_PATH):
+        os.remove(DATABASE_FILE_PATH)
+        logging.info(f"Deleted existing database file: {DATABASE_FILE_PATH}")
+    else:
+        logging.info(f"Database file not found, no need to delete: {DATABASE_FILE_PATH}")
 
 def init_db():
     db = SessionLocal()
@@ -113,5 +119,217 @@ def init_db():
     finally:
         db.close()
 
+
+def chunked(items, size=SYNC_BATCH_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def load_participants(path):
+    """
+    Read the participant file and apply the same cleaning rules as init_db.
+    Returns the cleaned participants and the number of participants that were skipped.
+    """
+    with open(path, 'r') as file:
+        data = json.load(file)
+
+    participants = []
+    skipped = 0
+    seen_emails = set()
+    seen_phones = set()
+    for user_data in data:
+        if user_data['email'] in seen_emails or user_data['phone'] in seen_phones:
+            logging.warning(f"Skipping user with duplicate email or phone: {user_data['email']} / {user_data['phone']}")
+            skipped += 1
+            continue
+        seen_emails.add(user_data['email'])
+        seen_phones.add(user_data['phone'])
+
+        # Keep the first rating of each skill, like init_db does
+        skills = {}
+        for skill_data in user_data['skills']:
+            if skill_data['skill'] in skills:
+                logging.warning(f"Skipping duplicate skill entry for user: {user_data['email']}, Skill: {skill_data['skill']}")
+                continue
+            skills[skill_data['skill']] = skill_data['rating']
+
+        participants.append({
+            "name": user_data['name'],
+            "company": user_data['company'],
+            "email": user_data['email'],
+            "phone": user_data['phone'],
+            "skills": skills,
+        })
+    return participants, skipped
+
+
+def phone_conflicts(participants, existing_users):
+    """
+    Emails of the participants who would end up with a phone number another user keeps.
+    Phone numbers can move between users in one sync (a user changes number and someone else
+    gets their old one), so this looks at the numbers every user has once the sync is done.
+    """
+    phones = {email: row.phone for email, row in existing_users.items()}
+    phones.update((participant['email'], participant['phone']) for participant in participants)
+    rejected = set()
+    while True:
+        owners = defaultdict(list)
+        for email, phone in phones.items():
+            if phone is not None:
+                owners[phone].append(email)
+        conflicts = [emails for emails in owners.values() if len(emails) > 1]
+        if not conflicts:
+            return rejected
+        for emails in conflicts:
+            # A user keeping their current number wins, otherwise existing users before new ones
+            keeper = next(
+                (email for email in emails if email in existing_users and existing_users[email].phone == phones[email]),
+                emails[0]
+            )
+            for email in emails:
+                if email == keeper:
+                    continue
+                rejected.add(email)
+                if email in existing_users:
+                    # Keeps the old number, which may in turn be taken from whoever wanted it
+                    phones[email] = existing_users[email].phone
+                else:
+                    del phones[email]
+
+
+def sync_db():
+    """
+    Incrementally apply HTN_2023_BE_Challenge_Data.json to an existing database.
+
+    Users are matched by email. New users are inserted, changed names, companies, phones and
+    skill ratings are updated, and everything else (check-ins, scans, hardware, skills added
+    through the API) is left alone. Nothing is written if the input matches the database.
+    """
+    counts = {"created": 0, "updated": 0, "unchanged": 0, "skipped": 0}
+    db = SessionLocal()
+    try:
+        participants, counts["skipped"] = load_participants('HTN_2023_BE_Challenge_Data.json')
+
+        # Load the current state with one query per table instead of one per participant
+        existing_users = {
+            row.email: row
+            for row in db.execute(select(User.user_id, User.name, User.company, User.email, User.phone))
+        }
+        rejected = phone_conflicts(participants, existing_users)
+        skill_ids = dict(db.execute(select(Skill.skill_name, Skill.skill_id)).all())
+        user_ratings = defaultdict(dict)
+        for user_id, skill_id, rating in db.execute(select(UserSkill.user_id, UserSkill.skill_id, UserSkill.rating)):
+            user_ratings[user_id][skill_id] = rating
+
+        new_users = []
+        user_updates = []
+        skill_changes = []  # (email, skill_name, rating)
+
+        for participant in participants:
+            email = participant['email']
+            existing = existing_users.get(email)
+
+            # The phone number is unique, so it can't be taken from a different user
+            if email in rejected:
+                logging.warning(f"Skipping user whose phone belongs to another user: {email} / {participant['phone']}")
+                counts["skipped"] += 1
+                continue
+
+            if existing is None:
+                new_users.append({
+                    "name": participant['name'],
+                    "company": participant['company'],
+                    "email": email,
+                    "phone": participant['phone'],
+                    "checked_in": False  # Assume all users are not checked in
+                })
+                skill_changes.extend((email, name, rating) for name, rating in participant['skills'].items())
+                counts["created"] += 1
+                continue
+
+            changed_fields = {
+                key: participant[key]
+                for key in ("name", "company", "phone")
+                if getattr(existing, key) != participant[key]
+            }
+            ratings = user_ratings[existing.user_id]
+            changed_skills = [
+                (email, name, rating)
+                for name, rating in participant['skills'].items()
+                if name not in skill_ids or ratings.get(skill_ids[name]) != rating
+            ]
+
+            if changed_fields:
+                user_updates.append({"user_id": existing.user_id, **changed_fields})
+            skill_changes.extend(changed_skills)
+            if changed_fields or changed_skills:
+                counts["updated"] += 1
+            else:
+                counts["unchanged"] += 1
+
+        if not (new_users or user_updates or skill_changes):
+            logging.info(f"Database already up to date: {counts}")
+            return counts
+
+        # Create skills that don't exist yet, then look up their IDs
+        new_skill_names = sorted({name for _, name, _ in skill_changes if name not in skill_ids})
+        for batch in chunked(new_skill_names):
+            db.execute(insert(Skill), [{"skill_name": name} for name in batch])
+            skill_ids.update(db.execute(select(Skill.skill_name, Skill.skill_id).where(Skill.skill_name.in_(batch))).all())
+
+        # Updates go before inserts, and numbers that change are cleared first, so a number can
+        # be handed to another user (new or existing) in the same sync without breaking uniqueness
+        moved = [user_update['user_id'] for user_update in user_updates if "phone" in user_update]
+        for batch in chunked(moved):
+            db.execute(update(User).where(User.user_id.in_(batch)).values(phone=None))
+        for batch in chunked(user_updates):
+            db.execute(update(User), batch)
+
+        user_ids = {email: row.user_id for email, row in existing_users.items()}
+        for batch in chunked(new_users):
+            db.execute(insert(User), batch)
+            emails = [user['email'] for user in batch]
+            user_ids.update(db.execute(select(User.email, User.user_id).where(User.email.in_(emails))).all())
+
+        upsert = insert(UserSkill)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[UserSkill.user_id, UserSkill.skill_id],
+            set_={"rating": upsert.excluded.rating}
+        )
+        rows = [
+            {"user_id": user_ids[email], "skill_id": skill_ids[name], "rating": rating}
+            for email, name, rating in skill_changes
+        ]
+        for batch in chunked(rows):
+            db.execute(upsert, batch)
+
+        # Tells the app's workers to drop their cached users (see user_cache.py)
+        db.execute(insert(UserChange).values(user_id=None))
+        db.commit()
+        logging.info(f"Sync complete: {counts}")
+        return counts
+
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
 if __name__ == "__main__":
-    init_db()
+    parser = argparse.ArgumentParser(description="Load the challenge data into the database.")
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Apply changes from the challenge data to the existing database instead of rebuilding it"
+    )
+    args = parser.parse_args()
+
+    if args.sync:
+        Base.metadata.create_all(bind=engine)
+        sync_db()
+    else:
+        reset_db_file()
+        Base.metadata.create_all(bind=engine)
+        init_db()
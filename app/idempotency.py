@@ -0,0 +1,275 @@
+"""
+Idempotency-Key support for the write endpoints.
+
+Clients on flaky networks retry check-ins, scans and hardware sign-outs, and a retry of a request
+that already went through either repeats the work or gets a confusing 400 ("User already checked
+in"). A client that sends an Idempotency-Key header with a write gets the response of the first
+request with that key back on every retry instead.
+
+The key is claimed by the request's own write: a before_commit session hook inserts it into the
+IdempotencyKeys table in the same transaction, so it is claimed if and only if the write
+commits, inside the writer slot admission control gave the request. IdempotencyMiddleware stores
+the response's status and body there before the last byte is sent, and answers retries from the
+table before admission control, request validation or the handler run. The table is shared by
+every worker, so a retry that lands on another worker is replayed too.
+
+    first use of a key                  run the request, and store its response if it wrote
+    same key, same request              replay the stored response, with Idempotent-Replayed: true
+    same key, still running             409 Conflict with Retry-After, so the client retries later
+    same key, different request         422, since the key was already used for something else
+
+A request is the method, path, query string and body. A request that didn't commit anything
+(a 404, a validation error, admission control turning it away) doesn't claim the key, so a retry
+runs it again. Once a write has committed, its key is never given up: if its response couldn't be
+stored, retries get a 409 saying so instead of running the write again. Two requests with the same
+key that both got past the lookup race for the claim, and the loser's transaction is rolled back
+with a 409. Keys expire after SQL_APP_IDEMPOTENCY_TTL seconds (a day by default).
+"""
+import datetime
+import hashlib
+import json
+import os
+import time
+from contextvars import ContextVar
+
+from fastapi import HTTPException
+from sqlalchemy import delete, event, select, update
+from sqlalchemy.dialects.sqlite import insert
+from starlette.concurrency import run_in_threadpool
+
+from . import database, metrics, models
+
+IDEMPOTENCY_TTL = float(os.environ.get("SQL_APP_IDEMPOTENCY_TTL", str(24 * 60 * 60)))
+# A key claimed longer ago than this without a stored response lost its response
+IN_FLIGHT_TIMEOUT = 60.0
+# Expired keys are deleted at most this often per worker
+PURGE_INTERVAL = 60.0
+
+MAX_KEY_LENGTH = 255
+MUTATING_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
+CLAIMED, REPLAY, IN_FLIGHT, MISMATCH, NO_WRITE = "claimed", "replay", "in_flight", "mismatch", "no_write"
+
+idempotent_requests = metrics.CounterFamily(
+    "idempotent_requests_total", "Write requests sent with an Idempotency-Key, by outcome.", ("result",)
+)
+metrics.register_collector(idempotent_requests.render)
+
+
+class IdempotencyStore:
+    """
+    Keys and stored responses in the IdempotencyKeys table. lookup and complete run their own
+    short transactions, so call them from a threadpool. claim runs in the write's transaction.
+    """
+    def __init__(self, ttl=IDEMPOTENCY_TTL, in_flight_timeout=IN_FLIGHT_TIMEOUT):
+        self.ttl = ttl
+        self.in_flight_timeout = in_flight_timeout
+        self.last_purge = 0.0
+
+    def lookup(self, key):
+        """
+        The row of a key that is in use, or None.
+        """
+        table = models.IdempotencyKey
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.ttl)
+        with database.get_engine().connect() as connection:
+            return connection.execute(
+                select(table.fingerprint, table.status_code, table.content_type, table.body, table.created_at)
+                .where(table.key == key, table.created_at >= cutoff)
+            ).one_or_none()
+
+    def claim(self, connection, key, fingerprint):
+        """
+        Claim the key in the connection's transaction. False if another request already has it.
+        """
+        now = datetime.datetime.utcnow()
+        table = models.IdempotencyKey
+        self.purge(connection, now)
+        statement = insert(table).values(key=key, fingerprint=fingerprint, created_at=now)
+        # An expired key (not purged yet) can be claimed again
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.key],
+            set_={"fingerprint": fingerprint, "status_code": None, "content_type": None, "body": None, "created_at": now},
+            where=table.created_at < now - datetime.timedelta(seconds=self.ttl)
+        )
+        return connection.execute(statement).rowcount == 1
+
+    def complete(self, key, status_code, content_type, body):
+        table = models.IdempotencyKey
+        with database.get_engine().begin() as connection:
+            connection.execute(
+                update(table).where(table.key == key)
+                .values(status_code=status_code, content_type=content_type, body=body)
+            )
+
+    def is_lost(self, row):
+        """
+        Whether a claimed key's response will never be stored, because storing it failed.
+        """
+        return row.created_at < datetime.datetime.utcnow() - datetime.timedelta(seconds=self.in_flight_timeout)
+
+    def purge(self, connection, now):
+        if time.monotonic() - self.last_purge < PURGE_INTERVAL:
+            return
+        self.last_purge = time.monotonic()
+        cutoff = now - datetime.timedelta(seconds=self.ttl)
+        connection.execute(delete(models.IdempotencyKey).where(models.IdempotencyKey.created_at < cutoff))
+
+
+store = IdempotencyStore()
+
+
+class PendingKey:
+    """
+    The key of the request being handled, shared with the threadpool threads that run it.
+    """
+    def __init__(self, key, fingerprint, store):
+        self.key = key
+        self.fingerprint = fingerprint
+        self.store = store
+        self.claimed = False
+
+
+_pending_key: ContextVar = ContextVar("idempotency_key", default=None)
+
+
+def _before_commit(session):
+    pending = _pending_key.get()
+    if pending is None or pending.claimed:
+        return
+    if not pending.store.claim(session.connection(), pending.key, pending.fingerprint):
+        # Raised inside commit, so the write is rolled back with it
+        raise HTTPException(
+            status_code=409,
+            detail="A request with this Idempotency-Key is still being processed",
+            headers={"Retry-After": "1"}
+        )
+    pending.claimed = True
+
+
+def instrument(session_factory):
+    """
+    Claim the key of the current request in the transaction of its write, for sessions from session_factory.
+    """
+    event.listen(session_factory, "before_commit", _before_commit)
+
+
+def request_fingerprint(scope, body):
+    digest = hashlib.sha256()
+    for part in (scope["method"].encode(), scope["path"].encode(), scope.get("query_string", b""), body):
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def header(scope, name):
+    for header_name, value in scope["headers"]:
+        if header_name == name:
+            return value.decode("latin-1")
+    return None
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            # The client disconnected before sending the whole body
+            return None
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+async def send_response(send, status_code, body, content_type="application/json", extra_headers=()):
+    headers = [(b"content-type", content_type.encode("latin-1")), (b"content-length", str(len(body)).encode())]
+    headers.extend(extra_headers)
+    await send({"type": "http.response.start", "status": status_code, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_error(send, status_code, detail, extra_headers=()):
+    await send_response(send, status_code, json.dumps({"detail": detail}).encode(), extra_headers=extra_headers)
+
+
+class IdempotencyMiddleware:
+    """
+    Plain ASGI middleware, added last so it runs before everything else and replays skip the rest
+    of the app.
+    """
+    def __init__(self, app, store=store):
+        self.app = app
+        self.store = store
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in MUTATING_METHODS:
+            await self.app(scope, receive, send)
+            return
+        key = header(scope, b"idempotency-key")
+        if key is None:
+            await self.app(scope, receive, send)
+            return
+        if not key or len(key) > MAX_KEY_LENGTH:
+            await send_error(send, 400, f"Idempotency-Key must be between 1 and {MAX_KEY_LENGTH} characters")
+            return
+
+        body = await read_body(receive)
+        if body is None:
+            return
+        fingerprint = request_fingerprint(scope, body)
+        row = await run_in_threadpool(self.store.lookup, key)
+        if row is not None:
+            await self.answer_from_store(send, row, fingerprint)
+            return
+
+        await self.run(scope, receive, send, PendingKey(key, fingerprint, self.store), body)
+
+    async def answer_from_store(self, send, row, fingerprint):
+        if row.fingerprint != fingerprint:
+            idempotent_requests.inc(MISMATCH)
+            await send_error(send, 422, "This Idempotency-Key was already used for a different request")
+        elif row.status_code is not None:
+            idempotent_requests.inc(REPLAY)
+            await send_response(send, row.status_code, row.body or b"", row.content_type or "application/json", [(b"idempotent-replayed", b"true")])
+        elif self.store.is_lost(row):
+            # The write went through, so running it again is exactly what the key is there to prevent
+            idempotent_requests.inc(IN_FLIGHT)
+            await send_error(send, 409, "A request with this Idempotency-Key was already processed, but its response was not stored")
+        else:
+            idempotent_requests.inc(IN_FLIGHT)
+            await send_error(send, 409, "A request with this Idempotency-Key is still being processed", [(b"retry-after", b"1")])
+
+    async def run(self, scope, receive, send, pending, body):
+        body_sent = False
+
+        # The app reads the body we already consumed, then anything else (a disconnect) as usual
+        async def replay_receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        status_code = None
+        content_type = None
+        chunks = []
+
+        async def send_and_store(message):
+            nonlocal status_code, content_type
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                content_type = dict(message.get("headers", [])).get(b"content-type", b"").decode("latin-1") or None
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+                # Store the response before the client can see all of it, so a retry sent as soon
+                # as the response arrives is already replayed
+                if not message.get("more_body", False) and pending.claimed:
+                    await run_in_threadpool(self.store.complete, pending.key, status_code, content_type, b"".join(chunks))
+            await send(message)
+
+        token = _pending_key.set(pending)
+        try:
+            await self.app(scope, replay_receive, send_and_store)
+        finally:
+            _pending_key.reset(token)
+            idempotent_requests.inc(CLAIMED if pending.claimed else NO_WRITE)
@@ -1,61 +1,177 @@
+from contextlib import asynccontextmanager
+from datetime import datetime
 from fastapi import FastAPI, Depends, HTTPException, Query
-from sqlalchemy import func
+from fastapi.responses import PlainTextResponse, Response
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import func, insert
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from .database import get_db  # Make sure this import matches your project structure
-from . import schemas, models  # Adjust imports as necessary
-
-app = FastAPI()
-
-@app.get("/users/", response_model=List[schemas.User])
-def read_users(skip: int = 0, limit: int = 100, checked_in_only: bool = False, db: Session = Depends(get_db)):
+from . import database
+from . import analytics, idempotency, matching, metrics, pipeline, schemas, models, queries, query_budget, scan_rollups  # Adjust imports as necessary
+from .profiler import ProfiledRoute, profiler, require_admin, MAX_DURATION_SECONDS
+from .query_budget import query_budget as budget
+from .coalesce import coalesce
+from .admission import admit
+from .responses import dump_json, json_response, type_adapter
+from .user_cache import user_cache
+
+# Response types of the busiest routes, whose serializers are compiled on startup
+WARM_RESPONSE_TYPES = [
+    schemas.UserPayload,
+    schemas.PartialUserPayload,
+    List[schemas.PartialUserPayload],
+    schemas.HackerDashboardPayload,
+]
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Engine, schema check, warm-up and preloading (see database.py), off the event loop
+    await run_in_threadpool(database.startup)
+    if database.WARMUP_ENABLED:
+        for type_ in WARM_RESPONSE_TYPES:
+            type_adapter(type_)
+    yield
+    # Finish the derived-data work that is due before the worker exits (see pipeline.py)
+    await run_in_threadpool(pipeline.worker.stop)
+
+
+app = FastAPI(lifespan=lifespan)
+# Every route can be profiled on demand through /admin/profiler (see profiler.py)
+app.router.route_class = ProfiledRoute
+app.add_middleware(metrics.MetricsMiddleware)
+if query_budget.QUERY_BUDGET_MODE != "off" or query_budget.DEBUG:
+    app.add_middleware(query_budget.QueryBudgetMiddleware)
+# Added last so it runs first: retries with an Idempotency-Key are answered before anything else
+app.add_middleware(idempotency.IdempotencyMiddleware)
+
+# Maximum number of ids accepted by GET /users/batch
+MAX_BATCH_IDS = 5000
+BATCH_CHUNKS = -(-MAX_BATCH_IDS // queries.BATCH_CHUNK_SIZE)
+
+# Maximum number of teammates returned by GET /users/{user_id}/matches
+MAX_MATCHES = 100
+
+# Maximum number of buckets returned by GET /analytics/scans
+MAX_SCAN_BUCKETS = 10000
+
+FIELDS_DESCRIPTION = "Comma separated list of user fields to return (name, company, email, phone, checked_in, skills)"
+EXPAND_DESCRIPTION = "Comma separated list of related data to include. Only skills is supported"
+
+
+def parse_fieldset(fields: Optional[str], expand: Optional[str], skills_by_default: bool):
+    """
+    Turn the ?fields= and ?expand= query parameters into the user fields to select and whether
+    to load skills. Without either parameter every field is returned.
+    """
+    expansions = {name.strip() for name in expand.split(",") if name.strip()} if expand else set()
+    unknown_expansions = expansions - {"skills"}
+    if unknown_expansions:
+        raise HTTPException(status_code=400, detail=f"Unknown expand value(s): {', '.join(sorted(unknown_expansions))}. Only skills can be expanded")
+
+    if fields is None:
+        return queries.USER_FIELDS, skills_by_default or "skills" in expansions
+
+    requested = [name.strip() for name in fields.split(",") if name.strip()]
+    if not requested:
+        raise HTTPException(status_code=400, detail="fields must name at least one field")
+    unknown_fields = set(requested) - set(queries.USER_FIELDS) - {"skills"}
+    if unknown_fields:
+        raise HTTPException(status_code=400, detail=f"Unknown field(s): {', '.join(sorted(unknown_fields))}")
+
+    selected = tuple(field for field in queries.USER_FIELDS if field in requested)
+    return selected, "skills" in requested or "skills" in expansions
+
+
+@app.get("/users/", response_model=List[schemas.PartialUserPayload])
+@budget(max_queries=2)
+def read_users(
+    skip: int = 0,
+    limit: int = 100,
+    checked_in_only: bool = False,
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+    expand: Optional[str] = Query(None, description=EXPAND_DESCRIPTION),
+    db: Session = Depends(get_db)
+):
     if skip < 0 or limit < 0:
         raise HTTPException(status_code=400, detail="Skip and limit query parameters must be non-negative")
-    
-    if checked_in_only:
-        users = db.query(models.User).filter(models.User.checked_in == True).offset(skip).limit(limit).all()
-    else:
-        users = db.query(models.User).offset(skip).limit(limit).all()
-
-    result = []
-    for user in users:
-        skills = [
-            {"skill": user_skill.skill.skill_name, "rating": user_skill.rating}
-            for user_skill in user.skills  # Assuming 'skills' is properly set up as a relationship on the User model
-        ]
-        user_dict = {
-            "name": user.name,
-            "company": user.company,
-            "email": user.email,
-            "phone": user.phone,
-            "checked_in": user.checked_in,
-            "skills": skills
-        }
-        result.append(schemas.User(**user_dict))  # Ensure this matches your schema class name exactly
-    return result
-
-@app.get("/users/{user_id}", response_model=schemas.User)
-def read_user_by_id(user_id: int, db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.user_id == user_id).first()
+    selected_fields, include_skills = parse_fieldset(fields, expand, skills_by_default=True)
+
+    # Rows come straight from our own tables, so serialize them without validating them again
+    users = queries.load_users(
+        db,
+        checked_in_only=checked_in_only,
+        skip=skip,
+        limit=limit,
+        fields=selected_fields,
+        include_skills=include_skills
+    )
+    return json_response(List[schemas.PartialUserPayload], users)
+
+# Declared before /users/{user_id} so "batch" isn't parsed as a user id
+@app.get("/users/batch", response_model=List[schemas.BatchUserResult])
+@budget(max_queries=2 * BATCH_CHUNKS, max_repeats=BATCH_CHUNKS)
+def read_users_batch(
+    ids: str = Query(..., description=f"Comma separated list of up to {MAX_BATCH_IDS} user ids"),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+    expand: Optional[str] = Query(None, description=EXPAND_DESCRIPTION),
+    db: Session = Depends(get_db)
+):
+    try:
+        user_ids = [int(user_id) for user_id in ids.split(",") if user_id.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be a comma separated list of integers")
+    if not user_ids:
+        raise HTTPException(status_code=400, detail="At least one user id is required")
+    if len(user_ids) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_IDS} user ids can be requested at once")
+    selected_fields, include_skills = parse_fieldset(fields, expand, skills_by_default=True)
+
+    users = queries.load_users_by_id(db, user_ids, fields=selected_fields, include_skills=include_skills)
+
+    # Results follow the order of the request, and missing users are reported in place
+    results = []
+    for user_id in user_ids:
+        user = users.get(user_id)
+        results.append({
+            "user_id": user_id,
+            "user": user,
+            "detail": None if user is not None else f"User with id {user_id} not found",
+        })
+    return json_response(List[schemas.BatchUserResultPayload], results)
+
+@app.get("/users/{user_id}", response_model=schemas.PartialUserPayload)
+@budget(max_queries=2)
+def read_user_by_id(
+    user_id: int,
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+    expand: Optional[str] = Query(None, description=EXPAND_DESCRIPTION),
+    db: Session = Depends(get_db)
+):
+    if fields is None and expand is None:
+        # Full profiles are served from the user cache (see user_cache.py)
+        def load():
+            user = queries.load_user(db, user_id)
+            return dump_json(schemas.UserPayload, user) if user is not None else None
+
+        payload = user_cache.get_or_load(user_id, load)
+        if payload is None:
+            raise HTTPException(status_code=404, detail=f"User with id {user_id} not found")
+        return Response(content=payload, media_type="application/json")
+
+    selected_fields, include_skills = parse_fieldset(fields, expand, skills_by_default=True)
+    user = queries.load_user(db, user_id, fields=selected_fields, include_skills=include_skills)
     if user is None:
         raise HTTPException(status_code=404, detail=f"User with id {user_id} not found")
-    # Fetch skills through the UserSkill association and then access the Skill model
-    skills = [
-        {"skill": user_skill.skill.skill_name, "rating": user_skill.rating}
-        for user_skill in user.skills
-    ]
-    user_dict = {
-        "name": user.name,
-        "company": user.company,
-        "email": user.email,
-        "phone": user.phone,
-        "checked_in": user.checked_in,
-        "skills": skills
-    }
-    return schemas.User(**user_dict)
+    return json_response(schemas.PartialUserPayload, user)
 
 
-@app.put("/users/{user_id}", response_model=schemas.User)
+@app.put("/users/{user_id}", response_model=schemas.User, dependencies=[Depends(admit("update_user"))])
+# Includes the 2 queries analytics.py runs per flush to keep its rollup up to date, up to 2 for
+# claiming an Idempotency-Key with the write (see idempotency.py), and 1 to log the change for
+# the other workers' user caches (see user_cache.py)
+@budget(max_queries=15)
 def update_user(user_id: int, user_update: schemas.UserUpdate, db: Session = Depends(get_db)):
     user = db.query(models.User).filter(models.User.user_id == user_id).first()
     if user is None:
@@ -66,63 +182,89 @@ def update_user(user_id: int, user_update: schemas.UserUpdate, db: Session = Dep
     for key, value in update_data.items():
         setattr(user, key, value)
 
-    # Initialize a set to keep track of processed skills
-    processed_skills = set()
-
     # Handle skill updates
     if user_update.skills is not None:
+        # Keep the first update of each skill and ignore duplicates
+        skill_updates = {}
         for skill_data in user_update.skills:
-            # Skip if we've already processed an update for this skill
-            if skill_data.skill in processed_skills:
+            if skill_data.skill in skill_updates:
                 continue  # Skip this skill update
-            
-            # Add the skill to the set of processed skills
-            processed_skills.add(skill_data.skill)
-            
+
             # Validate the rating is between 1 and 5
             if not (1 <= skill_data.rating <= 5):
                 raise HTTPException(status_code=400, detail=f"Invalid rating for skill: {skill_data.skill}. Rating must be between 1 and 5.")
+            skill_updates[skill_data.skill] = skill_data.rating
 
-
-            # Proceed with finding or creating the skill, and updating the rating as before
-            skill = db.query(models.Skill).filter_by(skill_name=skill_data.skill).first()
-            if not skill:
-                skill = models.Skill(skill_name=skill_data.skill)
-                db.add(skill)
-                db.flush()  # To get the new skill ID
-            
-            user_skill = db.query(models.UserSkill).filter_by(user_id=user.user_id, skill_id=skill.skill_id).first()
-            if user_skill:
-                user_skill.rating = skill_data.rating
-            else:
-                db.add(models.UserSkill(user_id=user.user_id, skill_id=skill.skill_id, rating=skill_data.rating))
+        if skill_updates:
+            # Find or create all of the skills at once, rather than one query per skill
+            skills = {
+                skill.skill_name: skill
+                for skill in db.query(models.Skill).filter(models.Skill.skill_name.in_(skill_updates))
+            }
+            new_skill_names = [skill_name for skill_name in skill_updates if skill_name not in skills]
+            if new_skill_names:
+                # Insert the new skills in one statement, then load them to get their IDs
+                db.execute(insert(models.Skill), [{"skill_name": skill_name} for skill_name in new_skill_names])
+                skills.update(
+                    (skill.skill_name, skill)
+                    for skill in db.query(models.Skill).filter(models.Skill.skill_name.in_(new_skill_names))
+                )
+
+            user_skills = {
+                user_skill.skill_id: user_skill
+                for user_skill in db.query(models.UserSkill).filter(
+                    models.UserSkill.user_id == user.user_id,
+                    models.UserSkill.skill_id.in_([skill.skill_id for skill in skills.values()])
+                )
+            }
+            for skill_name, rating in skill_updates.items():
+                skill_id = skills[skill_name].skill_id
+                if skill_id in user_skills:
+                    user_skills[skill_id].rating = rating
+                else:
+                    db.add(models.UserSkill(user_id=user.user_id, skill_id=skill_id, rating=rating))
 
     db.commit()
-    db.refresh(user)
-
 
     # Reconstruct the response with the updated skills
-    skills = [
-        {
-            "skill": user_skill.skill.skill_name,
-            "rating": user_skill.rating
-        }
-        for user_skill in user.skills
-    ]
-
-    user_dict = {
-        "name": user.name,
-        "company": user.company,
-        "email": user.email,
-        "phone": user.phone,
-        "checked_in": user.checked_in,
-        "skills": skills
-    }
+    return json_response(schemas.UserPayload, queries.load_user(db, user_id))
+
+
+@app.get("/users/{user_id}/matches", response_model=List[schemas.Match])
+# The first request builds the skill matrix (see matching.py), which takes 5 queries
+@budget(max_queries=7)
+def read_user_matches(
+    user_id: int,
+    limit: int = Query(20, description=f"Number of teammates to return, at most {MAX_MATCHES}"),
+    mode: str = Query("complement", description="complement ranks hackers by the skills they add, similar by how alike their skills are"),
+    checked_in_only: bool = True,
+    db: Session = Depends(get_db)
+):
+    if mode not in matching.MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of: {', '.join(matching.MODES)}")
+    if not 1 <= limit <= MAX_MATCHES:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_MATCHES}")
+
+    # Scored over the in-memory skill matrix in matching.py, which is only built on first use
+    matches = matching.matrix.read(
+        lambda skill_matrix: skill_matrix.matches(user_id, limit, mode=mode, checked_in_only=checked_in_only),
+        db.connection()
+    )
+    if matches is None:
+        raise HTTPException(status_code=404, detail=f"User with id {user_id} not found")
 
-    return schemas.User(**user_dict)
+    users = queries.load_users_by_id(db, [match_id for match_id, _ in matches], fields=("name", "company"))
+    results = [
+        {"user_id": match_id, "score": score, "user": users[match_id]}
+        for match_id, score in matches
+        if match_id in users
+    ]
+    return json_response(List[schemas.MatchPayload], results)
 
 
 @app.get("/skills/", response_model=List[schemas.SkillFrequency])
+@budget(max_queries=1)
+@coalesce()  # Dashboards poll this all at once, so identical requests share one query
 def read_skill_frequencies(min_frequency: Optional[int] = Query(None), max_frequency: Optional[int] = Query(None), db: Session = Depends(get_db)):
     if min_frequency is not None and max_frequency is not None and min_frequency > max_frequency:
         raise HTTPException(status_code=400, detail="min_frequency must be less than or equal to max_frequency")
@@ -149,7 +291,12 @@ def read_skill_frequencies(min_frequency: Optional[int] = Query(None), max_frequ
     return [{"skill_name": skill.skill_name, "frequency": skill.frequency} for skill in skills]
 
 
-@app.put("/users/{user_id}/checkin", response_model=schemas.User)
+@app.put("/users/{user_id}/checkin", response_model=schemas.User, dependencies=[Depends(admit("checkin"))])
+# Includes the 2 queries analytics.py runs per flush to keep its rollup up to date, and the
+# outbox insert that gets the check-in counted into its buckets (see scan_rollups.py), up to 2
+# for claiming an Idempotency-Key with the write (see idempotency.py), and 1 to log the change
+# for the other workers' user caches (see user_cache.py)
+@budget(max_queries=10)
 def checkin_user(user_id: int, db: Session = Depends(get_db)):
     user = db.query(models.User).filter(models.User.user_id == user_id).first()
     if not user:
@@ -160,28 +307,13 @@ def checkin_user(user_id: int, db: Session = Depends(get_db)):
     
     user.checked_in = True
     db.commit()
-    db.refresh(user)
     # Reconstruct the response with the updated skills
-    skills = [
-        {
-            "skill": user_skill.skill.skill_name,
-            "rating": user_skill.rating
-        }
-        for user_skill in user.skills
-    ]
-
-    user_dict = {
-        "name": user.name,
-        "company": user.company,
-        "email": user.email,
-        "phone": user.phone,
-        "checked_in": user.checked_in,
-        "skills": skills
-    }
+    return json_response(schemas.UserPayload, queries.load_user(db, user_id))
 
-    return schemas.User(**user_dict)
-
-@app.post("/scan/")
+@app.post("/scan/", dependencies=[Depends(admit("scan"))])
+# Includes the outbox insert that gets the scan counted into its buckets (see scan_rollups.py),
+# and up to 2 for claiming an Idempotency-Key with the write (see idempotency.py)
+@budget(max_queries=7)
 def scan_user(user_id: int, event_id: int, db: Session = Depends(get_db)):
     # Check if the event exists
     event = db.query(models.Event).filter(models.Event.event_id == event_id).first()
@@ -209,6 +341,7 @@ def scan_user(user_id: int, event_id: int, db: Session = Depends(get_db)):
 
 
 @app.get("/users/{user_id}/events/", response_model=List[schemas.Event])
+@budget(max_queries=3)
 def get_user_events(user_id: int, db: Session = Depends(get_db)):
     # Check if the user_id exists
     user = db.query(models.User).filter(models.User.user_id == user_id).first()
@@ -220,7 +353,9 @@ def get_user_events(user_id: int, db: Session = Depends(get_db)):
     events = db.query(models.Event).filter(models.Event.event_id.in_(event_ids)).all()
     return events
 
-@app.post("/hardware/{hardware_id}/signout")
+@app.post("/hardware/{hardware_id}/signout", dependencies=[Depends(admit("hardware"))])
+# Includes up to 2 queries for claiming an Idempotency-Key with the write (see idempotency.py)
+@budget(max_queries=7)
 def sign_out_hardware(hardware_id: int, user_id: int, db: Session = Depends(get_db)):
     hardware = db.query(models.Hardware).filter(models.Hardware.hardware_id == hardware_id).first()
     user = db.query(models.User).filter(models.User.user_id == user_id).first()
@@ -237,7 +372,9 @@ def sign_out_hardware(hardware_id: int, user_id: int, db: Session = Depends(get_
     return {"message": f"Hardware {hardware.name} signed out by user {user_id} ({user.name})"}
 
 
-@app.post("/hardware/{hardware_id}/return")
+@app.post("/hardware/{hardware_id}/return", dependencies=[Depends(admit("hardware"))])
+# Includes up to 2 queries for claiming an Idempotency-Key with the write (see idempotency.py)
+@budget(max_queries=7)
 def return_hardware(hardware_id: int, db: Session = Depends(get_db)):
     hardware = db.query(models.Hardware).filter(models.Hardware.hardware_id == hardware_id).first()
     if not hardware:
@@ -257,40 +394,159 @@ def return_hardware(hardware_id: int, db: Session = Depends(get_db)):
 
 
 @app.get("/hacker/{user_id}/dashboard", response_model=schemas.HackerDashboard)
-def get_hacker_dashboard(user_id: int, db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.user_id == user_id).first()
-    if not user:
+@budget(max_queries=4)
+def get_hacker_dashboard(
+    user_id: int,
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+    expand: Optional[str] = Query(None, description=EXPAND_DESCRIPTION),
+    db: Session = Depends(get_db)
+):
+    # user_info doesn't include skills unless they are asked for
+    selected_fields, include_skills = parse_fieldset(fields, expand, skills_by_default=False)
+    user_info = queries.load_user(db, user_id, fields=selected_fields, include_skills=include_skills)
+    if user_info is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    signed_out_hardware = db.query(models.Hardware).filter(models.Hardware.signed_out_by_user_id == user_id).all()
-    checked_in_events = db.query(models.ScanEvent).filter(models.ScanEvent.user_id == user_id).all()
-
     dashboard_info = {
-        "user_info": {
-            "name": user.name,
-            "email": user.email,
-            "phone": user.phone,
-            "company": user.company,  # Make sure this field is included
-            "checked_in": user.checked_in,  # Make sure this field is included
-            "skills": [
-                {"skill": skill.skill.skill_name, "rating": skill.rating}
-                for skill in user.skills
-            ],
-        },
-        "signed_out_hardware": [
-            {"name": hardware.name, "serial_number": hardware.serial_number}
-            for hardware in signed_out_hardware
-        ],
-        "checked_in_events": [
-            {
-                "name": event.event.name,
-                "description": event.event.description,  # Make sure this field is included
-                "start_time": event.event.start_time.isoformat(),
-                "end_time": event.event.end_time.isoformat(),
-                "location": event.event.location,  # Make sure this field is included
-            }
-            for event in checked_in_events
-        ],
+        "user_info": user_info,
+        "signed_out_hardware": queries.load_signed_out_hardware(db, user_id),
+        "checked_in_events": queries.load_scanned_events(db, user_id),
     }
 
-    return dashboard_info
+    return json_response(schemas.HackerDashboardPayload, dashboard_info)
+
+
+@app.get("/analytics/companies", response_model=List[schemas.CompanySummary])
+@budget(max_queries=4)
+@coalesce()
+def read_company_analytics(limit: int = 100, top_skills: int = 3, min_headcount: int = 1, db: Session = Depends(get_db)):
+    if limit < 0 or top_skills < 0:
+        raise HTTPException(status_code=400, detail="limit and top_skills must be non-negative")
+
+    # Served from the in-memory rollup in analytics.py, which is only built on first use
+    payload = analytics.rollup.payload(
+        ("companies", limit, top_skills, min_headcount),
+        lambda rollup: dump_json(
+            List[schemas.CompanySummaryPayload],
+            analytics.company_summaries(rollup, limit=limit, top_skills=top_skills, min_headcount=min_headcount)
+        ),
+        db.connection()
+    )
+    return Response(content=payload, media_type="application/json")
+
+
+@app.get("/analytics/skills/ratings", response_model=List[schemas.SkillRatings])
+@budget(max_queries=4)
+@coalesce()
+def read_skill_rating_analytics(db: Session = Depends(get_db)):
+    payload = analytics.rollup.payload(
+        ("skill_ratings",),
+        lambda rollup: dump_json(List[schemas.SkillRatingsPayload], analytics.skill_rating_histograms(rollup)),
+        db.connection()
+    )
+    return Response(content=payload, media_type="application/json")
+
+
+@app.get("/analytics/scans", response_model=List[schemas.ScanBucket])
+@budget(max_queries=2)
+@coalesce()
+def read_scan_analytics(
+    event_id: Optional[int] = None,
+    location: Optional[str] = None,
+    start: Optional[datetime] = Query(None, alias="from", description="Start of the range (inclusive)"),
+    end: Optional[datetime] = Query(None, alias="to", description="End of the range (exclusive)"),
+    bucket: str = Query("minute", description="Bucket size, minute or hour"),
+    db: Session = Depends(get_db)
+):
+    if bucket not in scan_rollups.GRANULARITIES:
+        raise HTTPException(status_code=400, detail=f"bucket must be one of: {', '.join(scan_rollups.GRANULARITIES)}")
+
+    # Read from the pre-aggregated buckets in scan_rollups.py, never from ScanEvents
+    buckets = scan_rollups.scan_counts(
+        db.connection(), bucket, scan_rollups.to_utc(start), scan_rollups.to_utc(end),
+        event_id=event_id, location=location, limit=MAX_SCAN_BUCKETS + 1
+    )
+    if len(buckets) > MAX_SCAN_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"More than {MAX_SCAN_BUCKETS} buckets match, narrow the range or use bigger buckets")
+    return json_response(List[schemas.ScanBucketPayload], buckets)
+
+
+@app.get("/analytics/checkins", response_model=List[schemas.CheckinBucket])
+@budget(max_queries=3)
+@coalesce()
+def read_checkin_analytics(
+    start: Optional[datetime] = Query(None, alias="from", description="Start of the range (inclusive)"),
+    end: Optional[datetime] = Query(None, alias="to", description="End of the range (exclusive)"),
+    bucket: str = Query("minute", description="Bucket size, minute or hour"),
+    db: Session = Depends(get_db)
+):
+    if bucket not in scan_rollups.GRANULARITIES:
+        raise HTTPException(status_code=400, detail=f"bucket must be one of: {', '.join(scan_rollups.GRANULARITIES)}")
+
+    curve = scan_rollups.checkin_curve(db.connection(), bucket, scan_rollups.to_utc(start), scan_rollups.to_utc(end))
+    return json_response(List[schemas.CheckinBucketPayload], curve)
+
+
+# Metrics are updated from request, worker and rebuild threads under their own locks (see
+# metrics.py). Rendering them never touches the database, so it runs on the event loop.
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def read_metrics():
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.post("/admin/profiler", dependencies=[Depends(require_admin)], include_in_schema=False)
+async def start_profiler(settings: schemas.ProfilerStart):
+    if not 0 < settings.sample_rate <= 1:
+        raise HTTPException(status_code=400, detail="sample_rate must be greater than 0 and at most 1")
+    if not 0 < settings.duration_seconds <= MAX_DURATION_SECONDS:
+        raise HTTPException(status_code=400, detail=f"duration_seconds must be greater than 0 and at most {MAX_DURATION_SECONDS}")
+    if settings.interval_ms <= 0:
+        raise HTTPException(status_code=400, detail="interval_ms must be positive")
+    known_routes = {route.path for route in app.routes if isinstance(route, ProfiledRoute)}
+    unknown_routes = set(settings.routes) - known_routes
+    if unknown_routes:
+        raise HTTPException(status_code=400, detail=f"Unknown route(s): {', '.join(sorted(unknown_routes))}")
+
+    profiler.start(
+        settings.routes,
+        sample_rate=settings.sample_rate,
+        duration_seconds=settings.duration_seconds,
+        mode=settings.mode,
+        interval_ms=settings.interval_ms
+    )
+    return profiler.status()
+
+
+@app.get("/admin/profiler", dependencies=[Depends(require_admin)], include_in_schema=False)
+async def read_profiler_status():
+    return profiler.status()
+
+
+@app.delete("/admin/profiler", dependencies=[Depends(require_admin)], include_in_schema=False)
+async def stop_profiler():
+    profiler.stop()
+    return profiler.status()
+
+
+@app.get("/admin/profiler/results", dependencies=[Depends(require_admin)], include_in_schema=False)
+async def read_profiler_results(route: Optional[str] = None, format: str = "collapsed"):
+    """
+    Results of the last profiling window. format=collapsed returns the sampled stacks (of one
+    route, or all of them) for flamegraph.pl; format=pstats returns the cProfile stats of a route
+    as a file that pstats.Stats can load.
+    """
+    if format == "collapsed":
+        return PlainTextResponse(profiler.collapsed(route))
+    if format == "pstats":
+        if route is None:
+            raise HTTPException(status_code=400, detail="route is required for pstats results")
+        dump = profiler.pstats_dump(route)
+        if dump is None:
+            raise HTTPException(status_code=404, detail="No cProfile results for this route")
+        filename = "".join(char if char.isalnum() else "_" for char in route).strip("_") or "root"
+        return Response(
+            dump,
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.pstats"'}
+        )
+    raise HTTPException(status_code=400, detail="format must be collapsed or pstats")
@@ -0,0 +1,159 @@
+"""
+Teammate matching over a dense user-by-skill rating matrix.
+
+Ratings are kept in a numpy uint8 matrix with one row per skill and one column per user (so the
+ratings of one skill are contiguous), next to per-user arrays of rating totals, squared norms and
+check-in flags. The matrix is an incremental view (see user_changes.py): it is built on first use
+and the columns of users changed by update_user or check-ins are rewritten after commit.
+
+Scoring only reads the rows of the skills the hacker has, whatever the number of skills overall:
+
+    complement  how many rating points a candidate adds on top of the hacker's own ratings,
+                sum(max(candidate - mine, 0)) = candidate's total - sum(min(candidate, mine))
+                over the hacker's skills
+    similar     cosine similarity of the rating vectors
+
+The best k candidates are picked with np.partition instead of sorting everyone. At 100k users the
+matrix takes 100k bytes per skill.
+
+numpy is imported by the methods that use it rather than at the top, since importing it takes
+longer than importing the rest of the app's own modules, and workers that never match anyone
+don't need it.
+"""
+import itertools
+import os
+
+from sqlalchemy import func, select
+
+from . import models, user_changes
+
+MATCHING_MAX_AGE = float(os.environ.get("SQL_APP_MATCHING_MAX_AGE", "0"))
+
+MODES = ("complement", "similar")
+
+
+class SkillMatrix:
+    def __init__(self, users, skills):
+        import numpy as np
+        self.ratings = np.zeros((skills, users), dtype=np.uint8)
+        self.totals = np.zeros(users, dtype=np.int32)
+        self.squares = np.zeros(users, dtype=np.int32)
+        self.checked_in = np.zeros(users, dtype=bool)
+        self.exists = np.zeros(users, dtype=bool)
+
+    @classmethod
+    def build(cls, connection):
+        import numpy as np
+        max_user_id = connection.execute(select(models.User.user_id).order_by(models.User.user_id.desc()).limit(1)).scalar() or 0
+        max_skill_id = connection.execute(select(models.Skill.skill_id).order_by(models.Skill.skill_id.desc()).limit(1)).scalar() or 0
+        # Columns and rows are indexed by id directly, with room to grow
+        matrix = cls(users=grown(max_user_id + 1), skills=grown(max_skill_id + 1))
+
+        users = int_array(connection.execute(select(models.User.user_id, func.coalesce(models.User.checked_in, False))), 2)
+        matrix.exists[users[:, 0]] = True
+        matrix.checked_in[users[:, 0]] = users[:, 1].astype(bool)
+
+        skills = int_array(connection.execute(select(models.UserSkill.skill_id, models.UserSkill.user_id, models.UserSkill.rating)), 3)
+        matrix.ratings[skills[:, 0], skills[:, 1]] = skills[:, 2]
+        np.add.at(matrix.totals, skills[:, 1], skills[:, 2])
+        np.add.at(matrix.squares, skills[:, 1], skills[:, 2] ** 2)
+        return matrix
+
+    def apply(self, before, after):
+        """
+        Rewrite the columns of the changed users from their after images.
+        """
+        for user_id in before.keys() - after.keys():
+            if user_id < self.exists.size:
+                self.clear(user_id)
+        for user_id, (company, checked_in, skills) in after.items():
+            max_skill_id = max(skills, default=0)
+            self.reserve(user_id, max_skill_id)
+            self.clear(user_id)
+            self.exists[user_id] = True
+            self.checked_in[user_id] = bool(checked_in)
+            for skill_id, (skill_name, rating) in skills.items():
+                self.ratings[skill_id, user_id] = rating
+                self.totals[user_id] += rating
+                self.squares[user_id] += rating * rating
+
+    def clear(self, user_id):
+        self.ratings[:, user_id] = 0
+        self.totals[user_id] = 0
+        self.squares[user_id] = 0
+        self.checked_in[user_id] = False
+        self.exists[user_id] = False
+
+    def reserve(self, user_id, skill_id):
+        """
+        Grow the arrays (geometrically, so inserts stay cheap) to fit a user and skill id.
+        """
+        import numpy as np
+        skills, users = self.ratings.shape
+        if user_id < users and skill_id < skills:
+            return
+        new_users = grown(user_id + 1) if user_id >= users else users
+        new_skills = grown(skill_id + 1) if skill_id >= skills else skills
+        ratings = np.zeros((new_skills, new_users), dtype=np.uint8)
+        ratings[:skills, :users] = self.ratings
+        self.ratings = ratings
+        if new_users != users:
+            for name in ("totals", "squares", "checked_in", "exists"):
+                array = getattr(self, name)
+                resized = np.zeros(new_users, dtype=array.dtype)
+                resized[:users] = array
+                setattr(self, name, resized)
+
+    def matches(self, user_id, k, mode="complement", checked_in_only=True):
+        """
+        [(user_id, score)] of the best k teammates for user_id, best first, or None if there is
+        no such user. Ties are broken by user_id.
+        """
+        import numpy as np
+        # Negative ids would index the arrays from the end
+        if not 0 <= user_id < self.exists.size or not self.exists[user_id]:
+            return None
+        mine = self.ratings[:, user_id]
+        skill_ids = np.flatnonzero(mine)
+
+        if mode == "complement":
+            overlap = np.zeros(self.totals.size, dtype=np.int32)
+            for skill_id in skill_ids:
+                overlap += np.minimum(self.ratings[skill_id], mine[skill_id])
+            scores = (self.totals - overlap).astype(np.float64)
+        else:
+            dot = np.zeros(self.totals.size, dtype=np.int32)
+            for skill_id in skill_ids:
+                dot += self.ratings[skill_id].astype(np.int32) * int(mine[skill_id])
+            norms = np.sqrt(self.squares.astype(np.float64) * float(self.squares[user_id]))
+            scores = np.divide(dot, norms, out=np.zeros(dot.size), where=norms > 0)
+
+        candidates = self.checked_in if checked_in_only else self.exists
+        scores[~candidates] = -np.inf
+        scores[user_id] = -np.inf
+
+        k = min(k, int(np.count_nonzero(scores > -np.inf)))
+        if k <= 0:
+            return []
+        # np.partition finds the k-th best score in linear time. Every candidate tied with it is
+        # kept so the lowest user ids win ties, and only those candidates are sorted
+        threshold = np.partition(scores, scores.size - k)[scores.size - k]
+        best = np.flatnonzero(scores >= threshold)
+        best = best[np.lexsort((best, -scores[best]))][:k]
+        return [(int(candidate), float(scores[candidate])) for candidate in best]
+
+
+def int_array(rows, columns):
+    """
+    Read result rows into an integer array. Passing Row objects to np.array directly is far
+    slower, since numpy probes each of them for array attributes first.
+    """
+    import numpy as np
+    return np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64).reshape(-1, columns)
+
+
+def grown(size):
+    return max(16, int(size * 1.25))
+
+
+matrix = user_changes.register(user_changes.IncrementalView("matching", SkillMatrix.build, max_age=MATCHING_MAX_AGE))
@@ -0,0 +1,292 @@
+"""
+Request and database metrics, exposed at /metrics in the Prometheus text format.
+
+MetricsMiddleware times every request and attaches a RequestStats object to it through a context
+variable. SQLAlchemy event hooks add to that object as statements run, connections are checked out
+of the pool and sessions commit. Sync handlers run in a threadpool, but starlette copies the context
+into the worker thread, so the hooks find the RequestStats of the request they are running for.
+
+When the request finishes, the middleware adds everything to the histograms in one go, so a
+request takes each histogram's lock once rather than once per statement. Histograms and counters
+are also updated straight from other threads: the hooks when there is no request (the outbox
+worker, the warm-up, background rebuilds), and other modules' metrics from the threadpool. Each
+histogram is a list of bucket counters allocated once, and observing a value is a bisect and an
+increment under its own lock, which /metrics also takes so it never reads half an observation.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250, 1000)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last slot is the +Inf bucket
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def render(self, name, labels=""):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        separator = "," if labels else ""
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            yield f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}'
+        yield f'{name}_bucket{{{labels}{separator}le="+Inf"}} {count}'
+        wrapped = f"{{{labels}}}" if labels else ""
+        yield f"{name}_sum{wrapped} {total}"
+        yield f"{name}_count{wrapped} {count}"
+
+
+class HistogramFamily:
+    """
+    Histograms of one metric, keyed by their label values.
+    """
+    def __init__(self, name, help_text, buckets, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.label_names = label_names
+        self.children = {}
+
+    def labels(self, *values):
+        histogram = self.children.get(values)
+        if histogram is None:
+            # setdefault, so two threads adding the same child end up with the same one
+            histogram = self.children.setdefault(values, Histogram(self.buckets))
+        return histogram
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        for values, histogram in list(self.children.items()):
+            yield from histogram.render(self.name, format_labels(self.label_names, values))
+
+
+class CounterFamily:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        with self.lock:
+            items = list(self.values.items())
+        for values, value in items:
+            labels = format_labels(self.label_names, values)
+            yield f"{self.name}{{{labels}}} {value}" if labels else f"{self.name} {value}"
+
+
+def format_labels(names, values):
+    return ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values))
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+request_duration = HistogramFamily(
+    "http_request_duration_seconds", "Time spent handling requests.", LATENCY_BUCKETS, ("method", "route")
+)
+requests_total = CounterFamily(
+    "http_requests_total", "Requests handled, by response status.", ("method", "route", "status")
+)
+statements_per_request = HistogramFamily(
+    "sql_statements_per_request", "SQL statements executed per request.", COUNT_BUCKETS, ("method", "route")
+)
+rows_per_request = HistogramFamily(
+    "sql_rows_affected_per_request", "Rows inserted, updated or deleted per request.", COUNT_BUCKETS, ("method", "route")
+)
+statements_total = CounterFamily("sql_statements_total", "SQL statements executed.")
+checkout_wait = HistogramFamily(
+    "db_pool_checkout_wait_seconds", "Time spent waiting for a connection from the pool.", LATENCY_BUCKETS
+)
+commit_duration = HistogramFamily(
+    "db_commit_duration_seconds", "Time spent committing sessions, including the final flush.", LATENCY_BUCKETS
+)
+
+FAMILIES = [
+    request_duration,
+    requests_total,
+    statements_per_request,
+    rows_per_request,
+    statements_total,
+    checkout_wait,
+    commit_duration,
+]
+
+# Other modules can add their own metrics by registering a function that returns text lines
+collectors = []
+
+
+def register_collector(collector):
+    collectors.append(collector)
+    return collector
+
+
+def render():
+    lines = []
+    for family in FAMILIES:
+        lines.extend(family.render())
+    for collector in collectors:
+        lines.extend(collector())
+    return "\n".join(lines) + "\n"
+
+
+class RequestStats:
+    __slots__ = ("statements", "rows", "checkout_waits", "commit_times")
+
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+        self.checkout_waits = []
+        self.commit_times = []
+
+
+_current_request: ContextVar = ContextVar("request_stats", default=None)
+
+
+def current_request_stats():
+    return _current_request.get()
+
+
+class MetricsMiddleware:
+    """
+    Plain ASGI middleware (rather than BaseHTTPMiddleware, which costs far more per request).
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _current_request.set(stats)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            _current_request.reset(token)
+            record_request(scope, status, elapsed, stats)
+
+
+# (method, route) -> the histograms for that route, so a request costs one dictionary lookup
+_route_histograms = {}
+
+
+def record_request(scope, status, elapsed, stats):
+    # Label by route template (/users/{user_id}) rather than the raw path to keep cardinality low
+    route = scope.get("route")
+    key = (scope["method"], route.path if route is not None else "unmatched")
+
+    histograms = _route_histograms.get(key)
+    if histograms is None:
+        histograms = _route_histograms[key] = (
+            request_duration.labels(*key),
+            statements_per_request.labels(*key),
+            rows_per_request.labels(*key),
+        )
+    duration, statements, rows = histograms
+    duration.observe(elapsed)
+    statements.observe(stats.statements)
+    rows.observe(stats.rows)
+    requests_total.inc(*key, status)
+
+    if stats.statements:
+        statements_total.inc(amount=stats.statements)
+    if stats.checkout_waits:
+        for wait in stats.checkout_waits:
+            checkout_wait.labels().observe(wait)
+    if stats.commit_times:
+        for duration in stats.commit_times:
+            commit_duration.labels().observe(duration)
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool that records how long each checkout waited for a connection.
+    """
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            wait = time.perf_counter() - start
+            stats = _current_request.get()
+            if stats is not None:
+                stats.checkout_waits.append(wait)
+            else:
+                checkout_wait.labels().observe(wait)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current_request.get()
+    if stats is None:
+        statements_total.inc()
+        return
+    stats.statements += 1
+    # SQLite only reports a row count for INSERT, UPDATE and DELETE
+    if cursor.rowcount > 0:
+        stats.rows += cursor.rowcount
+
+
+def _before_commit(session):
+    session.info["commit_started"] = time.perf_counter()
+
+
+def _after_commit(session):
+    started = session.info.pop("commit_started", None)
+    if started is None:
+        return
+    duration = time.perf_counter() - started
+    stats = _current_request.get()
+    if stats is not None:
+        stats.commit_times.append(duration)
+    else:
+        commit_duration.labels().observe(duration)
+
+
+def instrument(engine, session_factory):
+    """
+    Attach the statement and commit hooks to an engine and a sessionmaker.
+    """
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(session_factory, "before_commit", _before_commit)
+    event.listen(session_factory, "after_commit", _after_commit)
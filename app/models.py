@@ -1,5 +1,5 @@
 import datetime
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime, create_engine
+from sqlalchemy import Boolean, Column, ForeignKey, Index, Integer, LargeBinary, String, DateTime, create_engine
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -64,3 +64,61 @@ class Hardware(Base):
 
     # Relationship to the User model (assuming a User can sign out multiple hardware items)
     user = relationship("User", backref="signed_out_hardware")
+
+# Pre-aggregated scan and check-in counts, maintained by scan_rollups.py
+class ScanBucket(Base):
+    __tablename__ = 'ScanBuckets'
+
+    granularity = Column(String, primary_key=True)  # "minute" or "hour"
+    bucket_start = Column(DateTime, primary_key=True)
+    event_id = Column(Integer, ForeignKey('Events.event_id'), primary_key=True)
+    location = Column(String)  # The event's location when it was scanned
+    count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (Index('ix_ScanBuckets_event', 'event_id', 'granularity', 'bucket_start'),)
+
+class CheckinBucket(Base):
+    __tablename__ = 'CheckinBuckets'
+
+    granularity = Column(String, primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+# Responses stored for retried requests with an Idempotency-Key header, see idempotency.py
+class IdempotencyKey(Base):
+    __tablename__ = 'IdempotencyKeys'
+
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String, nullable=False)  # Hash of the request the key was first used with
+    status_code = Column(Integer)  # None until the response is stored
+    content_type = Column(String)
+    body = Column(LargeBinary)
+    created_at = Column(DateTime, nullable=False, index=True)
+
+# Derived-data work waiting to be done after the write that enqueued it, see pipeline.py
+class OutboxEvent(Base):
+    __tablename__ = 'OutboxEvents'
+
+    id = Column(Integer, primary_key=True)
+    topic = Column(String, nullable=False)
+    payload = Column(String, nullable=False)  # JSON
+    created_at = Column(DateTime, nullable=False)
+    available_at = Column(DateTime, index=True)  # When it can next be handled. None once given up on
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(String)
+
+# One row, bumped by every transaction that changes users while an in-memory view is built, so a
+# rebuild can tell which changes it already saw, see user_changes.py
+class UserChangeSequence(Base):
+    __tablename__ = 'UserChangeSequence'
+
+    id = Column(Integer, primary_key=True)
+    seq = Column(Integer, nullable=False, default=0)
+
+# The users each transaction changed, so other workers can drop just those from their user cache,
+# see user_cache.py
+class UserChange(Base):
+    __tablename__ = 'UserChanges'
+
+    seq = Column(Integer, primary_key=True)
+    user_id = Column(Integer)  # None when any user may have changed
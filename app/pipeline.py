@@ -0,0 +1,302 @@
+"""
+Post-commit background pipeline for derived data, backed by a durable outbox.
+
+Work that can lag a write by a few milliseconds (counting scans into the analytics buckets, and
+later search indexes or notifications) shouldn't make the write itself slower. Instead of doing it
+in the request, a session event enqueues it:
+
+    pipeline.enqueue(session, [("scan_buckets", {"event_id": 1, ...})])
+
+which inserts one OutboxEvents row per event in the same transaction as the write, so an event
+exists if and only if its write committed. When the transaction commits, the after_commit hook
+wakes the worker thread. It waits BATCH_WINDOW_SECONDS for more commits, then handles the due
+events in batches with the function registered for their topic:
+
+    @pipeline.handler("scan_buckets")
+    def count_scans(connection, payloads):
+        ...
+
+Taking a batch out of the outbox, the handlers' writes and the commit are one transaction, so each
+event is handled exactly once as far as the database is concerned, and a batch costs one write
+transaction however many events it has. If a handler raises, the batch is rolled back and its
+events are leased and handled again one at a time, so one bad event doesn't hold back the rest.
+Those that still fail are retried after a backoff, and events that keep failing are kept in the
+outbox with available_at set to NULL and their last error.
+
+There is one worker thread per process, since SQLite only has one writer at a time anyway. With
+several processes each event is still handled by one of them. Leased events left behind by a
+process that stopped or crashed are picked up when the lease runs out, on the next poll of any
+worker, or when the app starts again.
+"""
+import datetime
+import json
+import logging
+import os
+import threading
+from collections import defaultdict
+
+from sqlalchemy import delete, event, insert, select, update
+
+from . import metrics, models, query_budget
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+# Seconds a worker may spend on a batch before other workers can take its events
+LEASE_SECONDS = 30.0
+MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1.0  # Doubled after every failed attempt
+MAX_RETRY_DELAY = 60.0
+# After being woken up, the worker waits this long for more commits before claiming a batch, so
+# under load one claim and one handler transaction cover many events instead of one each
+BATCH_WINDOW_SECONDS = float(os.environ.get("SQL_APP_PIPELINE_BATCH_WINDOW", "0.05"))
+# How often the worker looks for due events (retries, other processes' events) when not woken up
+POLL_SECONDS = float(os.environ.get("SQL_APP_PIPELINE_POLL_SECONDS", "1.0"))
+
+events_total = metrics.CounterFamily(
+    "pipeline_events_total", "Outbox events handled, retried after a failure or given up on.", ("topic", "result")
+)
+lag = metrics.HistogramFamily(
+    "pipeline_lag_seconds", "Time from enqueueing an outbox event to handling it.", metrics.LATENCY_BUCKETS, ("topic",)
+)
+metrics.register_collector(events_total.render)
+metrics.register_collector(lag.render)
+
+# topic -> function(connection, payloads)
+handlers = {}
+
+
+def handler(topic):
+    """
+    Register the function that handles a batch of events of a topic, given a connection in the
+    transaction that will delete them and the list of their payloads.
+    """
+    def decorator(function):
+        handlers[topic] = function
+        return function
+    return decorator
+
+
+# session.info key set when the transaction enqueued events
+PENDING = "pipeline_pending"
+
+
+def enqueue(session, events):
+    """
+    Add (topic, payload) events to the outbox in the session's transaction. Payloads must be JSON
+    serializable. They are handled in the background once the transaction commits.
+    """
+    if not events:
+        return
+    now = datetime.datetime.utcnow()
+    session.connection().execute(insert(models.OutboxEvent), [
+        {"topic": topic, "payload": json.dumps(payload), "created_at": now, "available_at": now}
+        for topic, payload in events
+    ])
+    session.info[PENDING] = True
+
+
+def retry_delay(attempts):
+    return min(MAX_RETRY_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1))
+
+
+class OutboxWorker:
+    def __init__(self, batch_size=BATCH_SIZE, poll_seconds=POLL_SECONDS, batch_window=BATCH_WINDOW_SECONDS):
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.batch_window = batch_window
+        self.engine = None
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()  # Held while events are claimed and handled
+        self.thread = None
+        self.thread_lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def start(self):
+        with self.thread_lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.run, name="outbox-worker", daemon=True)
+            self.thread.start()
+
+    def stop(self, timeout=5.0):
+        """
+        Stop the worker thread once it has handled the events that are due. Events it doesn't get
+        to before the timeout stay in the outbox.
+        """
+        with self.thread_lock:
+            thread, self.thread = self.thread, None
+            self.stopping.set()
+            self.wakeup.set()
+        if thread is not None:
+            thread.join(timeout)
+
+    def notify(self):
+        # The thread is only started by the first commit that needs it (or by the app's startup)
+        if self.thread is None:
+            self.start()
+        self.wakeup.set()
+
+    def run(self):
+        query_budget.mark_background_thread()
+        while not self.stopping.is_set():
+            self.run_pending_logged()
+            if self.wakeup.wait(self.poll_seconds):
+                # Cut short by stop(), which drains right after
+                self.stopping.wait(self.batch_window)
+            self.wakeup.clear()
+        # The events committed since the last batch, including while stop() was waiting
+        self.run_pending_logged()
+
+    def run_pending_logged(self):
+        try:
+            self.run_pending()
+        except Exception:
+            # Usually the database being locked for longer than the busy timeout
+            logger.exception("Handling outbox events failed, retrying on the next poll")
+
+    def run_pending(self):
+        """
+        Handle due events until there are none left, and return how many were handled. Also
+        called directly (by tests, and before the test database is replaced) to catch up.
+        """
+        handled = 0
+        with self.lock:
+            while True:
+                try:
+                    batch = self.take()
+                except Exception:
+                    # A handler failed and the batch was rolled back, go through it with leases
+                    batch = self.claim()
+                    self.process(batch)
+                handled += len(batch)
+                if not batch:
+                    break
+        return handled
+
+    def due(self, now):
+        table = models.OutboxEvent
+        return select(table.id).where(table.available_at <= now).order_by(table.id).limit(self.batch_size)
+
+    def take(self):
+        """
+        Delete the next batch of due events and handle them, all in one transaction. This is the
+        usual path: one write transaction per batch, and no lease to take.
+        """
+        table = models.OutboxEvent
+        with self.engine.begin() as connection:
+            rows = connection.execute(
+                delete(table).where(table.id.in_(self.due(datetime.datetime.utcnow()).scalar_subquery()))
+                .returning(table.id, table.topic, table.payload, table.created_at)
+            ).all()
+            by_topic = defaultdict(list)
+            for row in sorted(rows, key=lambda row: row.id):
+                by_topic[row.topic].append(row)
+            for topic, topic_rows in by_topic.items():
+                self.call_handler(connection, topic, topic_rows)
+        for topic, topic_rows in by_topic.items():
+            self.handled(topic, topic_rows)
+        return rows
+
+    def claim(self):
+        """
+        Lease the next batch of due events, oldest first, to handle them outside of the claiming
+        transaction. One UPDATE ... RETURNING, so two processes can't claim the same event.
+        """
+        table = models.OutboxEvent
+        now = datetime.datetime.utcnow()
+        with self.engine.begin() as connection:
+            rows = connection.execute(
+                update(table)
+                .where(table.id.in_(self.due(now).scalar_subquery()))
+                .values(available_at=now + datetime.timedelta(seconds=LEASE_SECONDS), attempts=table.attempts + 1)
+                .returning(table.id, table.topic, table.payload, table.attempts, table.created_at)
+            ).all()
+        return sorted(rows, key=lambda row: row.id)
+
+    def process(self, batch):
+        by_topic = defaultdict(list)
+        for row in batch:
+            by_topic[row.topic].append(row)
+        for topic, rows in by_topic.items():
+            try:
+                self.handle(topic, rows)
+            except Exception as error:
+                if len(rows) == 1:
+                    self.retry(rows, error)
+                    continue
+                # Handle the events one at a time to find the ones that fail
+                for row in rows:
+                    try:
+                        self.handle(topic, [row])
+                    except Exception as error:
+                        self.retry([row], error)
+
+    def handle(self, topic, rows):
+        table = models.OutboxEvent
+        with self.engine.begin() as connection:
+            # Delete first and only handle the events that were still there: one whose lease ran
+            # out may have been handled by another worker meanwhile, or dropped by a backfill
+            deleted = set(connection.execute(
+                delete(table).where(table.id.in_([row.id for row in rows])).returning(table.id)
+            ).scalars())
+            rows = [row for row in rows if row.id in deleted]
+            if rows:
+                self.call_handler(connection, topic, rows)
+        self.handled(topic, rows)
+
+    def call_handler(self, connection, topic, rows):
+        handle_batch = handlers.get(topic)
+        if handle_batch is None:
+            raise LookupError(f"No handler for outbox topic {topic!r}")
+        handle_batch(connection, [json.loads(row.payload) for row in rows])
+
+    def handled(self, topic, rows):
+        if not rows:
+            return
+        events_total.inc(topic, "handled", amount=len(rows))
+        now = datetime.datetime.utcnow()
+        histogram = lag.labels(topic)
+        for row in rows:
+            histogram.observe((now - row.created_at).total_seconds())
+
+    def retry(self, rows, error):
+        table = models.OutboxEvent
+        now = datetime.datetime.utcnow()
+        with self.engine.begin() as connection:
+            for row in rows:
+                gave_up = row.attempts >= MAX_ATTEMPTS
+                available_at = None if gave_up else now + datetime.timedelta(seconds=retry_delay(row.attempts))
+                connection.execute(
+                    update(table).where(table.id == row.id).values(available_at=available_at, last_error=repr(error)[:1000])
+                )
+                events_total.inc(row.topic, "dead" if gave_up else "retried")
+        logger.warning(f"Outbox {rows[0].topic} events {[row.id for row in rows]} failed: {error!r}")
+
+
+worker = OutboxWorker()
+
+
+def _after_commit(session):
+    if session.info.pop(PENDING, False):
+        worker.notify()
+
+
+def _after_rollback(session):
+    session.info.pop(PENDING, None)
+
+
+def instrument(engine, session_factory):
+    """
+    Handle the events enqueued by sessions from session_factory once they commit.
+    """
+    worker.engine = engine
+    event.listen(session_factory, "after_commit", _after_commit)
+    event.listen(session_factory, "after_rollback", _after_rollback)
+
+
+def run_pending():
+    from . import database  # Imports this module
+    database.get_engine()
+    return worker.run_pending()
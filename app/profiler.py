@@ -0,0 +1,233 @@
+"""
+On-demand profiling of selected routes, for finding out where request time goes in production.
+
+An admin turns profiling on for some routes, a fraction of requests and a bounded time window
+(see the /admin/profiler endpoints in main.py). Two modes are supported:
+
+    sampling  a background thread samples the stacks of the threads running profiled requests
+              every interval_ms and counts them, ready for flamegraph.pl or speedscope
+    cprofile  profiled requests run under cProfile and the stats are merged per route into a
+              pstats file. Only one profiler can be active in the process at a time, so requests
+              that arrive while another one is being profiled run unprofiled
+
+Every route is created through ProfiledRoute, which wraps its endpoint. While profiling is off the
+wrapper only checks one attribute before calling the endpoint, so there is no measurable overhead.
+"""
+import cProfile
+import functools
+import inspect
+import marshal
+import os
+import pstats
+import random
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+
+from fastapi import Header, HTTPException
+from fastapi.routing import APIRoute
+
+ADMIN_TOKEN = os.environ.get("SQL_APP_ADMIN_TOKEN")
+
+# Longest time window profiling can be turned on for
+MAX_DURATION_SECONDS = 600
+
+
+def require_admin(x_admin_token: str = Header(None)):
+    """
+    Dependency for admin-only endpoints. They are disabled unless SQL_APP_ADMIN_TOKEN is set.
+    """
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled. Set SQL_APP_ADMIN_TOKEN to enable them")
+    if x_admin_token is None or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+class Profiler:
+    def __init__(self):
+        self.active = False
+        self.lock = threading.Lock()
+        # Held by the request being profiled in cprofile mode
+        self.cprofile_lock = threading.Lock()
+        # Held while a window is started, so only one sampler thread ever runs
+        self.start_lock = threading.Lock()
+        self.sampler = None
+        self.sampler_stop = threading.Event()
+        self.reset()
+
+    def reset(self):
+        self.routes = set()
+        self.sample_rate = 0.0
+        self.mode = "sampling"
+        self.interval = 0.001
+        self.deadline = 0.0
+        self.profiled_requests = Counter()
+        self.stacks = {}  # route -> Counter of collapsed stacks
+        self.stats = {}  # route -> pstats.Stats
+        self.running_threads = {}  # thread id -> route, for threads running a sampled request
+
+    def start(self, routes, sample_rate, duration_seconds, mode="sampling", interval_ms=1.0):
+        with self.start_lock:
+            # The sampler of the previous window must be gone before the results are reset, or
+            # it would keep sampling alongside the new one
+            self.stop()
+            if self.sampler is not None:
+                self.sampler.join()
+                self.sampler = None
+            with self.lock:
+                self.reset()
+                self.routes = set(routes)
+                self.sample_rate = sample_rate
+                self.mode = mode
+                self.interval = interval_ms / 1000
+                self.deadline = time.monotonic() + duration_seconds
+                self.active = True
+            if mode == "sampling":
+                self.sampler_stop = threading.Event()
+                self.sampler = threading.Thread(
+                    target=self.sample_stacks, args=(self.sampler_stop,), name="profiler-sampler", daemon=True
+                )
+                self.sampler.start()
+
+    def stop(self):
+        # Results are kept until profiling is started again
+        self.active = False
+        self.sampler_stop.set()
+
+    def status(self):
+        return {
+            "active": self.is_active(),
+            "mode": self.mode,
+            "routes": sorted(self.routes),
+            "sample_rate": self.sample_rate,
+            "seconds_remaining": max(0.0, round(self.deadline - time.monotonic(), 1)) if self.active else 0.0,
+            "profiled_requests": dict(self.profiled_requests),
+        }
+
+    def is_active(self):
+        if self.active and time.monotonic() >= self.deadline:
+            self.active = False
+        return self.active
+
+    def should_profile(self, route):
+        return (
+            self.is_active()
+            and (not self.routes or route in self.routes)
+            and random.random() < self.sample_rate
+        )
+
+    def call(self, route, endpoint, args, kwargs):
+        if not self.should_profile(route):
+            return endpoint(*args, **kwargs)
+
+        if self.mode == "cprofile":
+            # A second active cProfile.Profile raises on Python 3.12+ and mixes up the stats of
+            # both requests before that, so skip requests instead of waiting for the profiled one
+            if not self.cprofile_lock.acquire(blocking=False):
+                return endpoint(*args, **kwargs)
+            try:
+                self.count_profiled(route)
+                profile = cProfile.Profile()
+                try:
+                    return profile.runcall(endpoint, *args, **kwargs)
+                finally:
+                    self.add_profile(route, profile)
+            finally:
+                self.cprofile_lock.release()
+
+        self.count_profiled(route)
+        thread_id = threading.get_ident()
+        self.running_threads[thread_id] = route
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            self.running_threads.pop(thread_id, None)
+
+    def count_profiled(self, route):
+        with self.lock:
+            self.profiled_requests[route] += 1
+
+    def add_profile(self, route, profile):
+        with self.lock:
+            if route in self.stats:
+                self.stats[route].add(profile)
+            else:
+                self.stats[route] = pstats.Stats(profile)
+
+    def sample_stacks(self, stop):
+        while self.is_active() and not stop.is_set():
+            frames = sys._current_frames()
+            for thread_id, route in list(self.running_threads.items()):
+                frame = frames.get(thread_id)
+                stack = collapse_stack(frame) if frame is not None else None
+                if stack is not None:
+                    with self.lock:
+                        self.stacks.setdefault(route, Counter())[stack] += 1
+            del frames
+            stop.wait(self.interval)
+
+    def collapsed(self, route=None):
+        """
+        Sampled stacks in the collapsed format used by flamegraph.pl: "outer;inner;leaf count".
+        """
+        with self.lock:
+            counters = [self.stacks.get(route, Counter())] if route else list(self.stacks.values())
+            merged = Counter()
+            for counter in counters:
+                merged.update(counter)
+        return "".join(f"{stack} {count}\n" for stack, count in merged.most_common())
+
+    def pstats_dump(self, route):
+        """
+        The merged cProfile stats of a route, in the format written by pstats.Stats.dump_stats.
+        """
+        with self.lock:
+            stats = self.stats.get(route)
+            return marshal.dumps(stats.stats) if stats is not None else None
+
+
+def collapse_stack(frame):
+    """
+    Collapse a stack from the endpoint down to frame, or None if it doesn't lead back to the
+    profiling wrapper. That happens when the thread moved on while the stack was being walked
+    (a generator frame is detached from its caller when it yields), and the sample is dropped.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        # Stop at the profiling wrapper so stacks start at the endpoint, not at the threadpool
+        if code is Profiler.call.__code__:
+            # Nothing to record when the thread is still (or already) in the wrapper itself
+            return ";".join(reversed(names)) if names else None
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return None
+
+
+profiler = Profiler()
+
+
+def profiled(route, endpoint):
+    """
+    Wrap an endpoint so it can be profiled. functools.wraps keeps the signature (and attributes
+    such as query budgets) visible to FastAPI.
+    """
+    if inspect.iscoroutinefunction(endpoint):
+        # Async endpoints run on the event loop, where the sampler and cProfile can't separate
+        # them from other requests, so they are never profiled
+        return endpoint
+
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        if not profiler.active:
+            return endpoint(*args, **kwargs)
+        return profiler.call(route, endpoint, args, kwargs)
+
+    return wrapper
+
+
+class ProfiledRoute(APIRoute):
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, profiled(path, endpoint), **kwargs)
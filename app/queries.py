@@ -0,0 +1,143 @@
+"""
+Read queries that return plain rows and dicts instead of ORM objects.
+
+Loading users through the ORM hydrates a User object per row, then lazily runs one query per user
+for their UserSkill rows and one more per skill for its name. These helpers select only the
+columns a response needs and load the skills of a whole page of users in a single join.
+"""
+from collections import defaultdict
+
+from sqlalchemy import select
+
+from . import models
+
+# Number of ids looked up per IN list by load_users_by_id
+BATCH_CHUNK_SIZE = 500
+
+# Fields of a user that can be requested with ?fields=, in response order
+USER_FIELDS = ("name", "company", "email", "phone", "checked_in")
+
+
+def execute(db, query):
+    """
+    Run a query on the session's connection. These queries only select columns, so running them
+    as Core statements skips the ORM result processing, which is several times slower per row.
+    """
+    return db.connection().execute(query)
+
+
+def user_columns(fields=USER_FIELDS):
+    """
+    Columns to select for the requested fields. user_id is always selected to match up skills.
+    """
+    return (models.User.user_id, *(getattr(models.User, field) for field in fields))
+
+
+def select_users(checked_in_only=False, skip=0, limit=None, fields=USER_FIELDS):
+    """
+    Build the query for a page of users, ordered by user_id so pages are stable.
+    """
+    query = select(*user_columns(fields)).order_by(models.User.user_id)
+    if checked_in_only:
+        query = query.where(models.User.checked_in == True)
+    return query.offset(skip).limit(limit)
+
+
+def skills_by_user(db, user_ids):
+    """
+    Return {user_id: [{"skill": ..., "rating": ...}, ...]} for the given users.
+
+    user_ids can be a list of ids or a select() of ids. Skills are ordered by skill_id, the same
+    order the User.skills relationship loads them in.
+    """
+    query = (
+        select(models.UserSkill.user_id, models.Skill.skill_name, models.UserSkill.rating)
+        .join(models.Skill, models.Skill.skill_id == models.UserSkill.skill_id)
+        .where(models.UserSkill.user_id.in_(user_ids))
+        .order_by(models.UserSkill.user_id, models.UserSkill.skill_id)
+    )
+    skills = defaultdict(list)
+    for user_id, skill_name, rating in execute(db, query):
+        skills[user_id].append({"skill": skill_name, "rating": rating})
+    return skills
+
+
+def user_payload(row, fields=USER_FIELDS, skills=None):
+    """
+    Build a user dict from a row. Skills are only included if a skills mapping is given.
+    """
+    payload = {field: getattr(row, field) for field in fields}
+    if skills is not None:
+        payload["skills"] = skills.get(row.user_id, [])
+    return payload
+
+
+def load_users(db, checked_in_only=False, skip=0, limit=None, fields=USER_FIELDS, include_skills=True):
+    """
+    Load a page of users as dicts with only the requested fields. The UserSkills/Skills join only
+    runs if include_skills is set, so at most two queries are run.
+    """
+    page = select_users(checked_in_only, skip, limit, fields)
+    rows = execute(db, page).all()
+    if not rows:
+        return []
+    skills = None
+    if include_skills:
+        skills = skills_by_user(db, page.with_only_columns(models.User.user_id).scalar_subquery())
+    return [user_payload(row, fields, skills) for row in rows]
+
+
+def load_user(db, user_id, fields=USER_FIELDS, include_skills=True):
+    """
+    Load a single user as a dict with only the requested fields, or None if they don't exist.
+    """
+    row = execute(db, select(*user_columns(fields)).where(models.User.user_id == user_id)).first()
+    if row is None:
+        return None
+    skills = skills_by_user(db, [user_id]) if include_skills else None
+    return user_payload(row, fields, skills)
+
+
+def load_users_by_id(db, user_ids, fields=USER_FIELDS, include_skills=True, chunk_size=BATCH_CHUNK_SIZE):
+    """
+    Load many users by id as {user_id: dict}. Ids are looked up in IN lists of chunk_size, so
+    the number of queries depends only on how many ids there are, never on what they contain.
+    Ids that don't exist are left out of the result.
+    """
+    unique_ids = list(dict.fromkeys(user_ids))
+    users = {}
+    for start in range(0, len(unique_ids), chunk_size):
+        chunk = unique_ids[start:start + chunk_size]
+        rows = execute(db, select(*user_columns(fields)).where(models.User.user_id.in_(chunk))).all()
+        skills = skills_by_user(db, chunk) if include_skills and rows else None
+        for row in rows:
+            users[row.user_id] = user_payload(row, fields, skills)
+    return users
+
+
+def load_signed_out_hardware(db, user_id):
+    query = (
+        select(models.Hardware.name, models.Hardware.serial_number)
+        .where(models.Hardware.signed_out_by_user_id == user_id)
+        .order_by(models.Hardware.hardware_id)
+    )
+    return [{"name": row.name, "serial_number": row.serial_number} for row in execute(db, query)]
+
+
+def load_scanned_events(db, user_id):
+    """
+    Load the events a user has been scanned into, joining ScanEvents to Events in one query.
+    """
+    query = (
+        select(
+            models.Event.name,
+            models.Event.description,
+            models.Event.start_time,
+            models.Event.end_time,
+            models.Event.location,
+        )
+        .join(models.ScanEvent, models.ScanEvent.event_id == models.Event.event_id)
+        .where(models.ScanEvent.user_id == user_id)
+        .order_by(models.ScanEvent.scan_id)
+    )
+    return [row._asdict() for row in execute(db, query)]
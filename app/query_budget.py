@@ -0,0 +1,200 @@
+"""
+Per-request query budgets and N+1 detection.
+
+Routes declare how many SQL statements they are allowed to run with the query_budget decorator
+(imported as budget in main.py):
+
+    @app.get("/users/{user_id}")
+    @budget(max_queries=2)
+    def read_user_by_id(...):
+
+QueryBudgetMiddleware records the statements each request runs and fingerprints them (the SQL with
+IN lists and numbers collapsed), so running the same statement shape over and over, the usual sign
+of a lazy-loading N+1, is caught even on routes without a declared budget. What happens when a
+request goes over its budget is controlled by the SQL_APP_QUERY_BUDGET environment variable:
+
+    off    the middleware isn't installed (the default)
+    warn   log a warning
+    raise  replace the response with a 500 (used by the tests)
+
+With SQL_APP_DEBUG=1, every response also gets an X-Query-Count header.
+"""
+import json
+import logging
+import os
+import re
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+QUERY_BUDGET_MODE = os.environ.get("SQL_APP_QUERY_BUDGET", "off")
+DEBUG = os.environ.get("SQL_APP_DEBUG", "") not in ("", "0", "false")
+
+# Routes without a declared budget may still not run the same statement shape more than this
+DEFAULT_MAX_REPEATS = 3
+
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_NUMBER = re.compile(r"\b\d+\b")
+_WHITESPACE = re.compile(r"\s+")
+_fingerprints = {}
+
+
+def fingerprint(statement):
+    """
+    Reduce a statement to its shape, so the same query with different parameters or IN list
+    lengths counts as a repeat. Statements are cached since there are only a few distinct ones.
+    """
+    shape = _fingerprints.get(statement)
+    if shape is None:
+        shape = _WHITESPACE.sub(" ", statement).strip()
+        shape = _IN_LIST.sub("(?+)", shape)
+        shape = _NUMBER.sub("?", shape)
+        _fingerprints[statement] = shape
+    return shape
+
+
+class QueryBudget:
+    def __init__(self, max_queries=None, max_repeats=DEFAULT_MAX_REPEATS):
+        self.max_queries = max_queries
+        self.max_repeats = max_repeats
+
+
+def query_budget(max_queries=None, max_repeats=DEFAULT_MAX_REPEATS):
+    """
+    Declare the query budget of a route. Put it below the @app.get/@app.put decorator.
+    """
+    def decorator(endpoint):
+        endpoint.__query_budget__ = QueryBudget(max_queries, max_repeats)
+        return endpoint
+    return decorator
+
+
+class QueryRecorder:
+    def __init__(self):
+        self.count = 0
+        self.shapes = Counter()
+
+    def record(self, statement):
+        self.count += 1
+        self.shapes[fingerprint(statement)] += 1
+
+    def most_repeated(self):
+        if not self.shapes:
+            return None, 0
+        return self.shapes.most_common(1)[0]
+
+    def violations(self, budget):
+        problems = []
+        if budget.max_queries is not None and self.count > budget.max_queries:
+            problems.append(f"ran {self.count} queries, budget is {budget.max_queries}")
+        shape, repeats = self.most_repeated()
+        if budget.max_repeats is not None and repeats > budget.max_repeats:
+            problems.append(f"ran the same statement {repeats} times (limit {budget.max_repeats}), possible N+1: {shape}")
+        return problems
+
+    def assert_budget(self, max_queries=None, max_repeats=DEFAULT_MAX_REPEATS):
+        problems = self.violations(QueryBudget(max_queries, max_repeats))
+        assert not problems, "; ".join(problems)
+
+
+_current_recorder: ContextVar = ContextVar("query_recorder", default=None)
+# Set in threads that do background work, whose statements don't belong to any request
+_background_thread: ContextVar = ContextVar("query_budget_background_thread", default=False)
+
+
+def mark_background_thread():
+    """
+    Leave the statements run by the calling thread out of record_queries. Called first thing by
+    the outbox worker and view rebuild threads, which poll and write while requests are measured.
+    """
+    _background_thread.set(True)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    recorder = _current_recorder.get()
+    if recorder is not None:
+        recorder.record(statement)
+
+
+def instrument(engine):
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+@contextmanager
+def record_queries(engine):
+    """
+    Record every statement run on the engine while the block runs, from any thread except the
+    background ones (see mark_background_thread). Used by the query_recorder pytest fixture, where
+    requests run in the test client's threads.
+    """
+    recorder = QueryRecorder()
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not _background_thread.get():
+            recorder.record(statement)
+
+    event.listen(engine, "after_cursor_execute", record)
+    try:
+        yield recorder
+    finally:
+        event.remove(engine, "after_cursor_execute", record)
+
+
+def route_budget(scope):
+    route = scope.get("route")
+    endpoint = getattr(route, "endpoint", None)
+    return getattr(endpoint, "__query_budget__", None) or QueryBudget()
+
+
+class QueryBudgetMiddleware:
+    def __init__(self, app, mode=QUERY_BUDGET_MODE, debug=DEBUG):
+        self.app = app
+        self.mode = mode
+        self.debug = debug
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        recorder = QueryRecorder()
+        token = _current_recorder.set(recorder)
+        replaced = False
+
+        # The handler has finished by the time the response starts, so the budget can be checked
+        # (and the response replaced) before anything is sent to the client
+        async def send_checked(message):
+            nonlocal replaced
+            if replaced:
+                return
+            if message["type"] == "http.response.start":
+                problems = recorder.violations(route_budget(scope))
+                if problems:
+                    route = scope.get("route")
+                    description = f"{scope['method']} {route.path if route else scope['path']}: {'; '.join(problems)}"
+                    if self.mode == "raise":
+                        replaced = True
+                        await self.send_error(send, description, recorder.count)
+                        return
+                    logger.warning(f"Query budget exceeded by {description}")
+                if self.debug:
+                    message = dict(message)
+                    message["headers"] = list(message.get("headers", [])) + [(b"x-query-count", str(recorder.count).encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_checked)
+        finally:
+            _current_recorder.reset(token)
+
+    async def send_error(self, send, description, count):
+        body = json.dumps({"detail": f"Query budget exceeded by {description}"}).encode()
+        headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+        if self.debug:
+            headers.append((b"x-query-count", str(count).encode()))
+        await send({"type": "http.response.start", "status": 500, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
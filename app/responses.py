@@ -0,0 +1,31 @@
+"""
+Fast JSON responses for data that doesn't need to be validated again.
+
+Returning a list of pydantic models from a handler validates every object twice: once when the
+model is built, and again when FastAPI checks it against the route's response_model before
+serializing it. For rows that come straight from our own database queries that work is wasted.
+
+json_response() serializes plain dicts (shaped like the TypedDicts in schemas.py) straight to
+JSON bytes with a cached pydantic TypeAdapter and returns a Response, which FastAPI sends as is.
+Routes keep their response_model, so the OpenAPI documentation doesn't change.
+"""
+from functools import lru_cache
+
+from fastapi import Response
+from pydantic import TypeAdapter
+
+
+@lru_cache(maxsize=None)
+def type_adapter(type_):
+    """
+    Building a TypeAdapter compiles a serializer, so build each one once and reuse it.
+    """
+    return TypeAdapter(type_)
+
+
+def dump_json(type_, content):
+    return type_adapter(type_).dump_json(content)
+
+
+def json_response(type_, content, status_code=200):
+    return Response(content=dump_json(type_, content), status_code=status_code, media_type="application/json")
@@ -0,0 +1,236 @@
+"""
+Per-minute and per-hour scan and check-in counts behind /analytics/scans and /analytics/checkins.
+
+Counting ScanEvents rows by created_at on every request gets slower as the event goes on, so the
+counts are pre-aggregated into the ScanBuckets and CheckinBuckets tables instead. A session event
+enqueues every new scan (and every user going from not checked in to checked in) in the outbox,
+in the same transaction as the write itself (see pipeline.py). Once it commits, the background
+worker adds each batch of them to their minute and hour buckets with one upsert, so the buckets
+lag the committed rows by a few milliseconds but never miss any. The analytics endpoints only read
+bucket rows, by primary key range.
+
+Scans made before the buckets existed (or written straight to the database, like the benchmark
+datasets) are counted with:
+
+    python -m app.scan_rollups backfill
+
+Users only have a checked_in flag, not the time they checked in, so check-in buckets can't be
+backfilled and only count check-ins made through the app since the buckets were added. Bulk
+UPDATE statements (db_init.py --sync) aren't counted either.
+"""
+import argparse
+import datetime
+import os
+from collections import Counter
+
+from sqlalchemy import create_engine, delete, event, func, literal, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import attributes
+
+from . import models, pipeline
+
+# Truncate a time to the start of its bucket, in Python and in SQLite. The SQL formats have to
+# match how SQLAlchemy stores DateTime values, since bucket_start is part of the primary key
+GRANULARITIES = {
+    "minute": (lambda moment: moment.replace(second=0, microsecond=0), "%Y-%m-%d %H:%M:00.000000"),
+    "hour": (lambda moment: moment.replace(minute=0, second=0, microsecond=0), "%Y-%m-%d %H:00:00.000000"),
+}
+
+
+def to_utc(moment):
+    """
+    Times are stored as naive UTC, like ScanEvent.created_at.
+    """
+    if moment is not None and moment.tzinfo is not None:
+        moment = moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def upsert(connection, model, rows):
+    """
+    Add the counts of rows (dicts of primary key columns and count) to their buckets.
+    """
+    if not rows:
+        return
+    statement = insert(model)
+    statement = statement.on_conflict_do_update(
+        index_elements=[column.name for column in model.__table__.primary_key],
+        set_={"count": model.count + statement.excluded.count}
+    )
+    connection.execute(statement, rows)
+
+
+def checked_in_now(user):
+    """
+    Whether this flush checks the user in, rather than leaving them checked in.
+    """
+    history = attributes.get_history(user, "checked_in")
+    return bool(history.added and history.added[0]) and not (history.deleted and history.deleted[0])
+
+
+def _before_flush(session, flush_context, instances):
+    events = []
+    locations = {}
+    now = datetime.datetime.utcnow()
+
+    for instance in session.new:
+        if isinstance(instance, models.ScanEvent) and instance.event_id is not None:
+            # Set created_at here rather than leaving it to the column default, so the scan and
+            # its buckets agree on the time
+            if instance.created_at is None:
+                instance.created_at = now
+            if instance.event_id not in locations:
+                # Usually already in the session, since scan_user loads the event first
+                scanned_event = session.get(models.Event, instance.event_id)
+                locations[instance.event_id] = scanned_event.location if scanned_event is not None else None
+            events.append(("scan_buckets", {
+                "event_id": instance.event_id,
+                "location": locations[instance.event_id],
+                "at": to_utc(instance.created_at).isoformat(),
+            }))
+
+    for instance in (*session.new, *session.dirty):
+        if isinstance(instance, models.User) and checked_in_now(instance):
+            events.append(("checkin_buckets", {"at": now.isoformat()}))
+
+    pipeline.enqueue(session, events)
+
+
+@pipeline.handler("scan_buckets")
+def count_scans(connection, scans):
+    counts = Counter()
+    locations = {}
+    for scan in scans:
+        scanned_at = datetime.datetime.fromisoformat(scan["at"])
+        locations[scan["event_id"]] = scan["location"]
+        for granularity, (truncate, _) in GRANULARITIES.items():
+            counts[granularity, truncate(scanned_at), scan["event_id"]] += 1
+    upsert(connection, models.ScanBucket, [
+        {"granularity": granularity, "bucket_start": bucket_start, "event_id": event_id, "location": locations[event_id], "count": count}
+        for (granularity, bucket_start, event_id), count in counts.items()
+    ])
+
+
+@pipeline.handler("checkin_buckets")
+def count_checkins(connection, checkins):
+    counts = Counter()
+    for checkin in checkins:
+        checked_in_at = datetime.datetime.fromisoformat(checkin["at"])
+        for granularity, (truncate, _) in GRANULARITIES.items():
+            counts[granularity, truncate(checked_in_at)] += 1
+    upsert(connection, models.CheckinBucket, [
+        {"granularity": granularity, "bucket_start": bucket_start, "count": count}
+        for (granularity, bucket_start), count in counts.items()
+    ])
+
+
+def instrument(session_factory):
+    """
+    Enqueue the scans and check-ins made through sessions from session_factory, to be counted
+    into their buckets.
+    """
+    event.listen(session_factory, "before_flush", _before_flush)
+
+
+def scan_counts(connection, granularity, start=None, end=None, event_id=None, location=None, limit=None):
+    """
+    Scans per bucket and event in [start, end), in time order.
+    """
+    query = (
+        select(models.ScanBucket.bucket_start, models.ScanBucket.event_id, models.ScanBucket.location, models.ScanBucket.count)
+        .where(models.ScanBucket.granularity == granularity)
+        .order_by(models.ScanBucket.bucket_start, models.ScanBucket.event_id)
+    )
+    query = in_range(query, models.ScanBucket, start, end)
+    if event_id is not None:
+        query = query.where(models.ScanBucket.event_id == event_id)
+    if location is not None:
+        query = query.where(models.ScanBucket.location == location)
+    if limit is not None:
+        query = query.limit(limit)
+    return [
+        {"bucket_start": bucket_start, "event_id": event_id, "location": location, "scans": count}
+        for bucket_start, event_id, location, count in connection.execute(query)
+    ]
+
+
+def checkin_curve(connection, granularity, start=None, end=None):
+    """
+    Check-ins per bucket in [start, end), with the running total of check-ins up to the end of
+    each bucket (the arrival curve).
+    """
+    total = 0
+    if start is not None:
+        earlier = select(func.coalesce(func.sum(models.CheckinBucket.count), 0)).where(
+            models.CheckinBucket.granularity == granularity,
+            models.CheckinBucket.bucket_start < start
+        )
+        total = connection.execute(earlier).scalar()
+
+    query = (
+        select(models.CheckinBucket.bucket_start, models.CheckinBucket.count)
+        .where(models.CheckinBucket.granularity == granularity)
+        .order_by(models.CheckinBucket.bucket_start)
+    )
+    curve = []
+    for bucket_start, count in connection.execute(in_range(query, models.CheckinBucket, start, end)):
+        total += count
+        curve.append({"bucket_start": bucket_start, "checkins": count, "total": total})
+    return curve
+
+
+def in_range(query, model, start, end):
+    if start is not None:
+        query = query.where(model.bucket_start >= start)
+    if end is not None:
+        query = query.where(model.bucket_start < end)
+    return query
+
+
+def backfill(connection):
+    """
+    Recount the scan buckets from ScanEvents with one INSERT ... SELECT per granularity.
+    Returns {granularity: number of buckets}.
+    """
+    connection.execute(delete(models.ScanBucket))
+    # Committed scans still waiting in the outbox are counted here, so they mustn't be counted again
+    connection.execute(delete(models.OutboxEvent).where(models.OutboxEvent.topic == "scan_buckets"))
+    buckets = {}
+    for granularity, (_, sql_format) in GRANULARITIES.items():
+        bucket_start = func.strftime(sql_format, models.ScanEvent.created_at)
+        counts = (
+            select(
+                literal(granularity),
+                bucket_start,
+                models.ScanEvent.event_id,
+                models.Event.location,
+                func.count()
+            )
+            .join(models.Event, models.Event.event_id == models.ScanEvent.event_id)
+            .where(models.ScanEvent.created_at.is_not(None))
+            .group_by(bucket_start, models.ScanEvent.event_id, models.Event.location)
+        )
+        result = connection.execute(insert(models.ScanBucket).from_select(
+            ["granularity", "bucket_start", "event_id", "location", "count"], counts
+        ))
+        buckets[granularity] = result.rowcount
+    return buckets
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the scan analytics buckets from existing scans.")
+    parser.add_argument("command", choices=["backfill"])
+    parser.add_argument(
+        "--database",
+        default=os.environ.get("SQL_APP_DB_PATH", "./sql_app.db"),
+        help="Path of the database (defaults to SQL_APP_DB_PATH or ./sql_app.db)"
+    )
+    args = parser.parse_args()
+
+    engine = create_engine(f"sqlite:///{args.database}")
+    models.Base.metadata.create_all(bind=engine, tables=[models.ScanBucket.__table__, models.CheckinBucket.__table__])
+    with engine.begin() as connection:
+        buckets = backfill(connection)
+    for granularity, count in buckets.items():
+        print(f"{count} {granularity} buckets")
+    print("Check-ins have no timestamps, so check-in buckets only count check-ins from now on")
@@ -2,7 +2,8 @@
 
 from datetime import datetime
 from pydantic import field_validator, BaseModel, ConfigDict
-from typing import List, Optional
+from typing import Dict, List, Literal, Optional
+from typing_extensions import TypedDict
 
 
 # Define a schema for the skill with rating
@@ -45,6 +46,43 @@ class User(UserBase):
     skills: List[Skill] = []
     model_config = ConfigDict(from_attributes=True)
 
+# Plain dict shapes of the response models above, used to serialize rows that are already
+# known to be valid (see responses.py). They must stay in sync with SkillBase/Skill and User.
+class SkillPayload(TypedDict):
+    skill: str
+    rating: int
+
+class UserPayload(TypedDict):
+    name: str
+    company: str
+    email: str
+    phone: str
+    checked_in: bool
+    skills: List[SkillPayload]
+
+# Users returned with ?fields= only contain some of the keys. Also the response model of the
+# routes that take ?fields=, so the docs don't list every field as always present.
+class PartialUserPayload(TypedDict, total=False):
+    """
+    A user with the fields selected with ?fields= and ?expand=.
+    """
+    name: str
+    company: str
+    email: str
+    phone: str
+    checked_in: bool
+    skills: List[SkillPayload]
+
+class BatchUserResult(BaseModel):
+    user_id: int
+    user: Optional[PartialUserPayload] = None
+    detail: Optional[str] = None
+
+class BatchUserResultPayload(TypedDict):
+    user_id: int
+    user: Optional[PartialUserPayload]
+    detail: Optional[str]
+
 class SkillFrequency(BaseModel):
     skill_name: str
     frequency: int
@@ -79,7 +117,101 @@ class HardwareBase(BaseModel):
     serial_number: str
 
 class HackerDashboard(BaseModel):
-    user_info: UserBase
+    user_info: PartialUserPayload
     signed_out_hardware: List[HardwareBase]
     checked_in_events: List[EventBase]
     model_config = ConfigDict(from_attributes=True)
+
+class HardwarePayload(TypedDict):
+    name: str
+    serial_number: str
+
+class EventPayload(TypedDict):
+    name: str
+    description: str
+    start_time: datetime
+    end_time: datetime
+    location: str
+
+class HackerDashboardPayload(TypedDict):
+    user_info: PartialUserPayload
+    signed_out_hardware: List[HardwarePayload]
+    checked_in_events: List[EventPayload]
+
+class CompanySkill(BaseModel):
+    skill: str
+    users: int
+
+class CompanySummary(BaseModel):
+    company: Optional[str]
+    headcount: int
+    checked_in: int
+    checked_in_ratio: float
+    top_skills: List[CompanySkill]
+
+class SkillRatings(BaseModel):
+    skill: str
+    users: int
+    average_rating: float
+    ratings: Dict[int, int]  # rating -> number of users
+
+class CompanySkillPayload(TypedDict):
+    skill: str
+    users: int
+
+class CompanySummaryPayload(TypedDict):
+    company: Optional[str]
+    headcount: int
+    checked_in: int
+    checked_in_ratio: float
+    top_skills: List[CompanySkillPayload]
+
+class SkillRatingsPayload(TypedDict):
+    skill: str
+    users: int
+    average_rating: float
+    ratings: Dict[int, int]
+
+class MatchedUser(BaseModel):
+    name: str
+    company: str
+    skills: List[Skill]
+
+class Match(BaseModel):
+    user_id: int
+    score: float
+    user: MatchedUser
+
+class MatchPayload(TypedDict):
+    user_id: int
+    score: float
+    user: PartialUserPayload
+
+class ScanBucket(BaseModel):
+    bucket_start: datetime
+    event_id: int
+    location: Optional[str]
+    scans: int
+
+class CheckinBucket(BaseModel):
+    bucket_start: datetime
+    checkins: int
+    total: int  # Check-ins up to the end of the bucket
+
+class ScanBucketPayload(TypedDict):
+    bucket_start: datetime
+    event_id: int
+    location: Optional[str]
+    scans: int
+
+class CheckinBucketPayload(TypedDict):
+    bucket_start: datetime
+    checkins: int
+    total: int
+
+class ProfilerStart(BaseModel):
+    routes: List[str] = []  # Route paths as declared, e.g. /users/{user_id}. Empty profiles every route
+    sample_rate: float = 0.1
+    duration_seconds: float = 60
+    mode: Literal["sampling", "cprofile"] = "sampling"
+    interval_ms: float = 1.0  # Only used in sampling mode
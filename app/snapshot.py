@@ -0,0 +1,145 @@
+"""
+Snapshots of the seeded SQLite database.
+
+Seeding with db_init.py takes a couple of seconds, while copying an already seeded database
+with SQLite's online backup API takes a few milliseconds. Tests restore a snapshot before every
+test instead of reseeding, and the app can start from a prebuilt snapshot by setting the
+SQL_APP_SNAPSHOT environment variable, which creates the database from it if it doesn't exist yet.
+
+Usage:
+    python -m app.snapshot save snapshots/seed.db      # snapshot the current database
+    python -m app.snapshot restore snapshots/seed.db   # overwrite the current database
+    python -m app.snapshot seed snapshots/seed.db      # seed a fresh snapshot with db_init.py
+"""
+import argparse
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Files that change the contents of a freshly seeded database
+SEED_INPUTS = [
+    os.path.join(PROJECT_ROOT, "HTN_2023_BE_Challenge_Data.json"),
+    os.path.join(PROJECT_ROOT, "events.json"),
+    os.path.join(PROJECT_ROOT, "hardware.json"),
+    os.path.join(PROJECT_ROOT, "app", "db_init.py"),
+    os.path.join(PROJECT_ROOT, "app", "models.py"),
+]
+
+
+def copy_database(source_path, target_path):
+    """
+    Copy a whole SQLite database page by page using the backup API.
+    The target is overwritten in place, so open connections to it see the new contents.
+    """
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(target_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+
+def take_snapshot(database_path, snapshot_path):
+    """
+    Save the database at database_path to snapshot_path.
+    """
+    copy_database(database_path, snapshot_path)
+
+
+def restore_snapshot(snapshot_path, database_path):
+    """
+    Replace the contents of the database at database_path with the snapshot.
+    """
+    if not os.path.exists(snapshot_path):
+        raise FileNotFoundError(f"Snapshot not found: {snapshot_path}")
+    copy_database(snapshot_path, database_path)
+
+
+def create_from_snapshot(snapshot_path, database_path):
+    """
+    Create the database at database_path from the snapshot, unless it already exists, and return
+    whether it was created. An existing database is never overwritten, so a worker that starts
+    (or restarts) while others are serving requests doesn't throw their writes away. The snapshot
+    is copied into a temporary file and linked into place, so when several workers start at the
+    same time only one of them creates the database.
+    """
+    if not os.path.exists(snapshot_path):
+        raise FileNotFoundError(f"Snapshot not found: {snapshot_path}")
+    if os.path.exists(database_path):
+        return False
+
+    database_dir = os.path.dirname(os.path.abspath(database_path))
+    fd, restore_path = tempfile.mkstemp(suffix=".db", dir=database_dir)
+    os.close(fd)
+    try:
+        copy_database(snapshot_path, restore_path)
+        try:
+            os.link(restore_path, database_path)
+        except FileExistsError:
+            return False
+    finally:
+        os.remove(restore_path)
+    return True
+
+
+def is_stale(snapshot_path):
+    """
+    A snapshot is stale if it doesn't exist or is older than any of the seed inputs.
+    """
+    if not os.path.exists(snapshot_path):
+        return True
+    snapshot_mtime = os.path.getmtime(snapshot_path)
+    return any(os.path.getmtime(path) > snapshot_mtime for path in SEED_INPUTS)
+
+
+def seed_snapshot(snapshot_path):
+    """
+    Seed a new database with db_init.py and save it as a snapshot, unless an up to date snapshot
+    already exists. The database is seeded into a temporary file and moved into place atomically,
+    so several processes (e.g. pytest-xdist workers) can call this at the same time.
+    """
+    if not is_stale(snapshot_path):
+        return snapshot_path
+
+    snapshot_dir = os.path.dirname(os.path.abspath(snapshot_path))
+    os.makedirs(snapshot_dir, exist_ok=True)
+    fd, seed_path = tempfile.mkstemp(suffix=".db", dir=snapshot_dir)
+    os.close(fd)
+    try:
+        subprocess.run(
+            [sys.executable, os.path.join("app", "db_init.py")],
+            cwd=PROJECT_ROOT,
+            env=dict(os.environ, SQL_APP_DB_PATH=seed_path),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        os.replace(seed_path, snapshot_path)
+    finally:
+        if os.path.exists(seed_path):
+            os.remove(seed_path)
+    return snapshot_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Save, restore or seed database snapshots.")
+    parser.add_argument("command", choices=["save", "restore", "seed"])
+    parser.add_argument("snapshot_path")
+    parser.add_argument(
+        "--database",
+        default=os.environ.get("SQL_APP_DB_PATH", "./sql_app.db"),
+        help="Path of the live database (defaults to SQL_APP_DB_PATH or ./sql_app.db)"
+    )
+    args = parser.parse_args()
+
+    if args.command == "save":
+        take_snapshot(args.database, args.snapshot_path)
+    elif args.command == "restore":
+        restore_snapshot(args.snapshot_path, args.database)
+    else:
+        seed_snapshot(args.snapshot_path)
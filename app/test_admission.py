@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+from app.admission import AdmissionController, AdmissionPolicy, controller
+from app.main import app
+
+client = TestClient(app)
+
+CHECKIN = AdmissionPolicy("checkin", priority=0, max_queue=10, max_wait=5)
+SCAN = AdmissionPolicy("scan", priority=1, max_queue=10, max_wait=5)
+HARDWARE = AdmissionPolicy("hardware", priority=3, max_queue=2, max_wait=0.05)
+
+
+def test_free_slots_go_to_higher_priority_writes_first():
+    """
+    Test that waiting check-ins get a writer slot before scans and hardware, whatever order they arrived in.
+    """
+    async def scenario():
+        admission = AdmissionController(max_concurrency=1)
+        await admission.acquire(SCAN)
+        order = []
+
+        async def write(policy):
+            await admission.acquire(policy)
+            order.append(policy.name)
+            admission.release()
+
+        tasks = [asyncio.create_task(write(policy)) for policy in (HARDWARE, SCAN, CHECKIN)]
+        await asyncio.sleep(0)  # Let every write join the queue
+        admission.release()
+        await asyncio.gather(*tasks)
+        return order, admission
+
+    order, admission = asyncio.run(scenario())
+    assert order == ["checkin", "scan", "hardware"]
+    assert admission.active == 0
+    assert admission.waiting == 0
+
+def test_writes_are_rejected_when_the_queue_is_full_or_they_wait_too_long():
+    """
+    Test that low priority writes are shed with a 503 and Retry-After, and that they leave the queue.
+    """
+    async def scenario():
+        admission = AdmissionController(max_concurrency=1)
+        await admission.acquire(CHECKIN)
+        waiting = [asyncio.create_task(admission.acquire(CHECKIN)) for _ in range(2)]
+        await asyncio.sleep(0)
+
+        with pytest.raises(HTTPException) as queue_full:
+            await admission.acquire(HARDWARE)
+        assert queue_full.value.status_code == 503
+        assert queue_full.value.headers["Retry-After"] == "1"
+
+        admission.release()
+        admission.release()
+        await asyncio.gather(*waiting)
+        # One request holds the slot and nobody is queued, so this one times out waiting
+        with pytest.raises(HTTPException):
+            await admission.acquire(HARDWARE)
+        return admission
+
+    admission = asyncio.run(scenario())
+    assert admission.waiting == 0
+    assert admission.queue_depth["hardware"] == 0
+
+def test_hardware_signout_is_shed_under_load(monkeypatch):
+    """
+    Test that a write route returns 503 with Retry-After when its queue limit is reached.
+    """
+    monkeypatch.setattr(controller, "active", controller.max_concurrency)
+    monkeypatch.setattr(controller, "waiting", 100)
+    response = client.post("/hardware/1/signout?user_id=1")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+    monkeypatch.undo()
+    assert client.post("/hardware/1/signout?user_id=1").status_code == 200
+    assert 'admission_rejections_total{route="hardware",reason="queue_full"}' in client.get("/metrics").text
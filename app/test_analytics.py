@@ -0,0 +1,116 @@
+import time
+
+from fastapi.testclient import TestClient
+
+from app.analytics import rollup
+from app.main import app
+
+client = TestClient(app)
+
+COMPANIES_URL = "/analytics/companies?limit=100000&top_skills=100"
+RATINGS_URL = "/analytics/skills/ratings"
+
+
+def rebuilt(url):
+    """
+    The response for url from a rollup built from scratch.
+    """
+    rollup.reset()
+    return client.get(url).json()
+
+def test_company_analytics():
+    """
+    Test that companies report their headcount, check-ins and most common skills, largest first.
+    """
+    response = client.get("/analytics/companies", params={"limit": 5, "top_skills": 2})
+    assert response.status_code == 200
+    companies = response.json()
+    assert len(companies) == 5
+    assert [company['headcount'] for company in companies] == sorted((company['headcount'] for company in companies), reverse=True)
+    for company in companies:
+        assert company['checked_in_ratio'] == company['checked_in'] / company['headcount']
+        assert len(company['top_skills']) <= 2
+
+def test_skill_rating_histograms():
+    """
+    Test that every skill's rating histogram adds up to its number of users.
+    """
+    skills = client.get(RATINGS_URL).json()
+    frequencies = {skill['skill_name']: skill['frequency'] for skill in client.get("/skills/").json()}
+    assert {skill['skill']: skill['users'] for skill in skills} == frequencies
+    for skill in skills:
+        assert sum(skill['ratings'].values()) == skill['users']
+        assert set(skill['ratings']) <= {"1", "2", "3", "4", "5"}
+
+def test_rollups_are_updated_incrementally_by_writes():
+    """
+    Test that after check-ins and profile updates the rollups match ones built from scratch.
+    """
+    client.get(COMPANIES_URL)
+    client.get(RATINGS_URL)
+
+    client.put("/users/1/checkin")
+    client.put("/users/2", json={"company": "A Brand New Company", "skills": [{"skill": "Swift", "rating": 5}, {"skill": "Cobol", "rating": 1}]})
+    client.put("/users/3", json={"skills": [{"skill": "Cobol", "rating": 4}]})
+    companies = client.get(COMPANIES_URL).json()
+    ratings = client.get(RATINGS_URL).json()
+
+    new_company = next(company for company in companies if company['company'] == "A Brand New Company")
+    assert new_company['headcount'] == 1
+    assert companies == rebuilt(COMPANIES_URL)
+    assert ratings == rebuilt(RATINGS_URL)
+
+def test_analytics_reads_do_not_query_once_built(query_recorder):
+    """
+    Test that once the rollup is built, analytics are served from memory.
+    """
+    client.get("/analytics/companies")
+    with query_recorder() as queries:
+        assert client.get("/analytics/companies", params={"limit": 10}).status_code == 200
+        assert client.get(RATINGS_URL).status_code == 200
+    assert queries.count == 0
+
+def test_bulk_updates_trigger_a_rebuild():
+    """
+    Test that a bulk UPDATE marks the rollup stale, and that it is rebuilt in the background.
+    """
+    from sqlalchemy import update
+    from app import models
+    from app.database import SessionLocal
+
+    before = client.get(COMPANIES_URL).json()
+    with SessionLocal() as db:
+        db.execute(update(models.User).values(checked_in=True))
+        db.commit()
+    assert rollup.stale
+
+    client.get(COMPANIES_URL)  # Served from the stale rollup while it is rebuilt
+    deadline = time.monotonic() + 10
+    while (rollup.stale or rollup.rebuilding is not None) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    after = client.get(COMPANIES_URL).json()
+    assert after != before
+    assert all(company['checked_in'] == company['headcount'] for company in after)
+
+def test_commit_during_a_rebuild_is_counted_once(monkeypatch):
+    """
+    Test that a change committed while the rollup is rebuilt, and already seen by the rebuild, isn't
+    replayed onto it again.
+    """
+    def skill_users(skill):
+        return {ratings['skill']: ratings['users'] for ratings in client.get(RATINGS_URL).json()}.get(skill)
+
+    assert skill_users("Cobol") is None
+    build = rollup.build
+
+    def build_after_a_commit(connection):
+        # Lands before the build reads anything, while the rebuild is already collecting changes
+        response = client.put("/users/1", json={"skills": [{"skill": "Cobol", "rating": 4}]})
+        assert response.status_code == 200
+        return build(connection)
+
+    monkeypatch.setattr(rollup, "build", build_after_a_commit)
+    rollup.rebuild()
+    monkeypatch.undo()
+    assert skill_users("Cobol") == 1
+    assert client.get(COMPANIES_URL).json() == rebuilt(COMPANIES_URL)
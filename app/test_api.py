@@ -1,5 +1,6 @@
 from fastapi.testclient import TestClient
 from app.main import app  # This works when test_api.py is in the same directory as main.py
+from app import schemas
 
 
 client = TestClient(app)
@@ -51,6 +52,17 @@ def test_checked_in_only_filter():
     for user in data:
         assert user['checked_in'] is True 
 
+def test_users_response_matches_schema():
+    """
+    Test that users serialized on the fast path are valid against the documented User schema.
+    """
+    response = client.get("/users?limit=1000")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    users = [schemas.User.model_validate(user) for user in response.json()]
+    assert len(users) > 100
+    assert any(user.skills for user in users)
+
 def test_get_users_invalid_limit():
     """
     Test fetching users with an invalid limit parameter.
@@ -58,6 +70,68 @@ def test_get_users_invalid_limit():
     response = client.get("/users?limit=-1")
     assert response.status_code == 400
 
+def test_get_users_with_sparse_fields():
+    """
+    Test that ?fields= only returns the requested fields and leaves out skills.
+    """
+    response = client.get("/users?limit=5&fields=name,email")
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data) == 5
+    for user in data:
+        assert set(user) == {"name", "email"}
+
+def test_get_users_with_fields_and_expanded_skills():
+    """
+    Test that ?expand=skills adds skills to a sparse fieldset.
+    """
+    response = client.get("/users?limit=5&fields=email&expand=skills")
+    assert response.status_code == 200
+    for user in response.json():
+        assert set(user) == {"email", "skills"}
+        assert isinstance(user["skills"], list)
+
+def test_sparse_responses_are_documented_as_partial():
+    """
+    Test that the OpenAPI schema of routes that take ?fields= doesn't mark any user field as required.
+    """
+    openapi = client.get("/openapi.json").json()
+    components = openapi["components"]["schemas"]
+
+    def response_schema(path):
+        schema = openapi["paths"][path]["get"]["responses"]["200"]["content"]["application/json"]["schema"]
+        return schema.get("items", schema)
+
+    def resolve(schema):
+        return components[schema["$ref"].rsplit("/", 1)[1]]
+
+    user_schemas = [
+        resolve(response_schema("/users/")),
+        resolve(response_schema("/users/{user_id}")),
+        resolve(resolve(response_schema("/users/batch"))["properties"]["user"]["anyOf"][0]),
+        resolve(resolve(response_schema("/hacker/{user_id}/dashboard"))["properties"]["user_info"]),
+    ]
+    for schema in user_schemas:
+        assert set(schema["properties"]) == {"name", "company", "email", "phone", "checked_in", "skills"}
+        assert not schema.get("required")
+
+def test_get_users_with_empty_fields():
+    """
+    Test that an empty or blank ?fields= returns a 400 instead of users without any fields.
+    """
+    for fields in ("", " ", ",, ,"):
+        response = client.get("/users", params={"fields": fields})
+        assert response.status_code == 400
+        assert response.json()["detail"] == "fields must name at least one field"
+    assert client.get("/users/1", params={"fields": ""}).status_code == 400
+
+def test_get_users_with_unknown_field():
+    """
+    Test that requesting an unknown field or expansion returns a 400.
+    """
+    assert client.get("/users?fields=name,password").status_code == 400
+    assert client.get("/users?expand=hardware").status_code == 400
+
 # `GET /users/{user_id}`
 def test_get_user_by_valid_id():
     """
@@ -90,6 +164,14 @@ def test_get_user_by_invalid_id():
     data = response.json()
     assert 'detail' in data
 
+def test_get_user_by_id_with_sparse_fields():
+    """
+    Test fetching a single user with only some fields.
+    """
+    response = client.get("/users/1?fields=name,checked_in")
+    assert response.status_code == 200
+    assert response.json() == {"name": "Breanna Dillon", "checked_in": False}
+
 def test_get_user_response_structure():
     """
     Test the structure of the response for a valid user request.
@@ -108,6 +190,41 @@ def test_get_user_response_structure():
         assert 'skill' in first_skill and 'rating' in first_skill
 
 
+# `GET /users/batch`
+def test_batch_lookup_preserves_request_order():
+    """
+    Test that batch results come back in the order the ids were requested, including repeats.
+    """
+    response = client.get("/users/batch?ids=3,1,2,1")
+    assert response.status_code == 200
+    data = response.json()
+    assert [result['user_id'] for result in data] == [3, 1, 2, 1]
+    assert data[1]['user']['name'] == "Breanna Dillon"
+    assert data[1] == data[3]
+    assert all(result['detail'] is None for result in data)
+
+def test_batch_lookup_reports_missing_ids_inline():
+    """
+    Test that missing ids are reported in place instead of failing the request.
+    """
+    response = client.get("/users/batch?ids=1,9999,2&fields=email")
+    assert response.status_code == 200
+    data = response.json()
+    assert data[0]['user'] == {"email": "lorettabrown@example.net"}
+    assert data[1]['user'] is None
+    assert "9999" in data[1]['detail']
+    assert data[2]['user'] is not None
+
+def test_batch_lookup_invalid_ids():
+    """
+    Test that malformed, empty and oversized id lists are rejected.
+    """
+    assert client.get("/users/batch?ids=1,abc").status_code == 400
+    assert client.get("/users/batch?ids=").status_code == 400
+    too_many = ",".join(str(user_id) for user_id in range(1, 5002))
+    assert client.get(f"/users/batch?ids={too_many}").status_code == 400
+
+
 # `PUT /users/{user_id}`
 def test_update_user_phone():
     """
@@ -486,6 +603,20 @@ def test_retrieve_dashboard_for_existing_user():
     assert isinstance(data['checked_in_events'], list), "Checked in events should be a list."
 
 
+def test_dashboard_with_sparse_fields_and_skills():
+    """
+    Test that ?fields= and ?expand=skills apply to the dashboard's user_info.
+    """
+    response = client.get("/hacker/1/dashboard")
+    assert "skills" not in response.json()["user_info"]
+
+    response = client.get("/hacker/1/dashboard?fields=name&expand=skills")
+    assert response.status_code == 200
+    user_info = response.json()["user_info"]
+    assert set(user_info) == {"name", "skills"}
+    assert any(skill["skill"] == "Swift" for skill in user_info["skills"])
+
+
 def test_retrieve_dashboard_for_nonexistent_user():
     """
     Test retrieving dashboard information for a nonexistent user.
@@ -510,3 +641,174 @@ def test_dashboard_content_for_user_without_events_or_hardware():
     assert data['signed_out_hardware'] == [], "Expected no signed-out hardware for the user."
     assert data['checked_in_events'] == [], "Expected no checked-in events for the user."
 
+
+# `GET /metrics`
+def test_metrics_exposes_route_latency_and_sql_counts():
+    """
+    Test that /metrics reports per-route latency histograms and SQL statement counts.
+    """
+    client.get("/users/1")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+    assert 'http_request_duration_seconds_count{method="GET",route="/users/{user_id}"}' in text
+    assert 'http_requests_total{method="GET",route="/users/{user_id}",status="200"}' in text
+    assert 'sql_statements_per_request_bucket{method="GET",route="/users/{user_id}",le="+Inf"}' in text
+    assert "# TYPE db_pool_checkout_wait_seconds histogram" in text
+    assert "# TYPE db_commit_duration_seconds histogram" in text
+
+def test_metrics_updated_from_many_threads():
+    """
+    Test that observations made from several threads at once (outside of any request) are all counted.
+    """
+    import sys
+    import threading
+    from app import metrics
+
+    histogram = metrics.HistogramFamily("test_seconds", "Test.", metrics.LATENCY_BUCKETS)
+    counter = metrics.CounterFamily("test_total", "Test.")
+
+    def observe():
+        for _ in range(20000):
+            histogram.labels().observe(0.001)
+            counter.inc()
+
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=observe) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert "test_seconds_count 80000" in list(histogram.render())
+    assert "test_total 80000" in list(counter.render())
+
+
+# Query budgets
+def test_query_count_header():
+    """
+    Test that responses report how many queries they ran in debug mode.
+    """
+    response = client.get("/users/1")
+    assert response.headers["x-query-count"] == "2"
+
+def test_read_endpoints_stay_within_query_budget(query_recorder):
+    """
+    Test that read endpoints run a fixed number of queries, however many rows they return.
+    """
+    budgets = {
+        "/users?limit=1000": 2,
+        "/users?limit=1000&fields=name,email": 1,
+        "/users/batch?ids=" + ",".join(str(user_id) for user_id in range(1, 1001)): 4,
+        "/users/1": 2,
+        "/skills": 1,
+        "/hacker/1/dashboard?expand=skills": 4,
+    }
+    for url, max_queries in budgets.items():
+        with query_recorder() as queries:
+            assert client.get(url).status_code == 200
+        queries.assert_budget(max_queries=max_queries, max_repeats=2)
+
+def test_update_user_queries_do_not_grow_with_skills(query_recorder):
+    """
+    Test that updating many skills at once doesn't run queries per skill.
+    """
+    skills = [{"skill": f"New Skill {i}", "rating": 3} for i in range(20)] + [{"skill": "Swift", "rating": 1}]
+    with query_recorder() as queries:
+        response = client.put("/users/1", json={"skills": skills})
+    assert response.status_code == 200
+    assert len(response.json()['skills']) == 22
+    queries.assert_budget(max_queries=10, max_repeats=2)
+
+def test_query_budget_middleware_catches_repeated_queries():
+    """
+    Test that a route running the same statement in a loop fails in raise mode.
+    """
+    from fastapi import FastAPI
+    from sqlalchemy import text
+    from app.database import SessionLocal
+    from app.query_budget import QueryBudgetMiddleware, query_budget
+
+    n_plus_one_app = FastAPI()
+    n_plus_one_app.add_middleware(QueryBudgetMiddleware, mode="raise", debug=True)
+
+    @n_plus_one_app.get("/loop")
+    @query_budget(max_queries=10)
+    def loop():
+        with SessionLocal() as db:
+            for user_id in range(1, 6):
+                db.execute(text("SELECT name FROM Users WHERE user_id = :user_id"), {"user_id": user_id})
+        return {"ok": True}
+
+    response = TestClient(n_plus_one_app).get("/loop")
+    assert response.status_code == 500
+    assert "possible N+1" in response.json()['detail']
+    assert response.headers["x-query-count"] == "5"
+
+def test_query_recorder_leaves_out_background_threads(query_recorder):
+    """
+    Test that statements run by background threads, such as the outbox worker polling, aren't
+    counted against the request being measured.
+    """
+    import threading
+    from sqlalchemy import text
+    from app.database import get_engine
+    from app.query_budget import mark_background_thread
+
+    def poll(background):
+        if background:
+            mark_background_thread()
+        with get_engine().connect() as connection:
+            connection.execute(text("SELECT 1"))
+
+    with query_recorder() as queries:
+        for background in (True, False):
+            thread = threading.Thread(target=poll, args=(background,))
+            thread.start()
+            thread.join()
+    assert queries.count == 1
+
+
+# User cache
+def test_user_profile_served_from_cache():
+    """
+    Test that reading the same user twice only queries the database once.
+    """
+    first = client.get("/users/1")
+    second = client.get("/users/1")
+    assert second.status_code == 200
+    assert second.json() == first.json()
+    assert second.headers["x-query-count"] == "0"
+
+def test_update_user_invalidates_cached_profile():
+    """
+    Test that a cached user is dropped once an update to it commits.
+    """
+    client.get("/users/1")
+    client.put("/users/1", json={"phone": "+1 (555) 000-0000", "skills": [{"skill": "Cobol", "rating": 2}]})
+    response = client.get("/users/1")
+    assert response.headers["x-query-count"] == "2"
+    assert response.json()['phone'] == "+1 (555) 000-0000"
+    assert {"skill": "Cobol", "rating": 2} in response.json()['skills']
+
+def test_checkin_invalidates_cached_profile():
+    """
+    Test that checking a user in drops their cached profile.
+    """
+    assert client.get("/users/1").json()['checked_in'] is False
+    client.put("/users/1/checkin")
+    assert client.get("/users/1").json()['checked_in'] is True
+
+def test_user_cache_metrics():
+    """
+    Test that cache hits and misses are reported at /metrics.
+    """
+    client.get("/users/1")
+    client.get("/users/1")
+    text = client.get("/metrics").text
+    assert 'user_cache_requests_total{result="hit"}' in text
+    assert 'user_cache_evictions_total{reason="size"}' in text
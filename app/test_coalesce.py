@@ -0,0 +1,77 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.coalesce import SingleFlight, coalesced_calls
+from app.main import app
+
+client = TestClient(app)
+
+
+def run_concurrently(flight, key, function, callers):
+    """
+    Call flight.do from several threads while the first call is still running.
+    """
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return function()
+
+    with ThreadPoolExecutor(callers) as pool:
+        leader = pool.submit(flight.do, key, slow)
+        started.wait(5)
+        followers = [pool.submit(flight.do, key, slow) for _ in range(callers - 1)]
+        # Wait until every follower has joined the call in flight
+        while coalesced_calls.values.get((flight.name, "coalesced"), 0) < callers - 1:
+            time.sleep(0.001)
+        release.set()
+        return [leader] + followers
+
+def test_identical_concurrent_calls_share_one_computation():
+    """
+    Test that calls arriving while an identical call is in flight wait for it instead of running again.
+    """
+    flight = SingleFlight("test_share")
+    runs = []
+    futures = run_concurrently(flight, ("min_frequency", 1), lambda: runs.append(1) or ["result"], callers=8)
+    assert [future.result() for future in futures] == [["result"]] * 8
+    assert len(runs) == 1
+    # Once the call is done, the next call runs again
+    assert flight.do(("min_frequency", 1), lambda: "again") == "again"
+
+def test_errors_are_shared_and_not_reused():
+    """
+    Test that waiting callers get the leader's exception, and that failures aren't remembered.
+    """
+    flight = SingleFlight("test_errors", ttl=60)
+
+    def fail():
+        raise ValueError("boom")
+
+    futures = run_concurrently(flight, (), fail, callers=3)
+    for future in futures:
+        with pytest.raises(ValueError):
+            future.result()
+    assert flight.do((), lambda: "recovered") == "recovered"
+
+def test_fresh_results_are_reused_within_ttl():
+    """
+    Test that with a freshness window, a finished result is reused for identical calls only.
+    """
+    flight = SingleFlight("test_ttl", ttl=60)
+    assert flight.do(("a",), lambda: 1) == 1
+    assert flight.do(("a",), lambda: 2) == 1
+    assert flight.do(("b",), lambda: 3) == 3
+
+def test_skill_frequencies_are_coalesced():
+    """
+    Test that /skills/ goes through the coalescing layer and reports it at /metrics.
+    """
+    assert client.get("/skills/", params={"min_frequency": 2}).status_code == 200
+    assert 'coalesced_calls_total{route="read_skill_frequencies",result="leader"}' in client.get("/metrics").text
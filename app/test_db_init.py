@@ -0,0 +1,91 @@
+import ast
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+
+from app import snapshot
+
+DB_INIT_PATH = os.path.join(snapshot.PROJECT_ROOT, "app", "db_init.py")
+
+
+def participant(name, phone, **skills):
+    return {
+        "name": name,
+        "company": "Hack Inc",
+        "email": f"{name.lower()}@example.com",
+        "phone": phone,
+        "skills": [{"skill": skill, "rating": rating} for skill, rating in skills.items()],
+    }
+
+def sync(tmp_path, participants):
+    """
+    Run db_init.py --sync on tmp_path/sync.db with the given participants, and return its counts.
+    """
+    with open(tmp_path / "HTN_2023_BE_Challenge_Data.json", "w") as file:
+        json.dump(participants, file)
+    result = subprocess.run(
+        [sys.executable, DB_INIT_PATH, "--sync"],
+        cwd=tmp_path,
+        env=dict(os.environ, SQL_APP_DB_PATH=str(tmp_path / "sync.db")),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # The last log line ends with the counts, e.g. "Sync complete: {'created': 2, ...}"
+    return ast.literal_eval(result.stderr.strip().splitlines()[-1].split(": ", 1)[1])
+
+def users(tmp_path):
+    conn = sqlite3.connect(tmp_path / "sync.db")
+    try:
+        rows = conn.execute(
+            "SELECT Users.name, Users.phone, Skills.skill_name, UserSkills.rating FROM Users "
+            "LEFT JOIN UserSkills ON UserSkills.user_id = Users.user_id "
+            "LEFT JOIN Skills ON Skills.skill_id = UserSkills.skill_id"
+        ).fetchall()
+    finally:
+        conn.close()
+    result = {}
+    for name, phone, skill, rating in rows:
+        user = result.setdefault(name, {"phone": phone, "skills": {}})
+        if skill is not None:
+            user["skills"][skill] = rating
+    return result
+
+def test_sync_creates_updates_and_leaves_unchanged_users_alone(tmp_path):
+    """
+    Test that a sync inserts new users, updates changed ones, and that running it again changes nothing.
+    """
+    data = [participant("Ada", "111", Python=4), participant("Grace", "222", Cobol=5)]
+    assert sync(tmp_path, data) == {"created": 2, "updated": 0, "unchanged": 0, "skipped": 0}
+
+    data[0]["company"] = "Engines Ltd"
+    data[1]["skills"] = [{"skill": "Cobol", "rating": 3}, {"skill": "Fortran", "rating": 2}]
+    assert sync(tmp_path, data) == {"created": 0, "updated": 2, "unchanged": 0, "skipped": 0}
+    assert users(tmp_path)["Grace"]["skills"] == {"Cobol": 3, "Fortran": 2}
+
+    assert sync(tmp_path, data) == {"created": 0, "updated": 0, "unchanged": 2, "skipped": 0}
+
+def test_sync_skips_invalid_records(tmp_path):
+    """
+    Test that duplicate records and phone numbers that belong to another user are skipped.
+    """
+    sync(tmp_path, [participant("Ada", "111"), participant("Grace", "222")])
+
+    duplicate = participant("Ada", "333")
+    counts = sync(tmp_path, [participant("Ada", "111"), duplicate, participant("Grace", "111"), participant("Linus", "222")])
+    assert counts == {"created": 0, "updated": 0, "unchanged": 1, "skipped": 3}
+    assert users(tmp_path) == {"Ada": {"phone": "111", "skills": {}}, "Grace": {"phone": "222", "skills": {}}}
+
+def test_sync_hands_phone_numbers_over(tmp_path):
+    """
+    Test that a phone number can move to another user in the same sync as its owner changes
+    number, whichever order they come in.
+    """
+    sync(tmp_path, [participant("Ada", "111"), participant("Grace", "222")])
+
+    # Grace takes Ada's number and Linus takes Grace's, listed before the users giving them up
+    counts = sync(tmp_path, [participant("Linus", "222"), participant("Grace", "111"), participant("Ada", "333")])
+    assert counts == {"created": 1, "updated": 2, "unchanged": 0, "skipped": 0}
+    assert {name: user["phone"] for name, user in users(tmp_path).items()} == {"Ada": "333", "Grace": "111", "Linus": "222"}
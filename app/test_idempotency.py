@@ -0,0 +1,110 @@
+import datetime
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import select, update
+
+from app import models
+from app.database import get_engine
+from app.idempotency import request_fingerprint, store
+from app.main import app
+
+client = TestClient(app)
+
+
+def test_retried_checkin_replays_the_first_response(query_recorder):
+    """
+    Test that retrying a check-in with the same key returns the original response without running it again.
+    """
+    headers = {"Idempotency-Key": "checkin-5"}
+    first = client.put("/users/5/checkin", headers=headers)
+    assert first.status_code == 200
+
+    with query_recorder() as queries:
+        retry = client.put("/users/5/checkin", headers=headers)
+    assert retry.status_code == 200
+    assert retry.content == first.content
+    assert retry.headers['idempotent-replayed'] == "true"
+    assert not any('"Users"' in shape for shape in queries.shapes)
+
+    # Without the key, the retry runs again and finds the user already checked in
+    assert client.put("/users/5/checkin").status_code == 400
+
+def test_key_reused_for_a_different_request():
+    """
+    Test that a key can't be reused for a different request.
+    """
+    headers = {"Idempotency-Key": "scan-1"}
+    assert client.post("/scan/?user_id=1&event_id=1", headers=headers).status_code == 200
+    response = client.post("/scan/?user_id=2&event_id=1", headers=headers)
+    assert response.status_code == 422
+    assert client.post("/hardware/1/return", headers=headers).status_code == 422
+
+def test_request_still_running():
+    """
+    Test that a retry while the first request is still storing its response is told to try again
+    later, and that a write whose response was never stored isn't run again.
+    """
+    scope = {"method": "POST", "path": "/hardware/1/signout", "query_string": b"user_id=1"}
+    with get_engine().begin() as connection:
+        assert store.claim(connection, "signout-1", request_fingerprint(scope, b""))
+
+    response = client.post("/hardware/1/signout?user_id=1", headers={"Idempotency-Key": "signout-1"})
+    assert response.status_code == 409
+    assert response.headers['retry-after'] == "1"
+
+    with get_engine().begin() as connection:
+        connection.execute(
+            update(models.IdempotencyKey).values(created_at=datetime.datetime.utcnow() - datetime.timedelta(minutes=5))
+        )
+    response = client.post("/hardware/1/signout?user_id=1", headers={"Idempotency-Key": "signout-1"})
+    assert response.status_code == 409
+    assert 'retry-after' not in response.headers
+
+def user_company(user_id):
+    with get_engine().connect() as connection:
+        return connection.execute(select(models.User.company).where(models.User.user_id == user_id)).scalar()
+
+def set_user_company(user_id, company):
+    with get_engine().begin() as connection:
+        connection.execute(update(models.User).where(models.User.user_id == user_id).values(company=company))
+
+def test_write_is_not_run_again_when_its_response_is_not_stored(monkeypatch):
+    """
+    Test that once a write has committed, a retry with its key doesn't run it again, even if the
+    response couldn't be stored.
+    """
+    headers = {"Idempotency-Key": "update-1"}
+
+    def fail(*args):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(store, "complete", fail)
+    with pytest.raises(RuntimeError):
+        client.put("/users/1", json={"company": "Retried Inc"}, headers=headers)
+    monkeypatch.undo()
+    assert user_company(1) == "Retried Inc"
+
+    set_user_company(1, "Changed Since Inc")
+    response = client.put("/users/1", json={"company": "Retried Inc"}, headers=headers)
+    assert response.status_code == 409
+    assert user_company(1) == "Changed Since Inc"
+
+def test_racing_duplicate_is_rolled_back(monkeypatch):
+    """
+    Test that of two requests with the same key that both got past the lookup, only the first
+    one's write commits, and that requests that don't write don't claim their key.
+    """
+    headers = {"Idempotency-Key": "update-2"}
+    assert client.put("/users/1", json={"company": "First Inc"}, headers=headers).status_code == 200
+    set_user_company(1, "Changed Since Inc")
+
+    # As if the duplicate had looked the key up before the first request committed
+    monkeypatch.setattr(store, "lookup", lambda key: None)
+    response = client.put("/users/1", json={"company": "First Inc"}, headers=headers)
+    assert response.status_code == 409
+    assert user_company(1) == "Changed Since Inc"
+    monkeypatch.undo()
+
+    assert client.put("/users/100000", json={"company": "Nobody Inc"}, headers={"Idempotency-Key": "update-3"}).status_code == 404
+    assert store.lookup("update-3") is None
@@ -0,0 +1,78 @@
+import math
+
+from fastapi.testclient import TestClient
+
+from app import user_changes
+from app.main import app
+
+client = TestClient(app)
+
+
+def skill_vectors():
+    """
+    {user_id: {skill: rating}} for every user, from the users endpoint.
+    """
+    users = client.get("/users/", params={"limit": 100000}).json()
+    return {user_id: {skill['skill']: skill['rating'] for skill in user['skills']} for user_id, user in enumerate(users, start=1)}
+
+def expected_scores(user_id, mode):
+    vectors = skill_vectors()
+    mine = vectors[user_id]
+    scores = {}
+    for other_id, theirs in vectors.items():
+        if other_id == user_id:
+            continue
+        if mode == "complement":
+            scores[other_id] = sum(max(rating - mine.get(skill, 0), 0) for skill, rating in theirs.items())
+        else:
+            dot = sum(rating * mine.get(skill, 0) for skill, rating in theirs.items())
+            norms = math.sqrt(sum(r * r for r in theirs.values()) * sum(r * r for r in mine.values()))
+            scores[other_id] = dot / norms if norms else 0.0
+    return scores
+
+def test_matches_are_the_top_scoring_users():
+    """
+    Test that matches are the best scoring users in each mode, best first and ties by user id.
+    """
+    for mode in ("complement", "similar"):
+        response = client.get("/users/1/matches", params={"mode": mode, "checked_in_only": False, "limit": 20})
+        assert response.status_code == 200
+        matches = response.json()
+        scores = expected_scores(1, mode)
+        expected = sorted(scores, key=lambda user_id: (-scores[user_id], user_id))[:20]
+        assert [match['user_id'] for match in matches] == expected
+        for match in matches:
+            assert math.isclose(match['score'], scores[match['user_id']])
+            assert set(match['user']) == {"name", "company", "skills"}
+
+def test_matches_only_include_checked_in_users_by_default():
+    """
+    Test that only checked in hackers are suggested unless checked_in_only=false.
+    """
+    assert client.get("/users/1/matches").json() == []
+    for user_id in (5, 6, 7):
+        client.put(f"/users/{user_id}/checkin")
+    assert sorted(match['user_id'] for match in client.get("/users/1/matches").json()) == [5, 6, 7]
+
+def test_matches_follow_profile_updates():
+    """
+    Test that updates made after the matrix was built are reflected in matches.
+    """
+    url = "/users/1/matches?checked_in_only=false&limit=50"
+    client.get(url)
+    client.put("/users/2", json={"skills": [{"skill": "Brand New Skill", "rating": 5}, {"skill": "Swift", "rating": 5}]})
+    client.put("/users/1", json={"skills": [{"skill": "Brand New Skill", "rating": 1}]})
+    updated = client.get(url).json()
+
+    user_changes.reset()
+    assert updated == client.get(url).json()
+
+def test_matches_invalid_requests():
+    """
+    Test that unknown users, modes and limits are rejected.
+    """
+    assert client.get("/users/100000/matches").status_code == 404
+    assert client.get("/users/-1/matches").status_code == 404
+    assert client.get("/users/-5000/matches").status_code == 404
+    assert client.get("/users/1/matches", params={"mode": "random"}).status_code == 400
+    assert client.get("/users/1/matches", params={"limit": 0}).status_code == 400
@@ -0,0 +1,109 @@
+import datetime
+
+from sqlalchemy import func, select, update
+
+from fastapi.testclient import TestClient
+
+from app import models, pipeline
+from app.database import SessionLocal, get_engine
+from app.main import app
+
+
+def outbox():
+    with get_engine().connect() as connection:
+        return connection.execute(
+            select(models.OutboxEvent.topic, models.OutboxEvent.attempts, models.OutboxEvent.available_at)
+            .order_by(models.OutboxEvent.id)
+        ).all()
+
+def enqueue(*events):
+    with SessionLocal() as db:
+        pipeline.enqueue(db, list(events))
+        db.commit()
+
+def test_events_only_exist_if_the_write_committed():
+    """
+    Test that events enqueued in a transaction that rolls back are never handled, and that
+    committed ones are handled and removed from the outbox.
+    """
+    pipeline.run_pending()
+    with SessionLocal() as db:
+        db.add(models.ScanEvent(user_id=1, event_id=1))
+        db.flush()
+        db.rollback()
+    assert outbox() == []
+
+    with SessionLocal() as db:
+        db.add(models.ScanEvent(user_id=1, event_id=1))
+        db.commit()
+    pipeline.run_pending()
+    assert outbox() == []
+    with get_engine().connect() as connection:
+        counted = connection.execute(
+            select(func.sum(models.ScanBucket.count)).where(models.ScanBucket.granularity == "minute")
+        ).scalar()
+    assert counted == 1
+
+def test_failing_events_are_retried_then_given_up_on(monkeypatch):
+    """
+    Test that an event whose handler keeps failing doesn't hold back the rest of its batch, is
+    retried, and stays in the outbox once it runs out of attempts.
+    """
+    handled = []
+
+    def handle(connection, payloads):
+        if any(payload.get("poison") for payload in payloads):
+            raise ValueError("poison")
+        handled.extend(payload["n"] for payload in payloads)
+
+    monkeypatch.setitem(pipeline.handlers, "test", handle)
+    monkeypatch.setattr(pipeline, "RETRY_BASE_DELAY", 0)
+    pipeline.run_pending()
+    enqueue(("test", {"n": 1}), ("test", {"poison": True}), ("test", {"n": 2}))
+
+    pipeline.run_pending()
+    assert sorted(handled) == [1, 2]
+    [(topic, attempts, available_at)] = outbox()
+    assert attempts == pipeline.MAX_ATTEMPTS
+    assert available_at is None
+
+def test_expired_lease_is_handled_again(monkeypatch):
+    """
+    Test that events claimed by a worker that never finished them are picked up once the lease runs out.
+    """
+    handled = []
+    monkeypatch.setitem(pipeline.handlers, "test", lambda connection, payloads: handled.extend(payloads))
+    # Claimed by a worker that died before handling it. The lock keeps the background thread out.
+    with pipeline.worker.lock:
+        enqueue(("test", {"n": 1}))
+        assert len(pipeline.worker.claim()) == 1
+    pipeline.run_pending()
+    assert handled == []
+
+    with get_engine().begin() as connection:
+        connection.execute(update(models.OutboxEvent).values(available_at=datetime.datetime.utcnow()))
+    pipeline.run_pending()
+    assert handled == [{"n": 1}]
+    assert outbox() == []
+
+def test_shutdown_handles_the_last_events(monkeypatch):
+    """
+    Test that events committed just before the app shuts down are handled before the worker exits.
+    """
+    pipeline.worker.stop()
+    # Long enough that only the drain on shutdown can handle the scans
+    monkeypatch.setattr(pipeline.worker, "batch_window", 60.0)
+    monkeypatch.setattr(pipeline.worker, "poll_seconds", 60.0)
+    with TestClient(app) as client:
+        for user_id in (1, 2, 3):
+            assert client.post(f"/scan/?user_id={user_id}&event_id=1").status_code == 200
+        assert len(outbox()) == 3
+
+    assert outbox() == []
+    with get_engine().connect() as connection:
+        counted = dict(connection.execute(
+            select(models.ScanBucket.granularity, func.sum(models.ScanBucket.count))
+            .where(models.ScanBucket.event_id == 1)
+            .group_by(models.ScanBucket.granularity)
+        ).all())
+    assert counted == {"minute": 3, "hour": 3}
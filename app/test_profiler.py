@@ -0,0 +1,119 @@
+import marshal
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.conftest import ADMIN_TOKEN
+from app.main import app
+from app.profiler import profiler
+
+client = TestClient(app)
+ADMIN_HEADERS = {"X-Admin-Token": ADMIN_TOKEN}
+
+
+@pytest.fixture(autouse=True)
+def stop_profiler():
+    yield
+    profiler.stop()
+
+def test_profiler_requires_admin_token():
+    """
+    Test that the profiler can't be used without the admin token.
+    """
+    assert client.get("/admin/profiler").status_code == 403
+    assert client.get("/admin/profiler", headers={"X-Admin-Token": "wrong"}).status_code == 403
+    assert client.get("/admin/profiler", headers=ADMIN_HEADERS).status_code == 200
+
+def test_profiler_rejects_unknown_routes():
+    """
+    Test that starting the profiler for a route that doesn't exist fails.
+    """
+    response = client.post("/admin/profiler", json={"routes": ["/nope"]}, headers=ADMIN_HEADERS)
+    assert response.status_code == 400
+    assert not profiler.active
+
+def test_cprofile_results_per_route():
+    """
+    Test that cProfile mode profiles the selected route only and serves its stats as a pstats file.
+    """
+    response = client.post(
+        "/admin/profiler",
+        json={"routes": ["/users/{user_id}"], "sample_rate": 1, "duration_seconds": 60, "mode": "cprofile"},
+        headers=ADMIN_HEADERS
+    )
+    assert response.status_code == 200
+    for user_id in range(1, 4):
+        assert client.get(f"/users/{user_id}").status_code == 200
+    assert client.get("/skills/").status_code == 200
+
+    status = client.get("/admin/profiler", headers=ADMIN_HEADERS).json()
+    assert status["profiled_requests"] == {"/users/{user_id}": 3}
+
+    response = client.get("/admin/profiler/results", params={"route": "/users/{user_id}", "format": "pstats"}, headers=ADMIN_HEADERS)
+    assert response.status_code == 200
+    stats = marshal.loads(response.content)
+    assert any(function_name == "read_user_by_id" for _, _, function_name in stats)
+
+    response = client.get("/admin/profiler/results", params={"route": "/skills/", "format": "pstats"}, headers=ADMIN_HEADERS)
+    assert response.status_code == 404
+
+def test_cprofile_skips_requests_while_another_is_profiled():
+    """
+    Test that cProfile mode doesn't start a second profiler for a request that arrives while
+    another one is being profiled, and runs it unprofiled instead.
+    """
+    client.post(
+        "/admin/profiler",
+        json={"routes": ["/users/{user_id}"], "sample_rate": 1, "duration_seconds": 60, "mode": "cprofile"},
+        headers=ADMIN_HEADERS
+    )
+    # Stands in for a request that is being profiled on another thread
+    with profiler.cprofile_lock:
+        assert client.get("/users/1").status_code == 200
+    assert client.get("/admin/profiler", headers=ADMIN_HEADERS).json()["profiled_requests"] == {}
+    response = client.get("/admin/profiler/results", params={"route": "/users/{user_id}", "format": "pstats"}, headers=ADMIN_HEADERS)
+    assert response.status_code == 404
+
+    assert client.get("/users/2").status_code == 200
+    assert client.get("/admin/profiler", headers=ADMIN_HEADERS).json()["profiled_requests"] == {"/users/{user_id}": 1}
+
+def test_restarting_stops_the_previous_sampler():
+    """
+    Test that starting a new sampling window while one is running leaves a single sampler thread.
+    """
+    for _ in range(3):
+        response = client.post(
+            "/admin/profiler",
+            json={"routes": ["/users/"], "sample_rate": 1, "duration_seconds": 60, "interval_ms": 0.5},
+            headers=ADMIN_HEADERS
+        )
+        assert response.status_code == 200
+    samplers = [thread for thread in threading.enumerate() if thread.name == "profiler-sampler"]
+    assert samplers == [profiler.sampler]
+
+    client.delete("/admin/profiler", headers=ADMIN_HEADERS)
+    profiler.sampler.join(1)
+    assert not profiler.sampler.is_alive()
+
+def test_sampling_results_as_collapsed_stacks():
+    """
+    Test that sampling mode collects stacks that start at the endpoint.
+    """
+    client.post(
+        "/admin/profiler",
+        json={"routes": ["/users/"], "sample_rate": 1, "duration_seconds": 60, "interval_ms": 0.5},
+        headers=ADMIN_HEADERS
+    )
+    for _ in range(20):
+        assert client.get("/users/", params={"limit": 1000}).status_code == 200
+
+    client.delete("/admin/profiler", headers=ADMIN_HEADERS)
+    response = client.get("/admin/profiler/results", params={"route": "/users/"}, headers=ADMIN_HEADERS)
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert lines
+    for line in lines:
+        stack, count = line.rsplit(" ", 1)
+        assert stack.startswith("read_users (main.py:")
+        assert int(count) > 0
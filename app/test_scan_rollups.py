@@ -0,0 +1,96 @@
+import datetime
+
+from fastapi.testclient import TestClient
+
+from app import models, pipeline, scan_rollups
+from app.database import SessionLocal, get_engine
+from app.main import app
+
+client = TestClient(app)
+
+
+def scanned_buckets(bucket="minute", **params):
+    # The buckets are counted in the background, after the writes commit
+    pipeline.run_pending()
+    response = client.get("/analytics/scans", params={"bucket": bucket, **params})
+    assert response.status_code == 200
+    return response.json()
+
+def test_scans_are_counted_into_buckets(query_recorder):
+    """
+    Test that scans show up in minute and hour buckets without reading ScanEvents.
+    """
+    for user_id in (1, 2, 3):
+        assert client.post(f"/scan/?user_id={user_id}&event_id=1").status_code == 200
+    assert client.post("/scan/?user_id=1&event_id=2").status_code == 200
+
+    with query_recorder() as queries:
+        minutes = scanned_buckets(event_id=1)
+    assert not any("ScanEvents" in shape for shape in queries.shapes)
+    assert sum(bucket['scans'] for bucket in minutes) == 3
+    assert {bucket['event_id'] for bucket in minutes} == {1}
+
+    hours = scanned_buckets("hour")
+    assert sum(bucket['scans'] for bucket in hours) == 4
+    location = hours[0]['location']
+    assert all(bucket['location'] == location for bucket in scanned_buckets("hour", location=location))
+
+    # Every scan made in this test is in the past hour or so
+    later = (datetime.datetime.utcnow() + datetime.timedelta(hours=2)).isoformat()
+    assert scanned_buckets("hour", **{"from": later}) == []
+    assert sum(bucket['scans'] for bucket in scanned_buckets("hour", to=later)) == 4
+
+def test_backfill_matches_buckets_maintained_on_write():
+    """
+    Test that rebuilding the buckets from ScanEvents gives the buckets the writes made.
+    """
+    with SessionLocal() as db:
+        db.add_all([
+            models.ScanEvent(user_id=4, event_id=1, created_at=datetime.datetime(2024, 9, 14, 10, 5, 30)),
+            models.ScanEvent(user_id=5, event_id=1, created_at=datetime.datetime(2024, 9, 14, 10, 5, 59)),
+            models.ScanEvent(user_id=6, event_id=1, created_at=datetime.datetime(2024, 9, 14, 10, 50)),
+        ])
+        db.commit()
+    client.post("/scan/?user_id=7&event_id=3")
+    on_write = {bucket: scanned_buckets(bucket) for bucket in scan_rollups.GRANULARITIES}
+
+    with get_engine().begin() as connection:
+        scan_rollups.backfill(connection)
+    assert {bucket: scanned_buckets(bucket) for bucket in scan_rollups.GRANULARITIES} == on_write
+
+    minutes = scanned_buckets(**{"from": "2024-09-14T10:00:00", "to": "2024-09-14T11:00:00"})
+    assert [(bucket['bucket_start'], bucket['scans']) for bucket in minutes] == [
+        ("2024-09-14T10:05:00", 2),
+        ("2024-09-14T10:50:00", 1),
+    ]
+
+def test_checkin_arrival_curve():
+    """
+    Test that check-ins are counted once each, with a running total.
+    """
+    assert client.get("/analytics/checkins").json() == []
+    for user_id in (1, 2):
+        assert client.put(f"/users/{user_id}/checkin").status_code == 200
+    assert client.put("/users/1/checkin").status_code == 400
+
+    pipeline.run_pending()
+    curve = client.get("/analytics/checkins", params={"bucket": "hour"}).json()
+    assert sum(bucket['checkins'] for bucket in curve) == 2
+    assert curve[-1]['total'] == 2
+
+    # Check-ins before the range still count towards the total
+    with get_engine().begin() as connection:
+        scan_rollups.upsert(connection, models.CheckinBucket, [
+            {"granularity": "hour", "bucket_start": datetime.datetime(2024, 9, 13, 17), "count": 5},
+            {"granularity": "hour", "bucket_start": datetime.datetime(2024, 9, 13, 18), "count": 3},
+        ])
+    curve = client.get("/analytics/checkins", params={"bucket": "hour", "from": "2024-09-13T18:00:00"}).json()
+    assert curve[0] == {"bucket_start": "2024-09-13T18:00:00", "checkins": 3, "total": 8}
+    assert curve[-1]['total'] == 10
+
+def test_unknown_bucket_size():
+    """
+    Test that only minute and hour buckets are accepted.
+    """
+    assert client.get("/analytics/scans?bucket=day").status_code == 400
+    assert client.get("/analytics/checkins?bucket=day").status_code == 400
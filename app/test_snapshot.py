@@ -0,0 +1,70 @@
+import os
+import sqlite3
+
+from app import snapshot
+
+
+def test_snapshot_round_trip(tmp_path, fresh_db):
+    """
+    Test that restoring a snapshot undoes changes made after it was taken.
+    """
+    snapshot_path = str(tmp_path / "snapshot.db")
+    snapshot.take_snapshot(fresh_db, snapshot_path)
+
+    conn = sqlite3.connect(fresh_db)
+    conn.execute("UPDATE Users SET checked_in = 1")
+    conn.commit()
+
+    snapshot.restore_snapshot(snapshot_path, fresh_db)
+    checked_in = conn.execute("SELECT COUNT(*) FROM Users WHERE checked_in = 1").fetchone()[0]
+    conn.close()
+    assert checked_in == 0
+
+def test_restore_missing_snapshot(tmp_path, fresh_db):
+    """
+    Test that restoring a snapshot that doesn't exist fails without touching the database.
+    """
+    missing_path = str(tmp_path / "missing.db")
+    try:
+        snapshot.restore_snapshot(missing_path, fresh_db)
+        assert False, "Expected FileNotFoundError"
+    except FileNotFoundError:
+        pass
+    assert not os.path.exists(missing_path)
+
+def test_snapshot_only_creates_missing_databases(tmp_path, fresh_db):
+    """
+    Test that starting from a snapshot creates a missing database but never overwrites an existing one.
+    """
+    snapshot_path = str(tmp_path / "snapshot.db")
+    snapshot.take_snapshot(fresh_db, snapshot_path)
+    conn = sqlite3.connect(fresh_db)
+    conn.execute("UPDATE Users SET checked_in = 1")
+    conn.commit()
+    conn.close()
+
+    assert not snapshot.create_from_snapshot(snapshot_path, fresh_db)
+    conn = sqlite3.connect(fresh_db)
+    assert conn.execute("SELECT COUNT(*) FROM Users WHERE checked_in = 0").fetchone()[0] == 0
+    conn.close()
+
+    new_db = str(tmp_path / "new.db")
+    assert snapshot.create_from_snapshot(snapshot_path, new_db)
+    conn = sqlite3.connect(new_db)
+    assert conn.execute("SELECT COUNT(*) FROM Users WHERE checked_in = 1").fetchone()[0] == 0
+    conn.close()
+    assert sorted(os.listdir(tmp_path)) == ["new.db", "snapshot.db"]
+
+def test_snapshot_staleness(tmp_path):
+    """
+    Test that a snapshot older than the seed inputs is rebuilt.
+    """
+    snapshot_path = str(tmp_path / "seed.db")
+    assert snapshot.is_stale(snapshot_path)
+
+    open(snapshot_path, "w").close()
+    os.utime(snapshot_path, (0, 0))
+    assert snapshot.is_stale(snapshot_path)
+
+    os.utime(snapshot_path, None)
+    assert not snapshot.is_stale(snapshot_path)
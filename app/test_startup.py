@@ -0,0 +1,29 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from app import analytics, database, matching, pipeline
+from app.main import app
+
+
+def test_startup_warms_up_the_pool_and_preloads_views(monkeypatch):
+    """
+    Test that the lifespan startup fills the connection pool and builds the views listed in SQL_APP_PRELOAD.
+    """
+    monkeypatch.setattr(database, "PRELOAD", ["analytics", "matching"])
+    with TestClient(app) as client:
+        assert analytics.rollup.built
+        assert matching.matrix.built
+        pool = database.get_engine().pool
+        # The lock waits for the outbox worker to give back the connection it polls with
+        with pipeline.worker.lock:
+            assert pool.checkedin() == pool.size()
+        assert client.get("/users/1").status_code == 200
+
+def test_unknown_preloaded_view(monkeypatch):
+    """
+    Test that a typo in SQL_APP_PRELOAD stops the app from starting rather than being ignored.
+    """
+    monkeypatch.setattr(database, "PRELOAD", ["search"])
+    with pytest.raises(ValueError):
+        with TestClient(app):
+            pass
@@ -0,0 +1,95 @@
+import sqlite3
+
+from app.user_cache import DataVersionWatcher, UserCache
+
+
+def test_least_recently_used_entry_is_evicted():
+    """
+    Test that the cache stays within its size by dropping the least recently used user.
+    """
+    cache = UserCache(maxsize=2, ttl=60)
+    cache.put(1, b"one", cache.generation)
+    cache.put(2, b"two", cache.generation)
+    assert cache.get(1) == b"one"
+    cache.put(3, b"three", cache.generation)
+    assert cache.get(2) is None
+    assert cache.get(1) == b"one"
+    assert cache.evictions["size"] == 1
+
+def test_expired_entries_are_not_served():
+    """
+    Test that entries older than the TTL count as misses.
+    """
+    cache = UserCache(maxsize=10, ttl=0)
+    cache.put(1, b"one", cache.generation)
+    assert cache.get(1) is None
+    assert cache.evictions["ttl"] == 1
+
+def test_payload_loaded_before_an_invalidation_is_not_cached():
+    """
+    Test that a payload loaded while a write commits isn't cached after the write invalidated it.
+    """
+    cache = UserCache(maxsize=10, ttl=60)
+
+    def load():
+        cache.invalidate([1])  # A write commits while the user is being loaded
+        return b"stale"
+
+    assert cache.get_or_load(1, load) == b"stale"
+    assert cache.get(1) is None
+
+def test_changes_from_other_workers_drop_only_those_users(fresh_db):
+    """
+    Test that a write from another process (here, another connection) drops just the users it
+    logged, and that commits that don't change users keep the cache.
+    """
+    cache = UserCache(maxsize=10, ttl=60)
+    cache.watcher = DataVersionWatcher(fresh_db)
+    cache.put(1, b"one", cache.generation)
+    cache.put(2, b"two", cache.generation)
+
+    with sqlite3.connect(fresh_db) as connection:
+        connection.execute('INSERT INTO "ScanEvents" (user_id, event_id) VALUES (3, 1)')
+    assert cache.get(1) == b"one"
+
+    with sqlite3.connect(fresh_db) as connection:
+        connection.execute('UPDATE "Users" SET phone = ? WHERE user_id = 1', ("555",))
+        connection.execute('INSERT INTO "UserChanges" (user_id) VALUES (1)')
+    assert cache.get(1) is None
+    assert cache.get(2) == b"two"
+
+    # A bulk change, as db_init.py --sync logs
+    with sqlite3.connect(fresh_db) as connection:
+        connection.execute('INSERT INTO "UserChanges" (user_id) VALUES (NULL)')
+    assert cache.get(2) is None
+
+def test_writes_are_logged_for_other_workers(monkeypatch):
+    """
+    Test that with the data_version watch on, the users a write changed are logged for the other workers.
+    """
+    from fastapi.testclient import TestClient
+    from sqlalchemy import select
+    from app import models, user_cache
+    from app.database import get_engine
+    from app.main import app
+
+    monkeypatch.setattr(user_cache, "log_changes", True)
+    assert TestClient(app).put("/users/3", json={"company": "Logged Inc"}).status_code == 200
+    with get_engine().connect() as connection:
+        assert connection.execute(select(models.UserChange.user_id)).scalars().all() == [3]
+
+def test_bulk_update_clears_the_cache():
+    """
+    Test that a bulk UPDATE, which doesn't say which users it changed, clears the whole cache.
+    """
+    from sqlalchemy import update
+    from app import models
+    from app.database import SessionLocal
+    from app.user_cache import user_cache
+
+    user_cache.put(1, b"one", user_cache.generation)
+    with SessionLocal() as db:
+        db.execute(update(models.User).where(models.User.company == "Nobody").values(checked_in=True))
+        assert user_cache.get(1) == b"one"  # Nothing is dropped until the commit
+        db.commit()
+    assert user_cache.get(1) is None
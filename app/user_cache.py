@@ -0,0 +1,257 @@
+"""
+In-process cache of serialized GET /users/{user_id} responses.
+
+Profiles rarely change during the event, so the full response (every field and skills) is cached
+as JSON bytes per user in a bounded LRU with a TTL. Requests with ?fields= or ?expand= always go to
+the database.
+
+Entries are invalidated after commit by session events: users (and their skills) changed by a
+flush are dropped, and a bulk UPDATE/DELETE on Users or UserSkills clears the whole cache, since
+the affected ids aren't known. With several uvicorn workers, writes in other processes are caught
+by watching SQLite's PRAGMA data_version from a dedicated connection. It changes whenever another
+connection commits, including this process's own pool and every scan or check-in, so it only says
+when to look: every transaction that changes users also logs their ids in the UserChanges table
+(None for a bulk change), and the watcher drops just the users logged since it last looked.
+Writers outside the app have to log their changes too, as db_init.py --sync does; anything else
+is only picked up when the TTL runs out. Configured with environment variables:
+
+    SQL_APP_USER_CACHE_SIZE          maximum number of cached users, 0 disables the cache (10000)
+    SQL_APP_USER_CACHE_TTL           seconds an entry is served for (60)
+    SQL_APP_USER_CACHE_DATA_VERSION  set to 1 on every worker to log changes and watch them (off by default)
+    SQL_APP_USER_CACHE_POLL_MS       check data_version at most this often (0, on every lookup)
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import delete, event, func, insert, select
+
+from . import metrics, models
+
+USER_CACHE_SIZE = int(os.environ.get("SQL_APP_USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.environ.get("SQL_APP_USER_CACHE_TTL", "60"))
+WATCH_DATA_VERSION = os.environ.get("SQL_APP_USER_CACHE_DATA_VERSION", "") not in ("", "0", "false")
+DATA_VERSION_POLL_SECONDS = float(os.environ.get("SQL_APP_USER_CACHE_POLL_MS", "0")) / 1000
+
+# Tables whose rows end up in a cached user
+CACHED_TABLES = {models.User.__tablename__, models.UserSkill.__tablename__}
+
+# UserChanges keeps about this many rows. A worker that falls further behind clears its cache.
+MAX_LOGGED_CHANGES = 10000
+PRUNE_EVERY = 1000  # Logged transactions between prunes, per process
+
+
+class DataVersionWatcher:
+    """
+    Tells which users other connections (in this process or another one) changed.
+    """
+    def __init__(self, path, poll_seconds=0.0):
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        self.poll_seconds = poll_seconds
+        self.checked_at = time.monotonic()
+        self.version = self.read()
+        self.seq = self.connection.execute('SELECT MAX(seq) FROM "UserChanges"').fetchone()[0] or 0
+
+    def read(self):
+        return self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def changed_users(self):
+        """
+        The ids of the users changed since the last call, or ALL_USERS.
+        """
+        now = time.monotonic()
+        if now - self.checked_at < self.poll_seconds:
+            return set()
+        with self.lock:
+            self.checked_at = now
+            version = self.read()
+            if version == self.version:
+                return set()
+            self.version = version
+            oldest = self.connection.execute('SELECT MIN(seq) FROM "UserChanges"').fetchone()[0]
+            rows = self.connection.execute(
+                'SELECT seq, user_id FROM "UserChanges" WHERE seq > ? ORDER BY seq', (self.seq,)
+            ).fetchall()
+            if not rows:
+                return set()
+            # Rows this worker never saw were pruned already
+            pruned = oldest > self.seq + 1
+            self.seq = rows[-1][0]
+        user_ids = {user_id for _, user_id in rows}
+        return ALL_USERS if pruned or None in user_ids else user_ids
+
+
+class UserCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # user_id -> (expires_at, payload), least recently used first
+        self.lock = threading.Lock()
+        self.watcher = None
+        # Bumped by every invalidation, so a payload loaded before a write isn't cached after it
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = {"size": 0, "ttl": 0}
+        self.invalidations = 0
+
+    def get(self, user_id):
+        if self.maxsize <= 0:
+            return None
+        if self.watcher is not None:
+            changed = self.watcher.changed_users()
+            if changed == ALL_USERS:
+                self.clear()
+            elif changed:
+                self.invalidate(changed)
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self.entries.move_to_end(user_id)
+                    self.hits += 1
+                    return entry[1]
+                del self.entries[user_id]
+                self.evictions["ttl"] += 1
+            self.misses += 1
+            return None
+
+    def put(self, user_id, payload, generation):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[user_id] = (time.monotonic() + self.ttl, payload)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions["size"] += 1
+
+    def get_or_load(self, user_id, load):
+        """
+        The cached payload of a user, or load() (JSON bytes, or None if there is no such user).
+        """
+        payload = self.get(user_id)
+        if payload is None:
+            generation = self.generation
+            payload = load()
+            if payload is not None:
+                self.put(user_id, payload, generation)
+        return payload
+
+    def invalidate(self, user_ids):
+        with self.lock:
+            self.generation += 1
+            for user_id in user_ids:
+                if self.entries.pop(user_id, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+
+    def collect_metrics(self):
+        yield "# HELP user_cache_requests_total User cache lookups by result"
+        yield "# TYPE user_cache_requests_total counter"
+        yield f'user_cache_requests_total{{result="hit"}} {self.hits}'
+        yield f'user_cache_requests_total{{result="miss"}} {self.misses}'
+        yield "# HELP user_cache_evictions_total Entries dropped to stay within the size limit, or because they expired"
+        yield "# TYPE user_cache_evictions_total counter"
+        for reason, count in self.evictions.items():
+            yield f'user_cache_evictions_total{{reason="{reason}"}} {count}'
+        yield "# HELP user_cache_invalidations_total Entries dropped because the user changed"
+        yield "# TYPE user_cache_invalidations_total counter"
+        yield f"user_cache_invalidations_total {self.invalidations}"
+        yield "# HELP user_cache_entries Users currently cached"
+        yield "# TYPE user_cache_entries gauge"
+        yield f"user_cache_entries {len(self.entries)}"
+
+
+# session.info key of the users changed in the current transaction, or ALL_USERS
+CHANGED_USERS = "user_cache_changed_users"
+ALL_USERS = "all"
+
+user_cache = UserCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+metrics.register_collector(user_cache.collect_metrics)
+
+# Whether this process logs its changes to UserChanges for the other workers
+log_changes = False
+_logged = 0
+
+
+def log_user_changes(connection, user_ids):
+    """
+    Log changed users (or None, for any user) in the connection's transaction.
+    """
+    global _logged
+    connection.execute(insert(models.UserChange), [{"user_id": user_id} for user_id in user_ids])
+    _logged += 1
+    if _logged % PRUNE_EVERY == 0:
+        newest = select(func.max(models.UserChange.seq)).scalar_subquery()
+        connection.execute(delete(models.UserChange).where(models.UserChange.seq <= newest - MAX_LOGGED_CHANGES))
+
+
+def _mark_changed(session, user_ids):
+    changed = session.info.setdefault(CHANGED_USERS, set())
+    if changed != ALL_USERS:
+        if user_ids == ALL_USERS:
+            session.info[CHANGED_USERS] = ALL_USERS
+        else:
+            changed.update(user_ids)
+
+
+def _after_flush(session, flush_context):
+    user_ids = {
+        instance.user_id
+        for instance in (*session.new, *session.dirty, *session.deleted)
+        if isinstance(instance, (models.User, models.UserSkill))
+    }
+    if user_ids:
+        _mark_changed(session, user_ids)
+        if log_changes:
+            log_user_changes(session.connection(), sorted(user_ids))
+
+
+def _do_orm_execute(orm_execute_state):
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert):
+        return
+    table = getattr(orm_execute_state.statement, "table", None)
+    if table is not None and table.name in CACHED_TABLES:
+        # Bulk statements don't say which users they touched
+        _mark_changed(orm_execute_state.session, ALL_USERS)
+        if log_changes:
+            log_user_changes(orm_execute_state.session.connection(), [None])
+
+
+def _after_commit(session):
+    changed = session.info.pop(CHANGED_USERS, None)
+    if changed == ALL_USERS:
+        user_cache.clear()
+    elif changed:
+        user_cache.invalidate(changed)
+
+
+def _after_rollback(session):
+    session.info.pop(CHANGED_USERS, None)
+
+
+def instrument(engine, session_factory):
+    """
+    Invalidate cached users when sessions from session_factory commit changes to them, and log
+    and watch changes made by other workers if SQL_APP_USER_CACHE_DATA_VERSION is set.
+    """
+    global log_changes
+    event.listen(session_factory, "after_flush", _after_flush)
+    event.listen(session_factory, "do_orm_execute", _do_orm_execute)
+    event.listen(session_factory, "after_commit", _after_commit)
+    event.listen(session_factory, "after_rollback", _after_rollback)
+    # Logged even with the cache off here, since other workers may be caching
+    log_changes = WATCH_DATA_VERSION
+    if WATCH_DATA_VERSION and USER_CACHE_SIZE > 0:
+        user_cache.watcher = DataVersionWatcher(engine.url.database, DATA_VERSION_POLL_SECONDS)
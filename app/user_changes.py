@@ -0,0 +1,300 @@
+"""
+In-memory views derived from users and their skills, kept up to date from committed changes.
+
+A view (the analytics rollup, the matching skill matrix) is built on first use from the database,
+and then updated incrementally instead of being rebuilt. Session events take a before image of
+the users a flush is about to change (their company, check-in and skill ratings) and an after
+image once it has run. When the transaction commits, every view gets both images and replaces
+the contribution of those users. Nothing is done for writes while no view has been built yet.
+
+Bulk UPDATE/DELETE/INSERT statements on Users or UserSkills, which don't say which users they
+changed, mark the views stale instead. So does a commit that raced with a view's first build. A
+stale view keeps being served while it is rebuilt in a background thread, and changes committed
+during a rebuild are replayed onto the new view before it is swapped in.
+
+A commit can land while a rebuild is reading, and its after_commit hook can run before or after the
+rebuild's reads, so the rebuild can't tell from the order of events whether it already saw the
+change. Every transaction that changes users while a view is built bumps the UserChangeSequence
+row, and its deltas carry the new value. A build reads the row in the same read transaction as
+everything else, and deltas with a sequence number up to that value are skipped, since the build
+already counted them.
+
+Other processes (more uvicorn workers, db_init.py --sync) aren't seen by the session events, so
+views can be given a max_age in seconds after which they are rebuilt.
+"""
+import threading
+import time
+
+from contextlib import contextmanager
+
+from sqlalchemy import event, select
+from sqlalchemy.dialects.sqlite import insert
+
+from . import models, query_budget
+
+# Tables whose rows end up in the images
+IMAGE_TABLES = {models.User.__tablename__, models.UserSkill.__tablename__}
+
+# Serialized responses kept per view and combination of query parameters
+MAX_CACHED_PAYLOADS = 256
+
+
+def user_images(connection, user_ids):
+    """
+    {user_id: (company, checked_in, {skill_id: (skill_name, rating)})} for the given users.
+    """
+    query = (
+        select(
+            models.User.user_id,
+            models.User.company,
+            models.User.checked_in,
+            models.UserSkill.skill_id,
+            models.Skill.skill_name,
+            models.UserSkill.rating
+        )
+        .outerjoin(models.UserSkill, models.UserSkill.user_id == models.User.user_id)
+        .outerjoin(models.Skill, models.Skill.skill_id == models.UserSkill.skill_id)
+        .where(models.User.user_id.in_(user_ids))
+    )
+    images = {}
+    for user_id, company, checked_in, skill_id, skill_name, rating in connection.execute(query):
+        image = images.get(user_id)
+        if image is None:
+            image = images[user_id] = (company, int(bool(checked_in)), {})
+        if skill_id is not None:
+            image[2][skill_id] = (skill_name, rating)
+    return images
+
+
+def next_sequence(connection):
+    table = models.UserChangeSequence
+    statement = insert(table).values(id=1, seq=1)
+    statement = statement.on_conflict_do_update(index_elements=[table.id], set_={"seq": table.seq + 1})
+    return connection.execute(statement.returning(table.seq)).scalar()
+
+
+def current_sequence(connection):
+    return connection.execute(select(models.UserChangeSequence.seq)).scalar() or 0
+
+
+@contextmanager
+def read_transaction(connection):
+    """
+    Run the block's reads from one snapshot of the database. pysqlite only opens a transaction
+    before a write, so without this every statement of a build would see the commits made
+    before it ran.
+    """
+    driver_connection = connection.connection.driver_connection
+    if driver_connection.in_transaction:
+        yield
+        return
+    driver_connection.execute("BEGIN")
+    try:
+        yield
+    finally:
+        driver_connection.commit()
+
+
+class IncrementalView:
+    """
+    The current state of a view, and the bookkeeping to keep it up to date from any thread.
+    build(connection) returns a new state, and state.apply(before, after) updates it.
+    The state is as of sequence number self.seq, see the module docstring.
+    """
+    def __init__(self, name, build, max_age=0.0):
+        self.name = name
+        self.build = build
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.engine = None
+        self.reset()
+
+    def reset(self):
+        self.current = None
+        self.seq = 0
+        self.built_at = None
+        self.stale = False
+        self.version = 0  # Bumped by every change, so responses can be cached per version
+        self.rebuilding = None  # (seq, before, after) deltas committed while a rebuild is running, or None
+        self.build_lock = threading.Lock()
+        self.payloads = {}  # key -> (version, serialized response)
+
+    @property
+    def built(self):
+        return self.current is not None
+
+    def get(self, connection=None):
+        """
+        The state, built on first use. Stale (or, with a max_age, old) states are served while a
+        background thread rebuilds them.
+        """
+        if self.current is None:
+            with self.build_lock:
+                if self.current is None:
+                    self.rebuild(connection)
+        elif self.needs_rebuild() and self.rebuilding is None:
+            threading.Thread(target=self.rebuild_in_background, name=f"{self.name}-rebuild", daemon=True).start()
+        return self.current
+
+    def read(self, function, connection=None):
+        """
+        Call function(state) with the lock held, since commits in other threads change the state.
+        """
+        self.get(connection)
+        with self.lock:
+            return function(self.current)
+
+    def payload(self, key, render, connection=None):
+        """
+        render(state) for the current state, reusing the last result until the state changes.
+        """
+        self.get(connection)
+        with self.lock:
+            cached = self.payloads.get(key)
+            if cached is not None and cached[0] == self.version:
+                return cached[1]
+            payload = render(self.current)
+            if len(self.payloads) >= MAX_CACHED_PAYLOADS:
+                self.payloads.clear()
+            self.payloads[key] = (self.version, payload)
+            return payload
+
+    def needs_rebuild(self):
+        if self.stale:
+            return True
+        return self.max_age > 0 and time.monotonic() - self.built_at > self.max_age
+
+    def rebuild_in_background(self):
+        query_budget.mark_background_thread()
+        if self.build_lock.acquire(blocking=False):
+            try:
+                self.rebuild()
+            finally:
+                self.build_lock.release()
+
+    def rebuild(self, connection=None):
+        with self.lock:
+            self.rebuilding = []
+            self.stale = False
+        try:
+            if connection is not None:
+                seq, state = self.build_snapshot(connection)
+            else:
+                with self.engine.connect() as own_connection:
+                    seq, state = self.build_snapshot(own_connection)
+        except Exception:
+            with self.lock:
+                self.rebuilding = None
+                self.stale = True
+            raise
+        with self.lock:
+            for delta_seq, before, after in self.rebuilding:
+                if delta_seq > seq:
+                    state.apply(before, after)
+            self.rebuilding = None
+            self.current = state
+            self.seq = seq
+            self.built_at = time.monotonic()
+            self.version += 1
+
+    def build_snapshot(self, connection):
+        with read_transaction(connection):
+            state = self.build(connection)
+            return current_sequence(connection), state
+
+    def apply(self, seq, before, after):
+        with self.lock:
+            if self.rebuilding is not None:
+                self.rebuilding.append((seq, before, after))
+            # Already counted by the build, if its hook ran late
+            if self.current is None or seq <= self.seq:
+                return
+            self.current.apply(before, after)
+            self.version += 1
+
+    def mark_stale(self):
+        with self.lock:
+            self.stale = True
+
+
+views = []
+
+
+def register(view):
+    views.append(view)
+    return view
+
+
+# session.info keys for the changes of the current transaction
+DELTAS = "user_changes_deltas"
+BEFORE = "user_changes_before"
+STALE = "user_changes_stale"
+
+
+def changed_user_ids(session):
+    return {
+        instance.user_id
+        for instance in (*session.new, *session.dirty, *session.deleted)
+        if isinstance(instance, (models.User, models.UserSkill)) and instance.user_id is not None
+    }
+
+
+def _before_flush(session, flush_context, instances):
+    user_ids = changed_user_ids(session)
+    if not user_ids and not any(isinstance(instance, models.User) for instance in session.new):
+        return
+    built = [view for view in views if view.built]
+    # If a view's first build finishes before this transaction commits, it may have missed it
+    session.info.setdefault(STALE, set()).update(view for view in views if not view.built)
+    if built:
+        session.info[BEFORE] = (built, user_images(session.connection(), user_ids))
+
+
+def _after_flush(session, flush_context):
+    built, before = session.info.pop(BEFORE, (None, None))
+    if built is None:
+        return
+    # New users have their ids now
+    connection = session.connection()
+    after = user_images(connection, changed_user_ids(session) | set(before))
+    session.info.setdefault(DELTAS, []).append((built, next_sequence(connection), before, after))
+
+
+def _do_orm_execute(orm_execute_state):
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert):
+        return
+    table = getattr(orm_execute_state.statement, "table", None)
+    if table is not None and table.name in IMAGE_TABLES:
+        orm_execute_state.session.info.setdefault(STALE, set()).update(views)
+
+
+def _after_commit(session):
+    for built, seq, before, after in session.info.pop(DELTAS, ()):
+        for view in built:
+            view.apply(seq, before, after)
+    for view in session.info.pop(STALE, ()):
+        if view.built:
+            view.mark_stale()
+
+
+def _after_rollback(session):
+    for key in (DELTAS, BEFORE, STALE):
+        session.info.pop(key, None)
+
+
+def instrument(engine, session_factory):
+    """
+    Keep the registered views up to date with commits made through sessions from session_factory.
+    """
+    for view in views:
+        view.engine = engine
+    event.listen(session_factory, "before_flush", _before_flush)
+    event.listen(session_factory, "after_flush", _after_flush)
+    event.listen(session_factory, "do_orm_execute", _do_orm_execute)
+    event.listen(session_factory, "after_commit", _after_commit)
+    event.listen(session_factory, "after_rollback", _after_rollback)
+
+
+def reset():
+    for view in views:
+        view.reset()
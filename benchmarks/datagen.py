@@ -0,0 +1,150 @@
+"""
+Seeded generator for synthetic event-scale datasets.
+
+Writes a fresh SQLite database with the app's schema and the given number of users, plus skills,
+events, scans and hardware in proportion. The same size and seed always produce the same database,
+so benchmark runs can be compared with each other.
+
+Usage:
+    python -m benchmarks.datagen /tmp/bench_100k.db --users 100000 --seed 1
+"""
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import time
+
+from sqlalchemy import create_engine
+
+from app import models, scan_rollups
+
+BASE_SKILLS = [
+    "Python", "JavaScript", "TypeScript", "Go", "Rust", "Java", "Kotlin", "Swift", "C", "C++", "C#",
+    "Ruby", "PHP", "Julia", "Haskell", "Elixir", "Scala", "R", "SQL", "React", "Vue", "Svelte",
+    "Angular", "Flutter", "Django", "Flask", "FastAPI", "Rails", "Spring", "Node.js", "Docker",
+    "Kubernetes", "AWS", "GCP", "Azure", "TensorFlow", "PyTorch", "OpenCV", "Unity", "Unreal Engine",
+]
+LOCATIONS = ["MC 2025", "MC 4020", "Auditorium A", "Auditorium B", "E7 Hall", "DC 1350", "STC 0010", "RCH 301"]
+
+# Start of the synthetic event weekend
+EVENT_START = datetime.datetime(2024, 9, 13, 17, 0)
+
+
+def generate(path, users=10_000, seed=0, skills=400, events=None, hardware=None, scan_rate=0.3, batch_size=50_000):
+    """
+    Generate a dataset at path, replacing any existing file. Returns a summary of row counts.
+    """
+    rng = random.Random(seed)
+    events = events if events is not None else max(15, users // 2000)
+    hardware = hardware if hardware is not None else max(50, users // 20)
+
+    if os.path.exists(path):
+        os.remove(path)
+    engine = create_engine(f"sqlite:///{path}")
+    models.Base.metadata.create_all(bind=engine)
+    engine.dispose()
+
+    conn = sqlite3.connect(path)
+    # Nothing needs to survive a crash while generating, so skip the journal and fsyncs
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+
+    skill_names = BASE_SKILLS + [f"Skill {i}" for i in range(max(0, skills - len(BASE_SKILLS)))]
+    skill_names = skill_names[:skills]
+    conn.executemany(
+        'INSERT INTO "Skills" (skill_id, skill_name) VALUES (?, ?)',
+        enumerate(skill_names, start=1)
+    )
+
+    event_rows = []
+    for event_id in range(1, events + 1):
+        start = EVENT_START + datetime.timedelta(minutes=30 * rng.randrange(0, 72))
+        end = start + datetime.timedelta(minutes=rng.choice([30, 60, 90, 120]))
+        event_rows.append((event_id, f"Workshop {event_id}", start, end, f"Synthetic workshop {event_id}", rng.choice(LOCATIONS)))
+    conn.executemany(
+        'INSERT INTO "Events" (event_id, name, start_time, end_time, description, location) VALUES (?, ?, ?, ?, ?, ?)',
+        [(row[0], row[1], row[2].isoformat(" "), row[3].isoformat(" "), row[4], row[5]) for row in event_rows]
+    )
+
+    companies = max(10, users // 25)
+    # Skill popularity is skewed like real data: a few skills are far more common than the rest
+    skill_weights = [1 / (rank + 1) ** 0.8 for rank in range(len(skill_names))]
+    scan_count = 0
+    for start in range(1, users + 1, batch_size):
+        stop = min(users + 1, start + batch_size)
+        user_rows = []
+        user_skill_rows = []
+        scan_rows = []
+        for user_id in range(start, stop):
+            user_rows.append((
+                user_id,
+                f"Hacker {user_id}",
+                f"Company {rng.randrange(companies)}",
+                f"hacker{user_id}@example.com",
+                f"555-{user_id:08d}",
+                0,
+            ))
+            for skill_id in set(rng.choices(range(1, len(skill_names) + 1), weights=skill_weights, k=rng.randint(1, 6))):
+                user_skill_rows.append((user_id, skill_id, rng.randint(1, 5)))
+            # Event 1 is left without scans for the workshop scan burst scenario
+            if rng.random() < scan_rate:
+                event = rng.choice(event_rows[1:])
+                scanned_at = event[2] + datetime.timedelta(seconds=rng.randrange(0, 1800))
+                scan_rows.append((user_id, event[0], scanned_at.isoformat(" ")))
+        conn.executemany(
+            'INSERT INTO "Users" (user_id, name, company, email, phone, checked_in) VALUES (?, ?, ?, ?, ?, ?)',
+            user_rows
+        )
+        conn.executemany('INSERT INTO "UserSkills" (user_id, skill_id, rating) VALUES (?, ?, ?)', user_skill_rows)
+        conn.executemany('INSERT INTO "ScanEvents" (user_id, event_id, created_at) VALUES (?, ?, ?)', scan_rows)
+        scan_count += len(scan_rows)
+
+    conn.executemany(
+        'INSERT INTO "Hardware" (hardware_id, name, serial_number, signed_out_by_user_id) VALUES (?, ?, ?, ?)',
+        [
+            (hardware_id, f"Device {hardware_id}", f"SN{seed:04d}{hardware_id:08d}", rng.randint(1, users) if rng.random() < 0.3 else None)
+            for hardware_id in range(1, hardware + 1)
+        ]
+    )
+    conn.commit()
+    conn.execute("PRAGMA journal_mode = DELETE")
+    conn.close()
+
+    # Count the scans into the analytics buckets, as `python -m app.scan_rollups backfill` would
+    with engine.begin() as connection:
+        scan_rollups.backfill(connection)
+    engine.dispose()
+
+    return {"users": users, "skills": len(skill_names), "events": events, "hardware": hardware, "scans": scan_count, "seed": seed}
+
+
+def dataset_path(data_dir, users, seed):
+    return os.path.join(data_dir, f"bench_{users}_{seed}.db")
+
+
+def ensure_dataset(data_dir, users, seed):
+    """
+    Generate the dataset for this size and seed unless it was already generated.
+    """
+    path = dataset_path(data_dir, users, seed)
+    if not os.path.exists(path):
+        os.makedirs(data_dir, exist_ok=True)
+        partial_path = path + ".partial"
+        generate(partial_path, users=users, seed=seed)
+        os.replace(partial_path, path)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path")
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skills", type=int, default=400)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    summary = generate(args.path, users=args.users, seed=args.seed, skills=args.skills)
+    summary["seconds"] = round(time.perf_counter() - started, 2)
+    print(summary)
@@ -0,0 +1,68 @@
+"""
+Measure the query and payload cost of sparse fieldsets on the user endpoints.
+
+Each variant is requested in-process through the app and the SQL statements it runs are counted
+with an engine event listener. Point SQL_APP_DB_PATH at a seeded copy of the database, since
+nothing here writes to it.
+
+Usage:
+    SQL_APP_DB_PATH=/tmp/bench.db python -m benchmarks.fieldsets --repeat 50
+"""
+import argparse
+import json
+import time
+
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+from app.database import get_engine
+from app.main import app
+
+VARIANTS = [
+    ("/users/?limit=1000", "all fields"),
+    ("/users/?limit=1000&fields=name,email", "name and email"),
+    ("/users/?limit=1000&fields=name,email&expand=skills", "name, email and skills"),
+    ("/users/1", "all fields"),
+    ("/users/1?fields=name,email", "name and email"),
+    ("/hacker/1/dashboard", "default"),
+    ("/hacker/1/dashboard?fields=name", "name only"),
+]
+
+
+def measure(client, url, repeat):
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = get_engine()
+    event.listen(engine, "before_cursor_execute", count_statement)
+    try:
+        response = client.get(url)
+    finally:
+        event.remove(engine, "before_cursor_execute", count_statement)
+    assert response.status_code == 200, response.text
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        client.get(url)
+    elapsed = (time.perf_counter() - start) / repeat
+
+    return {
+        "queries": len(statements),
+        "joins_skills": any("Skills" in statement for statement in statements),
+        "payload_bytes": len(response.content),
+        "latency_ms": round(elapsed * 1000, 3),
+    }
+
+
+def run(repeat):
+    client = TestClient(app)
+    return [{"url": url, "variant": variant, **measure(client, url, repeat)} for url, variant in VARIANTS]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    print(json.dumps(run(args.repeat), indent=2))
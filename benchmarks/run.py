@@ -0,0 +1,216 @@
+"""
+Run load-test scenarios against the app and report throughput and latency percentiles as JSON.
+
+The dataset is generated (or reused) with benchmarks/datagen.py and copied to a working database
+before each write scenario, so runs with the same arguments are comparable. The in-process app
+runs its lifespan like a served one, and its caches and views are dropped along with the old
+database. uvicorn is restarted instead.
+
+Usage:
+    # In-process, through the ASGI app (and its lifespan) without a server
+    python -m benchmarks.run --users 10000 --requests 2000 --concurrency 16
+
+    # Against uvicorn, started by the runner with 4 workers
+    python -m benchmarks.run --users 100000 --uvicorn --workers 4 --out results.json
+
+    # Against a server that is already running on the working database
+    python -m benchmarks.run --users 10000 --url http://127.0.0.1:8000 --scenario dashboard_refresh
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from contextlib import AsyncExitStack
+
+import httpx
+
+from app.snapshot import copy_database
+from benchmarks.datagen import ensure_dataset
+from benchmarks.scenarios import SCENARIOS, WRITE_SCENARIOS
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(name, latencies, statuses, elapsed, concurrency):
+    latencies = sorted(latencies)
+    to_ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+    return {
+        "scenario": name,
+        "requests": len(latencies),
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "latency_ms": {
+            "mean": to_ms(sum(latencies) / len(latencies)) if latencies else None,
+            "p50": to_ms(percentile(latencies, 0.50)),
+            "p95": to_ms(percentile(latencies, 0.95)),
+            "p99": to_ms(percentile(latencies, 0.99)),
+            "max": to_ms(latencies[-1] if latencies else None),
+        },
+        "status_counts": {str(status): count for status, count in sorted(statuses.items())},
+    }
+
+
+async def run_requests(client, requests, concurrency):
+    latencies = []
+    statuses = Counter()
+    pending = iter(requests)
+
+    async def worker():
+        for method, url in pending:
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, url)
+                statuses[response.status_code] += 1
+            except httpx.HTTPError:
+                statuses["error"] += 1
+            latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, statuses, time.perf_counter() - started
+
+
+async def run_scenarios(client, args, reset_database):
+    results = []
+    for name in args.scenario:
+        if name in WRITE_SCENARIOS:
+            if reset_database is None:
+                print(f"Warning: not resetting the database before {name}", file=sys.stderr)
+            else:
+                reset_database()
+        rng = random.Random(f"{args.seed}:{name}")
+        requests = SCENARIOS[name](rng, args.users, args.requests)
+        # Warm up connections and caches before measuring
+        await run_requests(client, requests[:args.warmup], args.concurrency)
+        latencies, statuses, elapsed = await run_requests(client, requests[args.warmup:], args.concurrency)
+        results.append(summarize(name, latencies, statuses, elapsed, args.concurrency))
+    return results
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_uvicorn(working_db, workers, port):
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        env=dict(os.environ, SQL_APP_DB_PATH=working_db),
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"{url}/metrics", timeout=1)
+            return process, url
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("uvicorn did not start within 30 seconds")
+
+
+def stop_uvicorn(process):
+    process.terminate()
+    process.wait()
+
+
+async def main(args):
+    dataset = ensure_dataset(args.data_dir, args.users, args.seed)
+    working_db = os.path.join(args.data_dir, f"working_{args.users}_{args.seed}.db")
+    copy_database(dataset, working_db)
+
+    process = None
+    lifespan = None
+    if args.url:
+        target = args.url
+        reset_database = None  # The server's database is out of our hands
+        client = httpx.AsyncClient(base_url=args.url, timeout=30)
+    elif args.uvicorn:
+        port = free_port()
+        process, target = start_uvicorn(working_db, args.workers, port)
+        client = httpx.AsyncClient(base_url=target, timeout=30)
+
+        def reset_database():
+            # A restart drops the workers' caches and views along with the old database
+            nonlocal process
+            stop_uvicorn(process)
+            process = None
+            copy_database(dataset, working_db)
+            process, _ = start_uvicorn(working_db, args.workers, port)
+    else:
+        # The app reads SQL_APP_DB_PATH when it is imported
+        os.environ["SQL_APP_DB_PATH"] = working_db
+        from app import pipeline, user_changes
+        from app.main import app
+        from app.user_cache import user_cache
+        target = "in-process"
+        # ASGITransport doesn't send lifespan events, so the startup (warm-up, preloading, the
+        # outbox worker) and shutdown are run around the scenarios instead
+        lifespan = app.router.lifespan_context(app)
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://app", timeout=30)
+
+        def reset_database():
+            # Not while the outbox worker is writing to the file, and the user cache and views
+            # mustn't keep serving the old data (the same as between tests, see conftest.py)
+            with pipeline.worker.lock:
+                copy_database(dataset, working_db)
+            user_cache.clear()
+            user_changes.reset()
+
+    try:
+        async with AsyncExitStack() as stack:
+            if lifespan is not None:
+                await stack.enter_async_context(lifespan)
+            await stack.enter_async_context(client)
+            results = await run_scenarios(client, args, reset_database)
+    finally:
+        if process is not None:
+            stop_uvicorn(process)
+
+    return {
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "target": target,
+        "workers": args.workers if args.uvicorn else None,
+        "dataset": {"users": args.users, "seed": args.seed},
+        "python": platform.python_version(),
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10_000, help="Dataset size, from 10k to 1M users")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--scenario", nargs="+", choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per scenario")
+    parser.add_argument("--warmup", type=int, default=50, help="Requests per scenario sent before measuring")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "htn-2024-bench"))
+    parser.add_argument("--url", help="Send requests to an already running server")
+    parser.add_argument("--uvicorn", action="store_true", help="Start uvicorn and send requests to it")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers when using --uvicorn")
+    parser.add_argument("--out", help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    report = json.dumps(asyncio.run(main(args)), indent=2)
+    if args.out:
+        with open(args.out, "w") as file:
+            file.write(report + "\n")
+    else:
+        print(report)
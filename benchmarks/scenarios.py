@@ -0,0 +1,52 @@
+"""
+Traffic scenarios modelled on what the API sees during the event.
+
+Each scenario turns a seeded random generator and the dataset size into the list of requests to
+send, as (method, url) pairs. Scenarios that write (check-ins, scans) never repeat a user, so every
+request should succeed on a freshly generated dataset.
+"""
+
+
+def checkin_storm(rng, users, count):
+    """
+    Doors open: a burst of check-ins, each for a different hacker.
+    """
+    return [("PUT", f"/users/{user_id}/checkin") for user_id in rng.sample(range(1, users + 1), min(count, users))]
+
+
+def workshop_scan_burst(rng, users, count, event_id=1):
+    """
+    A popular workshop starts and volunteers scan everyone in at the door.
+    """
+    return [("POST", f"/scan/?user_id={user_id}&event_id={event_id}") for user_id in rng.sample(range(1, users + 1), min(count, users))]
+
+
+def dashboard_refresh(rng, users, count):
+    """
+    Hackers refreshing their dashboards. Most refreshes come from a small group of active users.
+    """
+    active_users = max(1, users // 10)
+    requests = []
+    for _ in range(count):
+        user_id = rng.randint(1, active_users) if rng.random() < 0.8 else rng.randint(1, users)
+        requests.append(("GET", f"/hacker/{user_id}/dashboard"))
+    return requests
+
+
+def skill_polling(rng, users, count):
+    """
+    Organizer dashboards polling skill frequencies with a handful of filter combinations.
+    """
+    filters = ["", "?min_frequency=10", "?max_frequency=100", f"?min_frequency={max(1, users // 1000)}"]
+    return [("GET", f"/skills/{rng.choice(filters)}") for _ in range(count)]
+
+
+SCENARIOS = {
+    "checkin_storm": checkin_storm,
+    "workshop_scan_burst": workshop_scan_burst,
+    "dashboard_refresh": dashboard_refresh,
+    "skill_polling": skill_polling,
+}
+
+# Scenarios that change the database, so the dataset is restored before running them
+WRITE_SCENARIOS = {"checkin_storm", "workshop_scan_burst"}
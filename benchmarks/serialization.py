@@ -0,0 +1,89 @@
+"""
+Compare the CPU time spent serializing a /users/ response on the old and the fast path.
+
+The old path builds a schemas.User per row and then lets FastAPI validate and serialize the list
+against the route's response_model. The fast path dumps the rows straight to JSON bytes with a
+cached TypeAdapter (see app/responses.py).
+
+Usage:
+    python -m benchmarks.serialization
+    python -m benchmarks.serialization --sizes 100 10000 --repeat 20
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import List
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from app import schemas
+from app.responses import json_response
+
+SKILL_NAMES = ["Python", "Rust", "Go", "Swift", "OpenCV", "React", "Svelte", "Julia", "PHP", "Ruby"]
+
+
+def make_users(count, seed=0):
+    rng = random.Random(seed)
+    return [
+        {
+            "name": f"User {i}",
+            "company": f"Company {rng.randrange(200)}",
+            "email": f"user{i}@example.com",
+            "phone": f"555-{i:07d}",
+            "checked_in": rng.random() < 0.5,
+            "skills": [
+                {"skill": name, "rating": rng.randint(1, 5)}
+                for name in rng.sample(SKILL_NAMES, rng.randint(1, 5))
+            ],
+        }
+        for i in range(count)
+    ]
+
+
+response_field = create_response_field(name="Response_Read_Users", type_=List[schemas.User])
+
+
+def old_path(rows):
+    users = [schemas.User(**row) for row in rows]
+    content = asyncio.run(serialize_response(field=response_field, response_content=users))
+    return JSONResponse(content).body
+
+
+def fast_path(rows):
+    return json_response(List[schemas.UserPayload], rows).body
+
+
+def cpu_time_per_response(render, rows, repeat):
+    render(rows)  # Warm up caches and compiled serializers
+    start = time.process_time()
+    for _ in range(repeat):
+        render(rows)
+    return (time.process_time() - start) / repeat
+
+
+def run(sizes, repeat):
+    results = []
+    for size in sizes:
+        rows = make_users(size)
+        assert json.loads(old_path(rows)) == json.loads(fast_path(rows))
+        old = cpu_time_per_response(old_path, rows, repeat)
+        fast = cpu_time_per_response(fast_path, rows, repeat)
+        results.append({
+            "users": size,
+            "old_ms": round(old * 1000, 3),
+            "fast_ms": round(fast * 1000, 3),
+            "speedup": round(old / fast, 1) if fast else None,
+        })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 10_000])
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+    print(json.dumps(run(args.sizes, args.repeat), indent=2))
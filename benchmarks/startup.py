@@ -0,0 +1,96 @@
+"""
+Measure how long a new worker takes to start and serve its first requests.
+
+Every run starts a fresh interpreter (as uvicorn does for each worker), which imports the app, runs
+its lifespan startup and sends one request to each of FIRST_REQUESTS in-process. The report gives
+the median of each phase per configuration:
+
+    import_ms      importing app.main
+    startup_ms     the lifespan startup (engine, schema check, warm-up, preloading)
+    first_*_ms     the first request to each URL, when every cache is still cold
+    ready_ms       from starting the interpreter to the last first response
+
+Point SQL_APP_DB_PATH at a seeded copy of the database, since nothing here writes to it.
+
+Usage:
+    SQL_APP_DB_PATH=/tmp/bench.db python -m benchmarks.startup --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FIRST_REQUESTS = [
+    "/users/1",
+    "/users/?limit=100",
+    "/skills/",
+    "/hacker/1/dashboard",
+    "/analytics/companies",
+    "/users/1/matches",
+]
+
+CONFIGURATIONS = {
+    "no warm-up": {"SQL_APP_WARMUP": "off"},
+    "warm-up": {},
+    "warm-up and preload": {"SQL_APP_PRELOAD": "analytics,matching"},
+}
+
+
+def child(started_at):
+    """
+    Runs in the new interpreter. Prints the timings of one start as JSON.
+    """
+    timings = {}
+    start = time.perf_counter()
+    from fastapi.testclient import TestClient
+    from app.main import app
+    timings["import_ms"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    # Entering the client runs the lifespan startup
+    with TestClient(app) as client:
+        timings["startup_ms"] = (time.perf_counter() - start) * 1000
+        for url in FIRST_REQUESTS:
+            start = time.perf_counter()
+            response = client.get(url)
+            timings[f"first {url} ms"] = (time.perf_counter() - start) * 1000
+            assert response.status_code == 200, response.text
+        timings["ready_ms"] = (time.time() - started_at) * 1000
+    print(json.dumps(timings))
+
+
+def run(configuration, runs):
+    samples = []
+    for _ in range(runs):
+        started_at = time.time()
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.startup", "--child", str(started_at)],
+            cwd=PROJECT_ROOT,
+            env=dict(os.environ, **CONFIGURATIONS[configuration]),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        samples.append(json.loads(output.splitlines()[-1]))
+    return {
+        "configuration": configuration,
+        **{name: round(statistics.median(sample[name] for sample in samples), 2) for name in samples[0]},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Interpreters started per configuration")
+    parser.add_argument("--configuration", nargs="+", choices=list(CONFIGURATIONS), default=list(CONFIGURATIONS))
+    parser.add_argument("--child", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        child(args.child)
+    else:
+        print(json.dumps([run(configuration, args.runs) for configuration in args.configuration], indent=2))